@@ -0,0 +1,75 @@
+#! /usr/bin/env python3
+# Compare masking output with the secret masker against the implementation it
+# replaced, for a few shapes of secrets and output.
+#
+#   PYTHONPATH=terrat_runner python3 bench/bench_secret_mask.py
+import random
+import string
+import time
+
+import secret_mask
+
+
+LINE = '      + resource "aws_instance" "web" { ami = "ami-0abcdef1234567890" tags = { Name = "x" } }\n'
+
+
+def old_mask(secrets, output):
+    for secret in sorted(secrets, key=len, reverse=True):
+        if secret in output:
+            output = output.replace(secret, '***')
+    return output
+
+
+def make_secrets(rand, count, min_len, max_len):
+    alphabet = string.ascii_letters + string.digits
+    return [''.join(rand.choice(alphabet) for _ in range(rand.randint(min_len, max_len)))
+            for _ in range(count)]
+
+
+def timed(f, texts):
+    start = time.perf_counter()
+    for t in texts:
+        f(t)
+    return time.perf_counter() - start
+
+
+def main():
+    rand = random.Random(0)
+    outputs = [
+        ('one 9MB string', [LINE * 100000]),
+        ('20000 small strings', [LINE * 3] * 20000),
+    ]
+    shapes = [
+        (20, 12, 40),
+        (120, 12, 40),
+        (120, 4, 8),
+        (500, 12, 40),
+    ]
+
+    engines = [('each', False)]
+    if secret_mask.ahocorasick is not None:
+        engines.append(('automaton', True))
+    else:
+        print('pyahocorasick is not installed, only timing the per-secret search')
+
+    print('{:>8} {:>8} {:<22} {:>8} {}'.format('secrets', 'length', 'output', 'old', ' '.join(
+        '{:>10}'.format(name) for (name, _) in engines)))
+    for (count, min_len, max_len) in shapes:
+        secrets = make_secrets(rand, count, min_len, max_len)
+        for (name, texts) in outputs:
+            texts = [t[:1000] + secrets[0] + t[1000:] for t in texts]
+            old = timed(lambda t: old_mask(secrets, t), texts)
+            times = []
+            for (_, use_automaton) in engines:
+                masker = secret_mask.Masker(secrets, use_automaton=use_automaton)
+                times.append(timed(masker.mask, texts))
+            print('{:>8} {:>8} {:<22} {:>7.3f}s {}'.format(
+                count,
+                '{}-{}'.format(min_len, max_len),
+                name,
+                old,
+                ' '.join('{:>9.3f}s'.format(t) for t in times)))
+
+
+if __name__ == '__main__':
+    main()
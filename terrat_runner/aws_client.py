@@ -0,0 +1,476 @@
+# Talk to S3 and STS in-process instead of starting the AWS CLI for every call.
+#
+# Starting the CLI costs around a second of CPU, which every dirspace paid to
+# store or fetch its plan.  There are two in-process backends:
+#
+# - boto3, if it is installed, which resolves credentials the same way the CLI
+#   does.
+#
+# - A native one, which signs requests with Signature Version 4 and sends them
+#   over the pooled connections of requests_retry.  It only supports
+#   credentials given in the environment.
+#
+# TERRATEAM_AWS_CLIENT chooses the backend: auto (the default) uses boto3 if it
+# is installed and the native backend otherwise, and cmd makes [s3_client] and
+# [assume_role] return [None] so callers use the CLI as before.
+#
+# Large objects are uploaded in parts and downloaded in ranges, several at a
+# time.
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import hmac
+import logging
+import os
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+import requests
+
+import requests_retry
+
+try:
+    import boto3
+    import boto3.exceptions
+    import boto3.s3.transfer
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+
+BACKEND_ENV = 'TERRATEAM_AWS_CLIENT'
+CONCURRENCY_ENV = 'TERRATEAM_AWS_CONCURRENCY'
+
+CONCURRENCY = 8
+
+# Objects larger than this are uploaded in parts of PART_SIZE and downloaded
+# in ranges of PART_SIZE.  S3 parts must be at least 5MiB, except the last.
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+PART_SIZE = 16 * 1024 * 1024
+
+STS_VERSION = '2011-06-15'
+STS_NAMESPACE = {'sts': 'https://sts.amazonaws.com/doc/2011-06-15/'}
+S3_NAMESPACE = {'s3': 'http://s3.amazonaws.com/doc/2006-03-01/'}
+
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+
+Credentials = collections.namedtuple('Credentials',
+                                     ['access_key_id', 'secret_access_key', 'session_token'])
+
+
+class Error(Exception):
+    """A request failed.  [unreachable] is [True] if no response was received
+    at all, in which case the CLI may still be able to do it."""
+    def __init__(self, msg, unreachable=False):
+        super().__init__(msg)
+        self.unreachable = unreachable
+
+
+def credentials(env, access_key_id=None, secret_access_key=None):
+    """Return the credentials in [env], with the given keys taking precedence,
+    or [None] if there are none."""
+    if access_key_id or secret_access_key:
+        session_token = None
+    else:
+        session_token = env.get('AWS_SESSION_TOKEN')
+
+    access_key_id = access_key_id or env.get('AWS_ACCESS_KEY_ID')
+    secret_access_key = secret_access_key or env.get('AWS_SECRET_ACCESS_KEY')
+
+    if access_key_id and secret_access_key:
+        return Credentials(access_key_id, secret_access_key, session_token)
+    else:
+        return None
+
+
+def backend(env, creds):
+    setting = env.get(BACKEND_ENV, 'auto').lower()
+    if setting == 'cmd':
+        return 'cmd'
+    elif setting in ('auto', 'boto3') and boto3 is not None:
+        return 'boto3'
+    elif setting in ('auto', 'native', 'boto3') and creds is not None:
+        return 'native'
+    else:
+        return 'cmd'
+
+
+def _concurrency(env):
+    return max(1, int(env.get(CONCURRENCY_ENV, CONCURRENCY)))
+
+
+def _parse_time(s):
+    return datetime.datetime.fromisoformat(s.replace('Z', '+00:00')).timestamp()
+
+
+def _quote(s, safe='-_.~'):
+    return urllib.parse.quote(s, safe=safe)
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def sign(method, url, headers, payload_hash, creds, region, service, now=None):
+    """Return [headers] with the headers of a Signature Version 4 signature
+    added.  Every header in [headers] is signed, as well as the host.  The
+    query string of [url] must already be in canonical form, see [_query]."""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date = now.strftime('%Y%m%d')
+
+    parts = urllib.parse.urlsplit(url)
+    headers = dict(headers)
+    headers['host'] = parts.netloc
+    headers['x-amz-date'] = amz_date
+    if creds.session_token:
+        headers['x-amz-security-token'] = creds.session_token
+
+    canonical_headers = sorted((k.lower(), ' '.join(str(v).split())) for k, v in headers.items())
+    signed_headers = ';'.join(k for k, _ in canonical_headers)
+    canonical_request = '\n'.join([
+        method,
+        parts.path or '/',
+        parts.query,
+        ''.join('{}:{}\n'.format(k, v) for k, v in canonical_headers),
+        signed_headers,
+        payload_hash,
+    ])
+
+    scope = '{}/{}/{}/aws4_request'.format(date, region, service)
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256',
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request.encode('utf-8')).hexdigest(),
+    ])
+
+    key = _hmac(('AWS4' + creds.secret_access_key).encode('utf-8'), date)
+    key = _hmac(key, region)
+    key = _hmac(key, service)
+    key = _hmac(key, 'aws4_request')
+    signature = hmac.new(key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    headers['authorization'] = (
+        'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+            creds.access_key_id,
+            scope,
+            signed_headers,
+            signature))
+    del headers['host']
+    return headers
+
+
+def _query(params):
+    return '&'.join('{}={}'.format(_quote(k), _quote(str(v))) for k, v in sorted(params.items()))
+
+
+def _aws_domain(region):
+    if region.startswith('cn-'):
+        return 'amazonaws.com.cn'
+    else:
+        return 'amazonaws.com'
+
+
+def sts_endpoint(env, region):
+    endpoint = env.get('AWS_ENDPOINT_URL_STS', env.get('AWS_ENDPOINT_URL'))
+    if endpoint:
+        return endpoint
+    else:
+        return 'https://sts.{}.{}/'.format(region, _aws_domain(region))
+
+
+def _request(f, url, *args, **kwargs):
+    try:
+        return f(url, *args, **kwargs)
+    except requests.exceptions.RequestException as exn:
+        raise Error('{}: {}'.format(url, exn), unreachable=True)
+
+
+def _check(res, *ok):
+    if res.status_code not in (ok or (200,)):
+        raise Error('{} {}: {}'.format(res.status_code,
+                                       res.request.method,
+                                       res.content.decode('utf-8', errors='replace')))
+    return res
+
+
+def parse_sts_credentials(content):
+    """Return the credentials in the response to an STS AssumeRole* call as a
+    dict, with when they expire in seconds since the epoch."""
+    creds = ET.fromstring(content).find('.//sts:Credentials', STS_NAMESPACE)
+    if creds is None:
+        raise Error(content.decode('utf-8', errors='replace'))
+
+    return {
+        'access_key_id': creds.find('sts:AccessKeyId', STS_NAMESPACE).text,
+        'secret_access_key': creds.find('sts:SecretAccessKey', STS_NAMESPACE).text,
+        'session_token': creds.find('sts:SessionToken', STS_NAMESPACE).text,
+        'expires_at': _parse_time(creds.find('sts:Expiration', STS_NAMESPACE).text),
+    }
+
+
+def _sts_call(env, region, params, creds=None):
+    url = sts_endpoint(env, region)
+    body = _query(dict(params, Version=STS_VERSION))
+    headers = {'content-type': 'application/x-www-form-urlencoded; charset=utf-8'}
+    if creds is not None:
+        headers = sign('POST',
+                       url,
+                       headers,
+                       hashlib.sha256(body.encode('utf-8')).hexdigest(),
+                       creds,
+                       region,
+                       'sts')
+
+    res = _check(_request(requests_retry.post, url, data=body.encode('utf-8'), headers=headers))
+    return parse_sts_credentials(res.content)
+
+
+def assume_role_with_web_identity(env, region, role_arn, session_name, duration, web_identity_token):
+    """Exchange an OIDC token for credentials.  The request is not signed, so
+    this does not need any backend."""
+    return _sts_call(env,
+                     region,
+                     {
+                         'Action': 'AssumeRoleWithWebIdentity',
+                         'RoleArn': role_arn,
+                         'RoleSessionName': session_name,
+                         'WebIdentityToken': web_identity_token,
+                         'DurationSeconds': duration,
+                     })
+
+
+def assume_role(env, region, role_arn, session_name, duration):
+    """Assume a role with the credentials in [env].  Returns [None] if the AWS
+    CLI has to be used instead."""
+    creds = credentials(env)
+    b = backend(env, creds)
+    if b == 'boto3':
+        try:
+            session = _boto3_session(creds, region)
+            client = session.client('sts', endpoint_url=sts_endpoint(env, region))
+            res = client.assume_role(RoleArn=role_arn,
+                                     RoleSessionName=session_name,
+                                     DurationSeconds=duration)
+        except botocore.exceptions.EndpointConnectionError as exn:
+            raise Error(str(exn), unreachable=True)
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as exn:
+            raise Error(str(exn))
+
+        return {
+            'access_key_id': res['Credentials']['AccessKeyId'],
+            'secret_access_key': res['Credentials']['SecretAccessKey'],
+            'session_token': res['Credentials']['SessionToken'],
+            'expires_at': res['Credentials']['Expiration'].timestamp(),
+        }
+    elif b == 'native':
+        return _sts_call(env,
+                         region,
+                         {
+                             'Action': 'AssumeRole',
+                             'RoleArn': role_arn,
+                             'RoleSessionName': session_name,
+                             'DurationSeconds': duration,
+                         },
+                         creds=creds)
+    else:
+        return None
+
+
+class S3:
+    """S3 client using the native backend."""
+    def __init__(self,
+                 env,
+                 region,
+                 creds,
+                 concurrency=None,
+                 part_size=PART_SIZE,
+                 multipart_threshold=MULTIPART_THRESHOLD):
+        self.env = env
+        self.region = region
+        self.creds = creds
+        self.concurrency = concurrency or _concurrency(env)
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+
+    def _url(self, bucket, key, params=None):
+        endpoint = self.env.get('AWS_ENDPOINT_URL_S3', self.env.get('AWS_ENDPOINT_URL'))
+        path = _quote(key, safe='/-_.~')
+        if endpoint:
+            url = '{}/{}/{}'.format(endpoint.rstrip('/'), bucket, path)
+        elif '.' in bucket:
+            url = 'https://s3.{}.{}/{}/{}'.format(self.region, _aws_domain(self.region), bucket, path)
+        else:
+            url = 'https://{}.s3.{}.{}/{}'.format(bucket, self.region, _aws_domain(self.region), path)
+
+        if params:
+            url += '?' + _query(params)
+
+        return url
+
+    def _call(self, f, method, bucket, key, params=None, headers=None, data=b''):
+        url = self._url(bucket, key, params)
+        payload_hash = hashlib.sha256(data).hexdigest() if data else EMPTY_SHA256
+        headers = sign(method,
+                       url,
+                       dict(headers or {}, **{'x-amz-content-sha256': payload_hash}),
+                       payload_hash,
+                       self.creds,
+                       self.region,
+                       's3')
+        if data:
+            return _request(f, url, data=data, headers=headers)
+        else:
+            return _request(f, url, headers=headers)
+
+    def size(self, bucket, key):
+        """Return the size of the object, or [None] if it does not exist."""
+        res = self._call(requests_retry.head, 'HEAD', bucket, key)
+        if res.status_code == 404:
+            return None
+        _check(res)
+        return int(res.headers['content-length'])
+
+    def delete(self, bucket, key):
+        _check(self._call(requests_retry.delete, 'DELETE', bucket, key), 200, 204)
+
+    def put_file(self, bucket, key, path):
+        size = os.path.getsize(path)
+        if size <= self.multipart_threshold:
+            with open(path, 'rb') as f:
+                data = f.read()
+            _check(self._call(requests_retry.put, 'PUT', bucket, key, data=data))
+        else:
+            self._put_multipart(bucket, key, path, size)
+
+    def _put_multipart(self, bucket, key, path, size):
+        res = _check(self._call(requests_retry.post, 'POST', bucket, key, params={'uploads': ''}))
+        upload_id = ET.fromstring(res.content).find('s3:UploadId', S3_NAMESPACE).text
+
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            def _put_part(part_number):
+                data = os.pread(fd, self.part_size, (part_number - 1) * self.part_size)
+                res = _check(self._call(requests_retry.put,
+                                        'PUT',
+                                        bucket,
+                                        key,
+                                        params={'partNumber': part_number, 'uploadId': upload_id},
+                                        data=data))
+                return (part_number, res.headers['etag'])
+
+            part_numbers = range(1, (size + self.part_size - 1) // self.part_size + 1)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                parts = sorted(pool.map(_put_part, part_numbers))
+        except Exception:
+            try:
+                self._call(requests_retry.delete, 'DELETE', bucket, key, params={'uploadId': upload_id})
+            except Error as exn:
+                logging.warning('AWS : S3 : ABORT_UPLOAD_FAILED : %s', exn)
+            raise
+        finally:
+            os.close(fd)
+
+        body = ''.join(['<CompleteMultipartUpload>'] +
+                       ['<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'.format(n, etag)
+                        for (n, etag) in parts] +
+                       ['</CompleteMultipartUpload>']).encode('utf-8')
+        res = _check(self._call(requests_retry.post,
+                                'POST',
+                                bucket,
+                                key,
+                                params={'uploadId': upload_id},
+                                data=body))
+        # Completing an upload can fail after the response has started, in
+        # which case the error is in the body of a 200.
+        if ET.fromstring(res.content).tag == 'Error':
+            raise Error(res.content.decode('utf-8', errors='replace'))
+
+    def get_file(self, bucket, key, path):
+        size = self.size(bucket, key)
+        if size is None:
+            raise Error('s3://{}/{}: not found'.format(bucket, key))
+
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            if size <= self.multipart_threshold:
+                res = _check(self._call(requests_retry.get, 'GET', bucket, key))
+                os.write(fd, res.content)
+            else:
+                def _get_range(start):
+                    end = min(start + self.part_size, size) - 1
+                    res = _check(self._call(requests_retry.get,
+                                            'GET',
+                                            bucket,
+                                            key,
+                                            headers={'range': 'bytes={}-{}'.format(start, end)}),
+                                 206)
+                    os.pwrite(fd, res.content, start)
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                    list(pool.map(_get_range, range(0, size, self.part_size)))
+        finally:
+            os.close(fd)
+
+
+def _boto3_session(creds, region):
+    if creds is not None:
+        return boto3.session.Session(aws_access_key_id=creds.access_key_id,
+                                     aws_secret_access_key=creds.secret_access_key,
+                                     aws_session_token=creds.session_token,
+                                     region_name=region)
+    else:
+        return boto3.session.Session(region_name=region)
+
+
+class Boto3S3:
+    """S3 client using boto3, which does its own multipart transfers."""
+    def __init__(self, env, region, creds, concurrency=None):
+        endpoint = env.get('AWS_ENDPOINT_URL_S3', env.get('AWS_ENDPOINT_URL'))
+        self.client = _boto3_session(creds, region).client('s3', endpoint_url=endpoint)
+        self.config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=PART_SIZE,
+            max_concurrency=concurrency or _concurrency(env))
+
+    def _call(self, f, *args, **kwargs):
+        try:
+            return f(*args, **kwargs)
+        except botocore.exceptions.EndpointConnectionError as exn:
+            raise Error(str(exn), unreachable=True)
+        except (boto3.exceptions.Boto3Error,
+                botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError) as exn:
+            raise Error(str(exn))
+
+    def size(self, bucket, key):
+        try:
+            return self.client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        except botocore.exceptions.ClientError as exn:
+            if exn.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise Error(str(exn))
+
+    def delete(self, bucket, key):
+        self._call(self.client.delete_object, Bucket=bucket, Key=key)
+
+    def put_file(self, bucket, key, path):
+        self._call(self.client.upload_file, path, bucket, key, Config=self.config)
+
+    def get_file(self, bucket, key, path):
+        self._call(self.client.download_file, bucket, key, path, Config=self.config)
+
+
+def s3_client(env, region, creds=None):
+    """Return an S3 client, or [None] if the AWS CLI has to be used instead.
+    [creds] default to the credentials in [env]."""
+    creds = creds or credentials(env)
+    b = backend(env, creds)
+    if b == 'boto3':
+        return Boto3S3(env, region, creds)
+    elif b == 'native':
+        return S3(env, region, creds)
+    else:
+        return None
@@ -1,10 +1,30 @@
+import codecs
 import io
 import logging
+import os
 import re
 import selectors
 import string
 import subprocess
 import sys
+import tempfile
+
+
+# Size of each read from a command's stdout and stderr.
+CHUNK_SIZE = 64 * 1024
+
+# Captured output larger than this is moved from memory to a temporary file.
+SPILL_BYTES = 8 * 1024 * 1024
+
+# Lines longer than this are logged in pieces rather than held in memory until
+# the end of the line is read.
+MAX_LOG_LINE = 64 * 1024
+
+_ANSI = re.compile(r'\033\[(\d|;)+?m')
+
+# The end of a chunk that could be the start of an escape sequence that
+# continues in the next chunk.
+_ANSI_PARTIAL = re.compile(r'\033(\[[\d;]*)?\Z')
 
 
 class MissingEnvVar(Exception):
@@ -12,7 +32,85 @@ class MissingEnvVar(Exception):
 
 
 def _strip_ansi(s):
-    return re.sub(r'\033\[(\d|;)+?m', '', s)
+    return _ANSI.sub('', s)
+
+
+class _AnsiStripper:
+    """Strip ANSI color codes from text that arrives in chunks, holding back the
+    end of a chunk if it might be part of an escape sequence."""
+    def __init__(self):
+        self.carry = ''
+
+    def feed(self, s):
+        s = self.carry + s
+        m = _ANSI_PARTIAL.search(s)
+        if m:
+            self.carry = s[m.start():]
+            s = s[:m.start()]
+        else:
+            self.carry = ''
+        return _strip_ansi(s)
+
+    def flush(self):
+        s = self.carry
+        self.carry = ''
+        return s
+
+
+class Output:
+    """Captured output of a command.  The output is kept in memory until it is
+    larger than [spill_bytes], after which it is kept in a temporary file.  It
+    is stored UTF-8 encoded, sizes and offsets are in bytes.
+
+    The output is only turned into one string if [read] is called, use [head],
+    [tail] or [chunks] to look at part of it.
+
+    """
+    def __init__(self, spill_bytes=SPILL_BYTES):
+        self.spill_bytes = spill_bytes
+        self.f = io.BytesIO()
+        self.spilled = False
+        self.size = 0
+
+    def write(self, s):
+        b = s.encode('utf-8')
+        if not self.spilled and self.size + len(b) > self.spill_bytes:
+            f = tempfile.TemporaryFile()
+            f.write(self.f.getvalue())
+            self.f = f
+            self.spilled = True
+        self.f.write(b)
+        self.size += len(b)
+
+    def _read_range(self, offset, length):
+        self.f.seek(offset)
+        b = self.f.read(length)
+        self.f.seek(0, os.SEEK_END)
+        return b
+
+    def head(self, n):
+        return self._read_range(0, n).decode('utf-8', errors='ignore')
+
+    def tail(self, n):
+        offset = max(0, self.size - n)
+        return self._read_range(offset, self.size - offset).decode('utf-8', errors='ignore')
+
+    def chunks(self, size=CHUNK_SIZE):
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        for offset in range(0, self.size, size):
+            yield decoder.decode(self._read_range(offset, size))
+        s = decoder.decode(b'', final=True)
+        if s:
+            yield s
+
+    def read(self):
+        return self._read_range(0, self.size).decode('utf-8')
+
+    def close(self):
+        self.f.close()
+
+    def __len__(self):
+        return self.size
 
 
 def replace_vars(s, env):
@@ -51,15 +149,54 @@ def run(state, config):
         return subprocess.run(cmd, cwd=state.working_dir, env=env, stdout=subprocess.DEVNULL)
 
 
-def _handle_line(state, config, name, stream, line):
-    stream.write(line)
-    if state.runtime.is_command(line):
-        sys.stdout.write(line)
-    elif config.get('log_output', True):
-        sys.stderr.write('cwd={}: {}: {}'.format(state.working_dir, name, line))
+class _Stream:
+    def __init__(self, state, config, name, output):
+        self.state = state
+        self.config = config
+        self.name = name
+        self.output = output
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='backslashreplace')
+        self.stripper = _AnsiStripper()
+        self.line = ''
 
+    def _handle_line(self, line):
+        state = self.state
+        config = self.config
+        # A caller can consume stdout as it is produced instead of having all of
+        # it collected and returned.
+        if self.name == 'stdout' and 'stdout_line_handler' in config:
+            config['stdout_line_handler'](_strip_ansi(line))
+        if state.runtime.is_command(line):
+            sys.stdout.write(line)
+        elif config.get('log_output', True):
+            sys.stderr.write('cwd={}: {}: {}'.format(state.working_dir, self.name, line))
 
-def run_with_output(state, config):
+    def feed(self, b, final=False):
+        s = self.decoder.decode(b, final=final)
+
+        if self.name != 'stdout' or 'stdout_line_handler' not in self.config:
+            self.output.write(self.stripper.feed(s))
+            if final:
+                self.output.write(self.stripper.flush())
+
+        lines = (self.line + s).split('\n')
+        self.line = lines.pop()
+
+        for line in lines:
+            self._handle_line(line + '\n')
+
+        if final and self.line:
+            self._handle_line(self.line)
+            self.line = ''
+        elif len(self.line) > MAX_LOG_LINE and 'stdout_line_handler' not in self.config:
+            self._handle_line(self.line + '\n')
+            self.line = ''
+
+
+def run_with_capture(state, config):
+    """Same as [run_with_output] but the output is returned as [Output] handles
+    rather than strings.  The caller must close them.  The output is read in
+    chunks, and the command's output is never held in memory more than once."""
     cmd = config['cmd']
     env = _create_env(state.env, config.get('env', {}))
     if config.get('log_cmd_pre_replace', False):
@@ -83,38 +220,38 @@ def run_with_output(state, config):
 
     proc.stdin.close()
 
-    sel = selectors.DefaultSelector()
-
-    stdout_done = False
-    stderr_done = False
+    spill_bytes = int(state.env.get('TERRATEAM_OUTPUT_SPILL_BYTES', SPILL_BYTES))
+    stdout = Output(spill_bytes)
+    stderr = Output(spill_bytes)
 
-    sel.register(proc.stdout, selectors.EVENT_READ, 'stdout')
-    sel.register(proc.stderr, selectors.EVENT_READ, 'stderr')
+    sel = selectors.DefaultSelector()
+    sel.register(proc.stdout, selectors.EVENT_READ, _Stream(state, config, 'stdout', stdout))
+    sel.register(proc.stderr, selectors.EVENT_READ, _Stream(state, config, 'stderr', stderr))
 
-    stdout = io.StringIO()
-    stderr = io.StringIO()
-    while not (stdout_done and stderr_done):
-        events = sel.select()
-        for key, _ in events:
-            line = key.fileobj.readline().decode('utf-8', errors='backslashreplace')
+    open_streams = 2
+    while open_streams:
+        for key, _ in sel.select():
+            b = os.read(key.fileobj.fileno(), CHUNK_SIZE)
 
-            if not line:
-                sel.unregister(key.fileobj)
-                if key.data == 'stdout':
-                    stdout_done = True
-                elif key.data == 'stderr':
-                    stderr_done = True
-                else:
-                    raise Exception('Unknown data: {}'.format(key.data))
-
-            elif key.data == 'stdout':
-                _handle_line(state, config, key.data, stdout, line)
-            elif key.data == 'stderr':
-                _handle_line(state, config, key.data, stderr, line)
+            if b:
+                key.data.feed(b)
             else:
-                raise Exception('Unknown data: {}'.format(key.data))
+                key.data.feed(b, final=True)
+                sel.unregister(key.fileobj)
+                open_streams -= 1
 
     sel.close()
+    proc.stdout.close()
+    proc.stderr.close()
 
     proc.wait()
-    return (proc, _strip_ansi(stdout.getvalue()), _strip_ansi(stderr.getvalue()))
+    return (proc, stdout, stderr)
+
+
+def run_with_output(state, config):
+    (proc, stdout, stderr) = run_with_capture(state, config)
+    try:
+        return (proc, stdout.read(), stderr.read())
+    finally:
+        stdout.close()
+        stderr.close()
@@ -0,0 +1,140 @@
+# Cache short-lived credentials for the whole run, across worker processes.
+#
+# Credentials are stored in files in TERRATEAM_CREDENTIAL_CACHE_DIR, which is
+# inside the run's temporary directory.  Getting a credential holds a lock on
+# its entry, so when several workers need the same credential at once only one
+# of them fetches it and the others wait and reuse it.  A credential is fetched
+# again once it is within a margin of its expiry, or after it is invalidated,
+# for example because the service rejected it.
+#
+# Each entry counts how often it was served from the cache and how often it
+# was fetched, see [log_stats].
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+
+
+ENV_NAME = 'TERRATEAM_CREDENTIAL_CACHE_DIR'
+
+# Credentials are fetched again when they have less than this many seconds
+# left.
+MARGIN = 300
+
+
+def cache_dir(env):
+    return env.get(ENV_NAME)
+
+
+def _path(directory, name, key):
+    h = hashlib.sha256(json.dumps([name, key], sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(directory, h)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write(path, entry):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
+
+
+class _Locked:
+    def __init__(self, path):
+        self.path = path + '.lock'
+
+    def __enter__(self):
+        self.f = open(self.path, 'a')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def get(env, name, key, fetch, margin=MARGIN):
+    """Return the credential [name] for [key], which is anything JSON
+    serialisable that identifies it, such as the role it is for.
+
+    [fetch] is called if the credential is not cached or is about to expire,
+    and returns the credential, which must be JSON serialisable, and the time
+    it expires at in seconds since the epoch.  Any exception it raises is
+    passed on and nothing is cached.
+
+    """
+    directory = cache_dir(env)
+    if not directory:
+        (value, _) = fetch()
+        return value
+
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    path = _path(directory, name, key)
+
+    with _Locked(path):
+        entry = _read(path) or {'name': name, 'hits': 0, 'fetches': 0}
+        if 'value' in entry and time.time() + margin < entry['expires_at']:
+            entry['hits'] += 1
+            _write(path, entry)
+            logging.debug('CREDENTIAL_CACHE : %s : HIT', name)
+            return entry['value']
+
+        logging.info('CREDENTIAL_CACHE : %s : FETCH', name)
+        (value, expires_at) = fetch()
+        entry['value'] = value
+        entry['expires_at'] = expires_at
+        entry['fetches'] += 1
+        _write(path, entry)
+        return value
+
+
+def invalidate(env, name, key):
+    """Make the next [get] of the credential fetch it again."""
+    directory = cache_dir(env)
+    if not directory:
+        return
+
+    path = _path(directory, name, key)
+    with _Locked(path):
+        entry = _read(path)
+        if entry is not None and 'value' in entry:
+            logging.info('CREDENTIAL_CACHE : %s : INVALIDATE', name)
+            del entry['value']
+            _write(path, entry)
+
+
+def stats(env):
+    """Return a dict of credential name to the number of times it was served
+    from the cache and the number of times it was fetched."""
+    directory = cache_dir(env)
+    ret = {}
+    if not directory or not os.path.isdir(directory):
+        return ret
+
+    for fname in os.listdir(directory):
+        if fname.endswith(('.lock', '.tmp')):
+            continue
+        entry = _read(os.path.join(directory, fname))
+        if entry is not None:
+            s = ret.setdefault(entry['name'], {'hits': 0, 'fetches': 0})
+            s['hits'] += entry['hits']
+            s['fetches'] += entry['fetches']
+
+    return ret
+
+
+def log_stats(env):
+    for name, s in sorted(stats(env).items()):
+        logging.info('CREDENTIAL_CACHE : STATS : %s : hits=%d : fetches=%d',
+                     name,
+                     s['hits'],
+                     s['fetches'])
@@ -1,4 +1,18 @@
+import collections
+import logging
 import multiprocessing
+import multiprocessing.util
+import pickle
+import queue
+import time
+
+import requests_retry
+
+
+# The worker pool lives for the whole runner process and is shared by every
+# work manifest it executes, see [_get_pool].
+_POOL = None
+_POOL_SIZE = 0
 
 
 # Need to order dirs by rank, but also, want to run one workspace at a time for
@@ -43,15 +57,194 @@ def _order_dirs_by_rank(dirs):
     return ret
 
 
-def _run(args):
-    return args[0](*args[1:])
+# Turn the rows from [_order_dirs_by_rank] into a dependency graph.  The rows
+# are only an approximation of the real constraints, which are:
+#
+# 1. Every dirspace of a rank must finish before any dirspace of a higher rank
+#    starts.
+#
+# 2. The workspaces of a dir run one at a time, in the order the rows put them
+#    in, unless [concurrent_workspaces] returns [True] for the dirspace, in which
+#    case it does not share any state with the other workspaces of its dir.
+#
+# The graph is returned as a list of dirspaces, in row order, and a list of the
+# same length where each entry is the set of indices that dirspace depends on.
+# It is enough for a dirspace to depend on the last workspaces of each dir in
+# the previous rank, as those transitively depend on everything before them.
+def _build_graph(dirs, concurrent_workspaces=None):
+    nodes = []
+    preds = []
+
+    prev_rank_tails = set()
+    rank = None
+    tails = {}
+
+    for row in _order_dirs_by_rank(dirs):
+        for d in row:
+            if d['rank'] != rank:
+                if rank is not None:
+                    prev_rank_tails = set(idx for idxs in tails.values() for idx in idxs)
+                rank = d['rank']
+                tails = {}
+
+            idx = len(nodes)
+            nodes.append(d)
+            if concurrent_workspaces is not None and concurrent_workspaces(d):
+                preds.append(set(prev_rank_tails))
+                tails.setdefault(d['path'], []).append(idx)
+            else:
+                preds.append(set(tails.get(d['path'], prev_rank_tails)))
+                tails[d['path']] = [idx]
+
+    return (nodes, preds)
+
+
+def _get_pool(parallel):
+    """Return the process-wide worker pool, creating it on first use.  The pool
+    is only recreated if a larger one is asked for, a smaller [parallel] is
+    honoured by [run] limiting how many tasks it has in flight.
+
+    """
+    global _POOL, _POOL_SIZE
+
+    if _POOL is None or _POOL_SIZE < parallel:
+        if _POOL is not None:
+            logging.info('DIR_EXEC : POOL : RESIZE : %d -> %d', _POOL_SIZE, parallel)
+            _POOL.close()
+            _POOL.join()
+        else:
+            logging.info('DIR_EXEC : POOL : CREATE : %d', parallel)
+
+        _POOL = multiprocessing.Pool(parallel, initializer=_init_worker)
+        _POOL_SIZE = parallel
+
+    return _POOL
+
+
+def _worker_exit():
+    requests_retry.close()
+    requests_retry.log_stats()
+
+
+def _init_worker():
+    # Workers make most of the requests of a run, so each one logs its own
+    # stats when the pool is closed and it exits.
+    multiprocessing.util.Finalize(None, _worker_exit, exitpriority=10)
+
+
+def shutdown():
+    global _POOL, _POOL_SIZE
+
+    if _POOL is not None:
+        logging.info('DIR_EXEC : POOL : SHUTDOWN')
+        _POOL.close()
+        _POOL.join()
+        _POOL = None
+        _POOL_SIZE = 0
+
+    requests_retry.close()
+
+
+def _run(task):
+    # The function and its arguments are pickled once per [run] rather than
+    # once per dirspace.  They are unpickled for every task so each dirspace
+    # gets its own copy, as steps are allowed to modify their configuration.
+    (ctx, d) = task
+    (f, args) = pickle.loads(ctx)
+    start = time.monotonic()
+    ret = f(*args, d)
+    return (time.monotonic() - start, ret)
+
+
+def _submit(pool, ctx, nodes, ready, done, in_flight, parallel):
+    while ready and in_flight < parallel:
+        idx = ready.popleft()
+        pool.apply_async(_run,
+                         ((ctx, nodes[idx]),),
+                         callback=lambda r, idx=idx: done.put((idx, True, r)),
+                         error_callback=lambda exn, idx=idx: done.put((idx, False, exn)))
+        in_flight += 1
+    return in_flight
+
+
+def run(parallel, dirs, f, args, concurrent_workspaces=None, on_result=None):
+    """Execute [f] on every dirspace in [dirs], [parallel] at a time.  A
+    dirspace is started as soon as everything it depends on has finished,
+    rather than waiting for an entire row of dirspaces to complete.  Results
+    are returned in row order.
+
+    [concurrent_workspaces] is an optional predicate on a dirspace which
+    returns [True] if it can run at the same time as the other workspaces of
+    its dir.
+
+    [on_result] is an optional function called with each dirspace and its
+    result as soon as it finishes, after the dirspaces waiting on it have been
+    started.
+
+    """
+    (nodes, preds) = _build_graph(dirs, concurrent_workspaces)
+
+    if not nodes:
+        return []
+
+    succs = [[] for _ in nodes]
+    for idx, ps in enumerate(preds):
+        for p in ps:
+            succs[p].append(idx)
+
+    waiting_on = [len(ps) for ps in preds]
+    ready = collections.deque(idx for idx, n in enumerate(waiting_on) if n == 0)
+    res = [None] * len(nodes)
+
+    ctx = pickle.dumps((f, args))
+    pool = _get_pool(parallel)
+
+    # Completions are delivered by the pool's result thread, so hand them back
+    # to this thread through a queue and do all of the bookkeeping here.
+    done = queue.Queue()
+
+    start = time.monotonic()
+    task_time = 0.0
+    in_flight = _submit(pool, ctx, nodes, ready, done, 0, parallel)
+    try:
+        while in_flight:
+            (idx, success, r) = done.get()
+            in_flight -= 1
+
+            if not success:
+                raise r
+
+            (elapsed, r) = r
+            task_time += elapsed
+            logging.info('DIR_EXEC : TASK : path=%s : workspace=%s : time=%.2fs',
+                         nodes[idx]['path'],
+                         nodes[idx]['workspace'],
+                         elapsed)
+
+            res[idx] = r
+            for s in succs[idx]:
+                waiting_on[s] -= 1
+                if waiting_on[s] == 0:
+                    ready.append(s)
+
+            in_flight = _submit(pool, ctx, nodes, ready, done, in_flight, parallel)
 
+            if on_result is not None:
+                on_result(nodes[idx], r)
+    except Exception:
+        # The pool outlives this run, so wait for the tasks that are still
+        # running rather than leave them to the next one.  Nothing new is
+        # started.
+        logging.info('DIR_EXEC : RUN : FAILED : draining=%d', in_flight)
+        while in_flight:
+            done.get()
+            in_flight -= 1
+        raise
 
-def run(parallel, dirs, f, args):
-    dirs = _order_dirs_by_rank(dirs)
-    res = []
-    for ds in dirs:
-        with multiprocessing.Pool(parallel) as p:
-            res.extend(p.map(_run, [(f,) + args + (d,) for d in ds]))
+    logging.info('DIR_EXEC : RUN : tasks=%d : parallel=%d : task_time=%.2fs : wall_time=%.2fs',
+                 len(nodes),
+                 parallel,
+                 task_time,
+                 time.monotonic() - start)
 
     return res
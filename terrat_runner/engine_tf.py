@@ -3,14 +3,25 @@ import logging
 import os
 import re
 import shutil
+import time
 
 import cmd
+import output_budget
+import plan_render
+import plugin_cache
 import repo_config
 import retry
 
 TRIES = 3
 INITIAL_SLEEP = 1
-BACKOFF = 1.5
+
+INIT_RETRY = retry.Policy('INIT', TRIES, INITIAL_SLEEP)
+
+# Past this many targets a targeted plan is usually slower than a full one.
+FAST_AND_LOOSE_MAX_TARGETS = 500
+
+# Event types of a `plan -json` that name a resource to target.
+TARGET_EVENTS = ['planned_change', 'resource_drift']
 
 
 # Opens a Terraform heredoc string value, e.g. `foo = <<-EOT` or `foo =
@@ -139,24 +150,25 @@ class Engine:
         return [self.tf_cmd, 'workspace'] + list(args)
 
     def init(self, state, config, create_and_select_workspace=None):
-        # If there is already a .terraform dir, delete it
-        terraform_path = os.path.join(state.working_dir, '.terraform')
+        # If there is already a data dir, delete it.  This is .terraform unless
+        # TF_DATA_DIR points somewhere else, for example when each dirspace is
+        # given its own data dir (see [work_exec.set_data_dir_env]).
+        terraform_path = os.path.join(state.working_dir, state.env.get('TF_DATA_DIR', '.terraform'))
         if os.path.exists(terraform_path):
             shutil.rmtree(terraform_path)
 
-        (proc, stdout, stderr) = retry.run(
-            lambda: cmd.run_with_output(
-                state,
-                {
-                    'cmd': [
-                        'flock',
-                        '/tmp/tf-init.lock',
-                        self.tf_cmd,
-                        'init'
-                    ] + config.get('extra_args', [])
-                }),
-            retry.finite_tries(TRIES, lambda result: result[0].returncode == 0),
-            retry.betwixt_sleep_with_backoff(INITIAL_SLEEP, BACKOFF))
+        init_cmd = [self.tf_cmd, 'init'] + config.get('extra_args', [])
+
+        # Inits are serialized because they may write to a shared plugin cache,
+        # unless all of the dir's providers have already been put in the cache.
+        if plugin_cache.is_resolved(state):
+            logging.info('INIT : PLUGIN_CACHE : %s : RESOLVED', state.path)
+        else:
+            init_cmd = ['flock', plugin_cache.INIT_LOCK] + init_cmd
+
+        (proc, stdout, stderr) = INIT_RETRY.run(
+            lambda: output_budget.run_with_output(state, {'cmd': init_cmd}),
+            lambda result: result[0].returncode == 0)
 
         if proc.returncode != 0:
             return (False, stdout, stderr)
@@ -201,7 +213,7 @@ class Engine:
             state.path,
             state.workflow['engine']['name'])
 
-        (proc, stdout, stderr) = cmd.run_with_output(
+        (proc, stdout, stderr) = output_budget.run_with_output(
             state,
             {
                 'cmd': [self.tf_cmd, 'apply'
@@ -216,16 +228,12 @@ class Engine:
             state.path,
             state.workflow['engine']['name'])
 
-        (proc, stdout, stderr) = cmd.run_with_output(
-            state,
-            {
-                'cmd': [self.tf_cmd, 'show', '${TERRATEAM_PLAN_FILE}']
-            })
-
-        if proc.returncode == 0:
-            stdout = format_diff(stdout)
+        (success, path, error) = plan_render.show_text(state, self.tf_cmd)
 
-        return (proc.returncode == 0, stdout, stderr)
+        if success:
+            return (True, format_diff(plan_render.read(path)), '')
+        else:
+            return (False, error, '')
 
 
     def diff_json(self, state, config):
@@ -234,19 +242,16 @@ class Engine:
             state.path,
             state.workflow['engine']['name'])
 
-        (proc, stdout, stderr) = cmd.run_with_output(
-            state,
-            {
-                'cmd': [self.tf_cmd, 'show', '-json', '${TERRATEAM_PLAN_FILE}']
-            })
+        (success, path, error) = plan_render.show_json(state, self.tf_cmd)
 
-        if proc.returncode == 0:
+        if success:
+            stdout = plan_render.read(path)
             try:
                 return (True, json.loads(stdout))
             except json.JSONDecodeError as exn:
                 return (False, stdout, str(exn))
 
-        return (False, stdout, stderr)
+        return (False, error, '')
 
 
     def plan(self, state, config):
@@ -256,26 +261,86 @@ class Engine:
             state.workflow['engine']['name'])
 
         if config.get('mode') == 'fast-and-loose':
-            (proc, stdout, stderr) = cmd.run_with_output(
-                state,
-                {
-                    'cmd': [self.tf_cmd, 'plan', '-detailed-exitcode', '-json', '-refresh=false'
-                            ] + config.get('extra_args', [])
-                })
+            return self._fast_and_loose_plan(state, config)
 
-            targets = []
+        (proc, stdout, stderr) = output_budget.run_with_output(
+            state,
+            {
+                'cmd': [
+                    self.tf_cmd,
+                    'plan',
+                    '-detailed-exitcode',
+                    '-out',
+                    '${TERRATEAM_PLAN_FILE}'
+                ] + config.get('extra_args', [])
+            })
+
+        return (proc.returncode in [0, 2], proc.returncode == 2, stdout, stderr)
+
+    def _fast_and_loose_plan(self, state, config):
+        # Plan without refreshing to find the resources that would change, then
+        # plan again with refresh, targeting only those resources.  The first
+        # plan is written to the plan file, so if nothing would change it is
+        # used as-is and the second plan is skipped entirely.
+        targets = {}
+        messages = []
+
+        def _on_line(line):
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                messages.append(line.rstrip('\n'))
+                return
+
+            if event.get('type') in TARGET_EVENTS:
+                targets[event['change']['resource']['addr']] = True
+            elif event.get('type') == 'diagnostic':
+                messages.append('\n'.join([event['@message'],
+                                           event.get('diagnostic', {}).get('detail', '')]))
+            elif event.get('type') in ['change_summary', 'outputs']:
+                messages.append(event['@message'])
+
+        start = time.monotonic()
+        (proc, _, stderr) = cmd.run_with_output(
+            state,
+            {
+                'cmd': [
+                    self.tf_cmd,
+                    'plan',
+                    '-detailed-exitcode',
+                    '-json',
+                    '-refresh=false',
+                    '-out',
+                    '${TERRATEAM_PLAN_FILE}'
+                ] + config.get('extra_args', []),
+                'stdout_line_handler': _on_line,
+            })
 
-            if proc.returncode in [0, 2]:
-                for line in stdout.splitlines():
-                    line = json.loads(line)
-                    if line.get('type') in ['planned_change', 'resource_drift']:
-                        targets.append(line['change']['resource']['addr'])
-            else:
-                return (False, False, stdout, stderr)
+        logging.info('PLAN : FAST_AND_LOOSE : %s : phase=scan : targets=%d : time=%.2fs',
+                     state.path,
+                     len(targets),
+                     time.monotonic() - start)
+
+        if proc.returncode not in [0, 2]:
+            return (False, False, '\n'.join(messages), stderr)
+
+        if not targets:
+            logging.info('PLAN : FAST_AND_LOOSE : %s : SKIP_TARGETED_PLAN', state.path)
+            return (True, proc.returncode == 2, '\n'.join(messages), stderr)
+
+        max_targets = int(state.env.get('TERRATEAM_FAST_AND_LOOSE_MAX_TARGETS',
+                                        FAST_AND_LOOSE_MAX_TARGETS))
+        if len(targets) > max_targets:
+            logging.info('PLAN : FAST_AND_LOOSE : %s : TOO_MANY_TARGETS : %d > %d',
+                         state.path,
+                         len(targets),
+                         max_targets)
+            target_args = []
         else:
-            targets = []
+            target_args = ['-target=' + t for t in targets]
 
-        (proc, stdout, stderr) = cmd.run_with_output(
+        start = time.monotonic()
+        (proc, stdout, stderr) = output_budget.run_with_output(
             state,
             {
                 'cmd': [
@@ -284,9 +349,14 @@ class Engine:
                     '-detailed-exitcode',
                     '-out',
                     '${TERRATEAM_PLAN_FILE}'
-                ] + targets + config.get('extra_args', [])
+                ] + target_args + config.get('extra_args', [])
             })
 
+        logging.info('PLAN : FAST_AND_LOOSE : %s : phase=plan : targeted=%r : time=%.2fs',
+                     state.path,
+                     bool(target_args),
+                     time.monotonic() - start)
+
         return (proc.returncode in [0, 2], proc.returncode == 2, stdout, stderr)
 
     def unsafe_apply(self, state, config):
@@ -295,7 +365,7 @@ class Engine:
             state.path,
             state.workflow['engine']['name'])
 
-        (proc, stdout, stderr) = cmd.run_with_output(
+        (proc, stdout, stderr) = output_budget.run_with_output(
             state,
             {
                 'cmd': [self.tf_cmd, 'apply', '-auto-approve'
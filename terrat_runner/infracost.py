@@ -17,22 +17,33 @@ def convert_cost(cost):
         return 0.0
 
 
-def create_infracost_yml(outname, dirspaces):
+def project_name(dirspace):
+    return '{}:{}'.format(dirspace['path'], dirspace['workspace'])
+
+
+def create_infracost_yml(outname, dirspaces, named=False):
+    projects = []
+    for ds in dirspaces:
+        project = {
+            'path': ds['path'],
+            'terraform_workspace': ds['workspace'],
+            # Treat each dirspace as exactly one project. Without this,
+            # Infracost autodetect scans within every `path`, and a root
+            # dirspace (`path: .`) recursively re-discovers every nested
+            # module in a monorepo. Those collide with the explicit leaf
+            # entries -> "duplicate project name" -> `infracost diff` aborts.
+            'skip_autodetect': True,
+        }
+        # Projects are matched by name between two breakdowns, and the name
+        # Infracost makes up depends on where the repo is checked out, so
+        # breakdowns of different checkouts need explicit names.
+        if named:
+            project['name'] = project_name(ds)
+        projects.append(project)
+
     config = {
         'version': '0.1',
-        'projects': [
-            {
-                'path': ds['path'],
-                'terraform_workspace': ds['workspace'],
-                # Treat each dirspace as exactly one project. Without this,
-                # Infracost autodetect scans within every `path`, and a root
-                # dirspace (`path: .`) recursively re-discovers every nested
-                # module in a monorepo. Those collide with the explicit leaf
-                # entries -> "duplicate project name" -> `infracost diff` aborts.
-                'skip_autodetect': True,
-            }
-            for ds in dirspaces
-        ]
+        'projects': projects,
     }
 
     with open(outname, 'w') as f:
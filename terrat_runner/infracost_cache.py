@@ -0,0 +1,131 @@
+# Cache of Infracost breakdowns of the base branch.
+#
+# Pull requests against the same base commit price the same base dirspaces, so
+# the base breakdown only needs to be made once.  Breakdowns are kept by a key
+# made from everything the breakdown depends on, see
+# workflow_step_infracost_setup, in one or more stores:
+#
+# - A directory, TERRATEAM_INFRACOST_CACHE_DIR, which on self-hosted runners
+#   can persist between jobs.
+#
+# - The S3 bucket plans are stored in, if plans are stored in S3 and
+#   TERRATEAM_INFRACOST_CACHE_S3 is set, which is shared by every runner.
+#
+# Prices change, so a breakdown is only used for TERRATEAM_INFRACOST_CACHE_TTL
+# seconds after it was made.
+import datetime
+import json
+import logging
+import os
+import shutil
+import time
+
+import aws_client
+import repo_config as rc
+import workflow_step_plan
+
+
+TTL = 24 * 60 * 60
+S3_PREFIX = 'terrateam/infracost-cache/'
+
+
+class _DirStore:
+    name = 'dir'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get(self, key, path):
+        try:
+            shutil.copyfile(os.path.join(self.directory, key + '.json'), path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def put(self, key, path):
+        os.makedirs(self.directory, exist_ok=True)
+        dst = os.path.join(self.directory, key + '.json')
+        tmp = '{}.{}.tmp'.format(dst, os.getpid())
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, dst)
+
+
+class _S3Store:
+    name = 's3'
+
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+
+    def get(self, key, path):
+        if self.client.size(self.bucket, S3_PREFIX + key + '.json') is None:
+            return False
+        self.client.get_file(self.bucket, S3_PREFIX + key + '.json', path)
+        return True
+
+    def put(self, key, path):
+        self.client.put_file(self.bucket, S3_PREFIX + key + '.json', path)
+
+
+def _stores(state):
+    stores = []
+    env = state.env
+    if env.get('TERRATEAM_INFRACOST_CACHE_DIR'):
+        stores.append(_DirStore(env['TERRATEAM_INFRACOST_CACHE_DIR']))
+
+    if env.get('TERRATEAM_INFRACOST_CACHE_S3', '').lower() in ('1', 'true'):
+        plan_storage = rc.get_plan_storage(state.repo_config)
+        if plan_storage['method'] == 's3':
+            client = workflow_step_plan.s3_client(state, plan_storage)
+            if client is not None:
+                stores.append(_S3Store(client, plan_storage['bucket']))
+            else:
+                logging.info('INFRACOST_CACHE : S3 : NO_CLIENT')
+
+    return stores
+
+
+def enabled(state):
+    return bool(_stores(state))
+
+
+def _ttl(env):
+    return int(env.get('TERRATEAM_INFRACOST_CACHE_TTL', TTL))
+
+
+def _fresh(env, path):
+    try:
+        with open(path) as f:
+            generated = json.load(f)['timeGenerated']
+        generated_at = datetime.datetime.fromisoformat(generated.replace('Z', '+00:00')).timestamp()
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+    return time.time() - generated_at < _ttl(env)
+
+
+def get(state, key, path):
+    """Copy the breakdown for [key] to [path] if a store has a fresh one.
+    Returns [True] if one did."""
+    for store in _stores(state):
+        try:
+            if store.get(key, path):
+                if _fresh(state.env, path):
+                    logging.info('INFRACOST_CACHE : %s : HIT : %s', store.name, key)
+                    return True
+                logging.info('INFRACOST_CACHE : %s : STALE : %s', store.name, key)
+            else:
+                logging.info('INFRACOST_CACHE : %s : MISS : %s', store.name, key)
+        except (OSError, aws_client.Error) as exn:
+            logging.warning('INFRACOST_CACHE : %s : GET_FAILED : %s : %s', store.name, key, exn)
+
+    return False
+
+
+def put(state, key, path):
+    for store in _stores(state):
+        try:
+            store.put(key, path)
+            logging.info('INFRACOST_CACHE : %s : PUT : %s', store.name, key)
+        except (OSError, aws_client.Error) as exn:
+            logging.warning('INFRACOST_CACHE : %s : PUT_FAILED : %s : %s', store.name, key, exn)
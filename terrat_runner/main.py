@@ -4,9 +4,13 @@ import logging
 import os
 import re
 import subprocess
+import time
 
+import dir_exec
 import repo_config
+import requests_retry
 import run_state
+import tf_modules
 
 import work_apply
 import work_build_config
@@ -15,12 +19,22 @@ import work_exec
 import work_manifest
 import work_plan
 import work_unsafe_apply
+import workflow_step_infracost_setup
 
 from runtime.github_actions import runtime as github_actions
 from runtime.gitlab_ci import runtime as gitlab_ci
 
 DEFAULT_API_BASE_URL = 'https://app.terrateam.io'
 
+MERGE_STRATEGY_DEEPEN = 'deepen'
+MERGE_STRATEGY_PARTIAL = 'partial'
+
+# Always part of a sparse checkout, as the runner reads its configuration from
+# there.
+SPARSE_CHECKOUT_ALWAYS = ['.terrateam']
+# Most rounds of adding module dependencies to the sparse checkout.
+SPARSE_CHECKOUT_MAX_ROUNDS = 10
+
 
 def set_env_context(env, context):
     try:
@@ -71,7 +85,98 @@ def install_ca_bundles():
         os.environ['REQUESTS_CA_BUNDLE'] = '/etc/ssl/certs/ca-certificates.crt'
 
 
-def perform_merge(working_dir, base_ref):
+def _git(working_dir, args):
+    logging.info('%r', ['git'] + args)
+    return subprocess.check_output(['git'] + args,
+                                   cwd=working_dir,
+                                   stderr=subprocess.STDOUT).decode('utf-8')
+
+
+def _sparse_checkout(working_dir, paths):
+    # A module directory only appears once the directory using it is checked
+    # out, so keep adding the dependencies found until there are no new ones.
+    current = None
+    for _ in range(SPARSE_CHECKOUT_MAX_ROUNDS):
+        wanted = tf_modules.closure(working_dir, SPARSE_CHECKOUT_ALWAYS + paths)
+        if wanted == current:
+            break
+        _git(working_dir, ['sparse-checkout', 'set', '--cone'] + wanted)
+        current = wanted
+
+    logging.info('MERGE : SPARSE_CHECKOUT : paths=%d', len(current))
+
+
+def _disable_sparse_checkout(working_dir):
+    # The runner can run several work manifests in the same checkout, so one
+    # that wants the whole repo must undo the sparse checkout of an earlier
+    # one.
+    ret = subprocess.run(['git', 'config', '--get', 'core.sparseCheckout'],
+                         cwd=working_dir,
+                         capture_output=True)
+    if ret.stdout.decode('utf-8').strip().lower() == 'true':
+        logging.info('MERGE : SPARSE_CHECKOUT : DISABLE')
+        _git(working_dir, ['sparse-checkout', 'disable'])
+
+
+def _perform_merge_partial(working_dir, base_ref, sparse_paths):
+    # Fetch the whole history of the base branch, and of HEAD if the checkout
+    # is shallow, but without any file contents, which are fetched when the
+    # merge needs them.  The merge base is then always there, so there is no
+    # deepening one round trip at a time.
+    phases = []
+
+    def _phase(name, f):
+        start = time.monotonic()
+        try:
+            return f()
+        finally:
+            phases.append((name, time.monotonic() - start))
+
+    try:
+        _git(working_dir, ['config', 'remote.origin.promisor', 'true'])
+        _git(working_dir, ['config', 'remote.origin.partialclonefilter', 'blob:none'])
+
+        shallow = _git(working_dir, ['rev-parse', '--is-shallow-repository']).strip() == 'true'
+        fetch = (['fetch', '--filter=blob:none'] +
+                 (['--unshallow'] if shallow else []) +
+                 ['origin', base_ref + ':refs/remotes/origin/' + base_ref])
+        try:
+            _phase('fetch', lambda: _git(working_dir, fetch))
+        except subprocess.CalledProcessError as exn:
+            output = exn.output.decode('utf-8')
+            logging.info('%s', output)
+            # See [_perform_merge_deepen].
+            if 'rejected' in output and 'non-fast-forward' in output:
+                return
+            else:
+                raise
+
+        try:
+            merge_base = _phase('merge_base',
+                                lambda: _git(working_dir,
+                                             ['merge-base', 'HEAD', 'origin/' + base_ref]).strip())
+        except subprocess.CalledProcessError as exn:
+            logging.info('%s', exn.output.decode('utf-8'))
+            raise Exception('Could not merge destination branch')
+
+        logging.info('MERGE : MERGE_BASE : %s', merge_base)
+
+        if sparse_paths:
+            _phase('sparse_checkout', lambda: _sparse_checkout(working_dir, sparse_paths))
+
+        print(_phase('merge',
+                     lambda: _git(working_dir, ['merge', '--no-edit', 'origin/' + base_ref])))
+
+        if sparse_paths:
+            # The merge can add module dependencies.
+            _phase('sparse_checkout_merged', lambda: _sparse_checkout(working_dir, sparse_paths))
+    finally:
+        logging.info('MERGE : STRATEGY=%s : %s',
+                     MERGE_STRATEGY_PARTIAL,
+                     ' : '.join('{}={:.2f}s'.format(name, t) for (name, t) in phases))
+
+
+def _perform_merge_deepen(working_dir, base_ref):
     current_commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
                                              cwd=working_dir).decode('utf-8').strip()
     logging.debug('current commit=%s : fetching base ref', current_commit)
@@ -116,6 +221,47 @@ def perform_merge(working_dir, base_ref):
     raise Exception('Could not merge destination branch')
 
 
+def perform_merge(working_dir, base_ref, strategy=MERGE_STRATEGY_DEEPEN, sparse_paths=None):
+    """Merge [base_ref] into HEAD.
+
+    The [MERGE_STRATEGY_DEEPEN] strategy fetches the tip of the base branch
+    and then deepens the history until the merge base is found.  The
+    [MERGE_STRATEGY_PARTIAL] strategy fetches the history without file
+    contents in one go, and can limit the checkout to [sparse_paths], and the
+    local modules they use.
+
+    """
+    if not sparse_paths:
+        _disable_sparse_checkout(working_dir)
+
+    if strategy == MERGE_STRATEGY_PARTIAL:
+        _perform_merge_partial(working_dir, base_ref, sparse_paths)
+    else:
+        _perform_merge_deepen(working_dir, base_ref)
+
+
+def _merge(state, sparse=False):
+    env = state.env
+    strategy = env.get('TERRATEAM_MERGE_STRATEGY', MERGE_STRATEGY_DEEPEN).lower()
+    sparse_paths = None
+    if (sparse
+            and strategy == MERGE_STRATEGY_PARTIAL
+            and env.get('TERRATEAM_MERGE_SPARSE_CHECKOUT', '').lower() in ('1', 'true')):
+        paths = [d['path'] for d in state.work_manifest['changed_dirspaces']]
+        if '.' in paths or '' in paths:
+            logging.info('MERGE : SPARSE_CHECKOUT : SKIPPED : root dir changed')
+        elif (state.work_manifest['type'] == 'plan'
+              and repo_config.get_cost_estimation(state.repo_config)['enabled']
+              and not workflow_step_infracost_setup.plan_json_enabled(env)):
+            # Cost estimation prices every dir of the repo, unless it prices
+            # the plans.
+            logging.info('MERGE : SPARSE_CHECKOUT : SKIPPED : cost estimation enabled')
+        else:
+            sparse_paths = paths
+
+    perform_merge(state.working_dir, state.work_manifest['base_ref'], strategy, sparse_paths)
+
+
 def maybe_setup_cdktf(rc, work_manifest, env):
     # Determine if any engine uses cdktf and only install it if it is required.
     cdktf_used = False
@@ -130,12 +276,12 @@ def maybe_setup_cdktf(rc, work_manifest, env):
 
 
 def tf_operation(state, op):
-    perform_merge(state.working_dir, state.work_manifest['base_ref'])
+    _merge(state, sparse=True)
     maybe_setup_cdktf(state.repo_config, state.work_manifest, state.env)
     work_exec.run(state, op)
 
 def ensure_merged(state, f):
-    perform_merge(state.working_dir, state.work_manifest['base_ref'])
+    _merge(state)
     f(state)
 
 
@@ -384,12 +530,16 @@ def main():
 
     env = os.environ.copy()
 
-    while not done:
-        done = run(args, env)
-        run_count += 1
-        if run_count > 10:
-            print('*** Performed too many work manifests, exiting to prevent unexpected loop')
-            break
+    try:
+        while not done:
+            done = run(args, env)
+            run_count += 1
+            if run_count > 10:
+                print('*** Performed too many work manifests, exiting to prevent unexpected loop')
+                break
+    finally:
+        dir_exec.shutdown()
+        requests_retry.log_stats()
 
     # This means we only did one run, which is that we got the "done" work
     # manifest.
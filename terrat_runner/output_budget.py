@@ -0,0 +1,195 @@
+# Limit how much step output is sent to the API.
+#
+# One noisy dirspace can make the results of a run tens of megabytes.  Outputs
+# larger than their budget keep their head and tail with a marker in between
+# saying how many bytes were dropped.
+#
+# Output of the commands that can print the most (plan, apply and run steps) is
+# already cut to about the step budget as it is read from the command's
+# captured output, see [run_with_output], so it is never held in memory whole.
+# The full output is not kept anywhere: TERRATEAM_RESULTS_FILE, and so the post
+# hooks, only see the cut output.
+import logging
+import re
+
+import cmd
+
+
+# Budgets are in bytes, 0 disables a budget.
+STEP_BUDGET_BYTES = 2 * 1024 * 1024
+RUN_BUDGET_BYTES = 16 * 1024 * 1024
+
+# Payload fields that hold command output.
+FIELDS = ['text', 'plan', 'stderr']
+
+MARKER = '\n\n... [truncated {} bytes] ...\n\n'
+_MARKER_RE = re.compile(r'\n\n\.\.\. \[truncated (\d+) bytes\] \.\.\.\n\n')
+
+# Output cut when it is read keeps this much more than the step budget on each
+# side of the cut, so that [apply] can later mask the text around its own cut.
+READ_MARGIN_BYTES = 64 * 1024
+
+
+def _budget(env, name, default):
+    return int(env.get(name, default))
+
+
+def _size(s):
+    if s.isascii():
+        return len(s)
+    else:
+        return len(s.encode('utf-8'))
+
+
+def _fill(sizes, budget):
+    """Return a limit for each of [sizes] such that the limits add up to at most
+    [budget].  Every entry gets an equal share, and what an entry smaller than
+    its share does not use is shared among the larger ones."""
+    limits = [0] * len(sizes)
+    remaining = budget
+    order = sorted(range(len(sizes)), key=lambda idx: sizes[idx])
+    for n, idx in enumerate(order):
+        limits[idx] = min(sizes[idx], remaining // (len(order) - n))
+        remaining -= limits[idx]
+    return limits
+
+
+def run_budget(env):
+    return _budget(env, 'TERRATEAM_OUTPUT_RUN_BUDGET_BYTES', RUN_BUDGET_BYTES)
+
+
+def size(results):
+    """Return the number of bytes of output in the steps of [results]."""
+    return sum(_size(step['payload'][f])
+               for step in results['steps']
+               for f in FIELDS
+               if isinstance(step.get('payload', {}).get(f), str))
+
+
+def truncate(s, limit, masker=None):
+    """Keep the first and last [limit] / 2 bytes of [s].  Returns the string and
+    the number of bytes dropped.
+
+    If [masker] is given, the secrets it finds around each cut are masked, and
+    a cut that falls inside a secret is moved out of it so no part of the
+    secret is kept.
+
+    """
+    b = s.encode('utf-8')
+    if len(b) <= limit:
+        return (s, 0)
+
+    head_bytes = limit // 2
+    tail_bytes = limit - head_bytes
+
+    dropped = len(b) - head_bytes - tail_bytes
+
+    head_len = len(b[:head_bytes].decode('utf-8', errors='ignore'))
+    tail_start = len(s) - len(b[len(b) - tail_bytes:].decode('utf-8', errors='ignore'))
+
+    if masker is not None:
+        # Secrets are found in the text around each cut, with enough context
+        # on the other side of the cut for the longest secret.
+        window = max(map(len, masker.secrets), default=0)
+        head_spans = masker.spans(s[:head_len + window])
+        for (start, end) in head_spans:
+            if start < head_len < end:
+                dropped += len(s[start:head_len].encode('utf-8'))
+                head_len = start
+        head = masker.replace_spans(s[:head_len],
+                                    [(start, end) for (start, end) in head_spans
+                                     if end <= head_len])
+
+        offset = max(0, tail_start - window)
+        tail_spans = [(start + offset, end + offset)
+                      for (start, end) in masker.spans(s[offset:])]
+        for (start, end) in tail_spans:
+            if start < tail_start < end:
+                dropped += len(s[tail_start:end].encode('utf-8'))
+                tail_start = end
+        tail = masker.replace_spans(s[tail_start:],
+                                    [(start - tail_start, end - tail_start)
+                                     for (start, end) in tail_spans
+                                     if start >= tail_start])
+    else:
+        head = s[:head_len]
+        tail = s[tail_start:]
+
+    # Output that was already cut when it was read has a marker in the middle,
+    # count what it dropped too.
+    for m in _MARKER_RE.finditer(s, head_len, tail_start):
+        dropped += int(m.group(1)) - len(m.group(0).encode('utf-8'))
+
+    return (head + MARKER.format(dropped) + tail, dropped)
+
+
+def read(env, output):
+    """Return the text of the [cmd.Output] [output], cut in the middle if it is
+    larger than the step budget.  Only the part that is kept is read."""
+    step_budget = _budget(env, 'TERRATEAM_OUTPUT_STEP_BUDGET_BYTES', STEP_BUDGET_BYTES)
+    if not step_budget or len(output) <= step_budget + 2 * READ_MARGIN_BYTES:
+        return output.read()
+
+    head_bytes = step_budget // 2 + READ_MARGIN_BYTES
+    tail_bytes = step_budget - step_budget // 2 + READ_MARGIN_BYTES
+    dropped = len(output) - head_bytes - tail_bytes
+    logging.info('OUTPUT_BUDGET : READ : size=%d : dropped=%d', len(output), dropped)
+    return output.head(head_bytes) + MARKER.format(dropped) + output.tail(tail_bytes)
+
+
+def run_with_output(state, config):
+    """Same as [cmd.run_with_output] but the output is cut with [read]."""
+    (proc, stdout, stderr) = cmd.run_with_capture(state, config)
+    try:
+        return (proc, read(state.env, stdout), read(state.env, stderr))
+    finally:
+        stdout.close()
+        stderr.close()
+
+
+def apply(env, results, masker=None):
+    """Return [results] with the output of its steps truncated to fit the
+    per-step and per-run budgets.  [masker] is passed to [truncate]."""
+    step_budget = _budget(env, 'TERRATEAM_OUTPUT_STEP_BUDGET_BYTES', STEP_BUDGET_BYTES)
+    budget = run_budget(env)
+
+    if not step_budget and not budget:
+        return results
+
+    # (step index, field, size, limit)
+    entries = []
+    for idx, step in enumerate(results['steps']):
+        fields = [(f, _size(step['payload'][f]))
+                  for f in FIELDS
+                  if isinstance(step.get('payload', {}).get(f), str)]
+        sizes = [size for (_, size) in fields]
+        if step_budget and sum(sizes) > step_budget:
+            limits = _fill(sizes, step_budget)
+        else:
+            limits = sizes
+        entries.extend((idx, f, size, limit) for ((f, size), limit) in zip(fields, limits))
+
+    if budget and sum(limit for (_, _, _, limit) in entries) > budget:
+        limits = _fill([limit for (_, _, _, limit) in entries], budget)
+        entries = [(idx, f, size, limit)
+                   for ((idx, f, size, _), limit) in zip(entries, limits)]
+
+    steps = list(results['steps'])
+    total = 0
+    for (idx, f, size, limit) in entries:
+        if limit < size:
+            if steps[idx] is results['steps'][idx]:
+                steps[idx] = dict(steps[idx], payload=steps[idx]['payload'].copy())
+            payload = steps[idx]['payload']
+            (payload[f], dropped) = truncate(payload[f], limit, masker)
+            total += dropped
+            logging.info('OUTPUT_BUDGET : TRUNCATED : step=%s : field=%s : size=%d : dropped=%d',
+                         steps[idx].get('step'),
+                         f,
+                         size,
+                         dropped)
+
+    if total:
+        logging.info('OUTPUT_BUDGET : TOTAL_DROPPED : %d', total)
+
+    return dict(results, steps=steps)
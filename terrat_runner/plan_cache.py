@@ -0,0 +1,121 @@
+# Plans stored on this machine, keyed by the sha256 of their contents.
+#
+# A plan is put in the cache when it is stored, and when it is fetched for an
+# apply.  An apply whose plan is already in the cache, because it was made on
+# this machine or another dirspace had the same plan, does not fetch it again.
+#
+# The cache is only used if TERRATEAM_PLAN_CACHE_DIR is set, which on
+# self-hosted runners can point at a directory that persists between jobs.
+# Entries are checked against their digest when they are used, and a damaged
+# one is removed.  When the cache grows past TERRATEAM_PLAN_CACHE_MAX_MB, the
+# least recently used plans are removed.
+import hashlib
+import logging
+import os
+import shutil
+
+
+ENV_NAME = 'TERRATEAM_PLAN_CACHE_DIR'
+MAX_MB_ENV_NAME = 'TERRATEAM_PLAN_CACHE_MAX_MB'
+DEFAULT_MAX_MB = 2048
+CHUNK_SIZE = 1024 * 1024
+
+
+def cache_dir(env):
+    return env.get(ENV_NAME)
+
+
+def digest(path):
+    """Return the sha256 of the file at [path]."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _path(directory, sha256):
+    return os.path.join(directory, sha256)
+
+
+def _entries(directory):
+    entries = []
+    for name in os.listdir(directory):
+        if name.endswith('.tmp'):
+            continue
+        try:
+            st = os.stat(_path(directory, name))
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, name))
+    return entries
+
+
+def _evict(env, directory):
+    # An entry's mtime is updated every time it is used, so the oldest one is
+    # the least recently used.
+    max_bytes = int(env.get(MAX_MB_ENV_NAME, DEFAULT_MAX_MB)) * 1024 * 1024
+    entries = sorted(_entries(directory))
+    total = sum(size for (_mtime, size, _name) in entries)
+    for (_mtime, size, name) in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(_path(directory, name))
+            logging.info('PLAN_CACHE : EVICT : %s', name)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def put(env, sha256, path):
+    directory = cache_dir(env)
+    if not directory:
+        return
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        dst = _path(directory, sha256)
+        if os.path.exists(dst):
+            os.utime(dst)
+        else:
+            tmp = '{}.{}.tmp'.format(dst, os.getpid())
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, dst)
+        _evict(env, directory)
+    except OSError as exn:
+        logging.warning('PLAN_CACHE : PUT_FAILED : %s : %s', sha256, exn)
+
+
+def get(env, sha256, path):
+    """Copy the plan with digest [sha256] to [path] if it is in the cache.
+    Returns [True] if it was."""
+    directory = cache_dir(env)
+    if not directory:
+        return False
+
+    src = _path(directory, sha256)
+    try:
+        shutil.copyfile(src, path)
+    except FileNotFoundError:
+        logging.info('PLAN_CACHE : MISS : %s', sha256)
+        return False
+    except OSError as exn:
+        logging.warning('PLAN_CACHE : GET_FAILED : %s : %s', sha256, exn)
+        return False
+
+    if digest(path) != sha256:
+        logging.warning('PLAN_CACHE : CORRUPT : %s', sha256)
+        try:
+            os.unlink(src)
+        except OSError:
+            pass
+        return False
+
+    try:
+        os.utime(src)
+    except OSError:
+        pass
+
+    logging.info('PLAN_CACHE : HIT : %s', sha256)
+    return True
@@ -0,0 +1,134 @@
+# Encoding of plans stored with the terrateam plan storage method.
+#
+# The first version wrapped the base64 of the plan in a JSON object, which was
+# then base64 encoded again to send it, so a plan grew by almost double and was
+# held in memory several times over.  Version 2 is a short header followed by
+# the compressed plan, and is only base64 encoded once, to send it:
+#
+#   TERRATEAM_PLAN\n{"version": 2, "compression": "gzip", "size": 1234}\n<data>
+#
+# Plans are compressed with zstd if the zstandard module is installed and with
+# gzip otherwise, reading and writing the plan file in chunks.
+# TERRATEAM_PLAN_COMPRESSION can choose one, or none.
+import hashlib
+import io
+import json
+import logging
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = b'TERRATEAM_PLAN\n'
+VERSION = 2
+CHUNK_SIZE = 1024 * 1024
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+_DECOMPRESS_ERRORS = (zlib.error,) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class Error(Exception):
+    pass
+
+
+class _Identity:
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+def compression(env):
+    """Return the compression to use for new plans."""
+    setting = env.get('TERRATEAM_PLAN_COMPRESSION', 'auto').lower()
+    if setting in ('auto', 'zstd') and zstandard is not None:
+        return 'zstd'
+    elif setting == 'zstd':
+        logging.warning('PLAN_CODEC : ZSTD_UNAVAILABLE : USING_GZIP')
+        return 'gzip'
+    elif setting == 'none':
+        return 'none'
+    else:
+        return 'gzip'
+
+
+def _compressor(name):
+    if name == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    elif name == 'gzip':
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        return _Identity()
+
+
+def _decompressor(name):
+    if name == 'zstd':
+        if zstandard is None:
+            raise Error('Plan is compressed with zstd but the zstandard module is not installed')
+        return zstandard.ZstdDecompressor().decompressobj()
+    elif name == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif name == 'none':
+        return _Identity()
+    else:
+        raise Error('Unknown plan compression: {}'.format(name))
+
+
+def encode(path, name):
+    """Encode the plan at [path] with compression [name].  Returns the encoded
+    plan and the md5 of the plan."""
+    compressor = _compressor(name)
+    md5 = hashlib.md5(usedforsecurity=False)
+    size = 0
+    buf = io.BytesIO()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+            size += len(chunk)
+            buf.write(compressor.compress(chunk))
+    buf.write(compressor.flush())
+
+    header = json.dumps({'version': VERSION, 'compression': name, 'size': size}).encode('utf-8')
+    return (b''.join([MAGIC, header, b'\n', buf.getbuffer()]), md5.hexdigest())
+
+
+def is_encoded(data):
+    return data.startswith(MAGIC)
+
+
+def decode_to_file(data, path):
+    """Decode the encoded plan [data] into [path].  Returns the md5 of the
+    plan."""
+    end = data.index(b'\n', len(MAGIC))
+    try:
+        header = json.loads(data[len(MAGIC):end])
+    except json.JSONDecodeError as exn:
+        raise Error('Invalid plan header: {}'.format(exn))
+
+    decompressor = _decompressor(header['compression'])
+    md5 = hashlib.md5(usedforsecurity=False)
+    size = 0
+    body = memoryview(data)[end + 1:]
+    try:
+        with open(path, 'wb') as f:
+            for offset in range(0, len(body), CHUNK_SIZE):
+                chunk = decompressor.decompress(body[offset:offset + CHUNK_SIZE])
+                md5.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+    except _DECOMPRESS_ERRORS as exn:
+        raise Error('Invalid plan data: {}'.format(exn))
+
+    if size != header['size']:
+        raise Error('Plan is {} bytes but should be {}'.format(size, header['size']))
+
+    return md5.hexdigest()
@@ -0,0 +1,79 @@
+# Render a plan file with `show` at most once per format.
+#
+# The text diff and several policy steps (OPA, Conftest, Checkov, Resourcely)
+# all need the rendering of the same plan file, and `show -json` of a large plan
+# can take tens of seconds.  Renderings are stored in the dirspace's tmpdir,
+# keyed by the hash of the plan file, and handed back as a path so tools that
+# take a file can use it directly.
+import hashlib
+import logging
+import os
+
+import cmd
+
+
+CHUNK_SIZE = 1024 * 1024
+
+JSON = 'json'
+TEXT = 'txt'
+
+
+def _digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _render(state, kind, show_cmd, log_output):
+    plan_file = state.env['TERRATEAM_PLAN_FILE']
+    cache_dir = os.path.join(state.env.get('TERRATEAM_TMPDIR', state.tmpdir), 'plan-render')
+
+    if not os.path.exists(plan_file):
+        logging.info('PLAN_RENDER : %s : MISSING : %s', state.path, plan_file)
+        return (False, None, 'Plan file {} does not exist'.format(plan_file))
+
+    path = os.path.join(cache_dir, '{}.{}'.format(_digest(plan_file), kind))
+
+    if os.path.exists(path):
+        logging.info('PLAN_RENDER : %s : HIT : %s', state.path, kind)
+        return (True, path, None)
+
+    logging.info('PLAN_RENDER : %s : MISS : %s', state.path, kind)
+    (proc, stdout, stderr) = cmd.run_with_output(
+        state,
+        {
+            'cmd': show_cmd,
+            'log_output': log_output,
+        })
+
+    if proc.returncode != 0:
+        return (False, None, '\n'.join([stderr, stdout]))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(stdout)
+    os.replace(tmp_path, path)
+
+    return (True, path, None)
+
+
+def show_json(state, tf_cmd='${TERRATEAM_TF_CMD}'):
+    """Return (success, path, error) where [path] is a file with the output of
+    `show -json` of the plan file, and [error] is the output of the command if
+    it failed, or says that the plan file does not exist.
+
+    """
+    return _render(state, JSON, [tf_cmd, 'show', '-json', '${TERRATEAM_PLAN_FILE}'], False)
+
+
+def show_text(state, tf_cmd='${TERRATEAM_TF_CMD}'):
+    """Same as [show_json] but for the human readable rendering."""
+    return _render(state, TEXT, [tf_cmd, 'show', '${TERRATEAM_PLAN_FILE}'], True)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
@@ -0,0 +1,187 @@
+# Manage a provider plugin cache (TF_PLUGIN_CACHE_DIR) shared by every dirspace
+# in a run.
+#
+# Terraform does not support concurrent writes to the plugin cache, which is
+# why all inits used to be serialized behind a global lock.  Instead, before
+# any dirspace runs, every provider named in the lock files of the changed
+# dirspaces is installed into the cache in a single pass.  After that, an init
+# of a dir whose lock file is fully present in the cache only ever reads from
+# the cache and does not need the lock.
+import logging
+import os
+import platform
+import re
+import shutil
+
+import cmd
+import repo_config as rc
+
+
+LOCK_FILE = '.terraform.lock.hcl'
+
+# Dirs that do not have their providers pre-resolved still take this lock
+# around init because they may write to the cache.
+INIT_LOCK = '/tmp/tf-init.lock'
+
+# Engines whose init installs providers from a lock file in the dir.
+ENGINES = ['terraform', 'tofu', 'terragrunt']
+
+_PROVIDER = re.compile(r'provider\s+"([^"]+)"\s*\{[^}]*?\bversion\s*=\s*"([^"]+)"', re.DOTALL)
+
+
+def cache_dir(env):
+    return env.get('TERRATEAM_PLUGIN_CACHE_DIR')
+
+
+def current_platform():
+    arch = platform.machine()
+    arch = {'x86_64': 'amd64', 'aarch64': 'arm64'}.get(arch, arch)
+    return '{}_{}'.format(platform.system().lower(), arch)
+
+
+def read_lock_file(path):
+    """Return a list of (source, version) for every provider in a lock file."""
+    with open(path) as f:
+        return _PROVIDER.findall(f.read())
+
+
+def changed_lock_files(state):
+    """Yield (dirspace, engine, lock file) for every changed dirspace whose
+    engine installs providers from a lock file.  The lock file is None if the
+    dir does not have one."""
+    for d in state.work_manifest['changed_dirspaces']:
+        engine = rc.get_dirspace_workflow(state.repo_config, d)['engine']
+        if engine['name'] in ENGINES:
+            lock_file = os.path.join(state.working_dir, d['path'], LOCK_FILE)
+            yield (d, engine, lock_file if os.path.exists(lock_file) else None)
+
+
+def _cached(cache, provider):
+    (source, version) = provider
+    return os.path.isdir(os.path.join(cache, *source.split('/'), version, current_platform()))
+
+
+def is_resolved(state):
+    """Return True if every provider in the lock file of the dir being run is
+    already in the plugin cache, which means init will not write to it."""
+    cache = cache_dir(state.env)
+    lock_file = os.path.join(state.working_dir, LOCK_FILE)
+    if not cache or not os.path.exists(lock_file):
+        return False
+
+    providers = read_lock_file(lock_file)
+    return bool(providers) and all(_cached(cache, p) for p in providers)
+
+
+def _passes(providers):
+    # A configuration can only require one version of a provider, so split the
+    # providers into passes where each source appears at most once.
+    passes = []
+    for (source, version) in sorted(providers):
+        for p in passes:
+            if source not in p:
+                p[source] = version
+                break
+        else:
+            passes.append({source: version})
+
+    return passes
+
+
+def _required_providers_tf(providers):
+    names = set()
+    lines = ['terraform {', '  required_providers {']
+    for source, version in sorted(providers.items()):
+        name = source.split('/')[-1]
+        suffix = 1
+        while name in names:
+            name = '{}{}'.format(source.split('/')[-1], suffix)
+            suffix += 1
+        names.add(name)
+        lines.extend([
+            '    {} = {{'.format(name),
+            '      source  = "{}"'.format(source),
+            '      version = "{}"'.format(version),
+            '    }',
+        ])
+    lines.extend(['  }', '}', ''])
+    return '\n'.join(lines)
+
+
+def _resolve(state, env, idx, providers):
+    scratch = os.path.join(state.tmpdir, 'plugin-cache', str(idx))
+    os.makedirs(scratch, exist_ok=True)
+
+    with open(os.path.join(scratch, 'main.tf'), 'w') as f:
+        f.write(_required_providers_tf(providers))
+
+    env = env.copy()
+    env['TF_DATA_DIR'] = os.path.join(scratch, '.terraform')
+
+    try:
+        (proc, stdout, stderr) = cmd.run_with_output(
+            state._replace(working_dir=scratch, env=env),
+            {
+                'cmd': ['${TERRATEAM_TF_CMD}', 'init', '-backend=false', '-input=false'],
+                'log_output': False,
+            })
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if proc.returncode != 0:
+        logging.warning('PLUGIN_CACHE : RESOLVE : FAILED : %s', '\n'.join([stderr, stdout]))
+
+
+def prepare(state, set_engine_env):
+    """Install every provider from the lock files of the changed dirspaces into
+    the plugin cache.  [set_engine_env] configures the environment for an
+    engine, so the right binary and version does the install.
+
+    """
+    cache = cache_dir(state.env)
+    if not cache:
+        return
+
+    os.makedirs(cache, exist_ok=True)
+
+    # Map the command that will install the providers to the providers it needs
+    # and the environment to run it in.
+    by_tf_cmd = {}
+    hits = set()
+    misses = set()
+    no_lock_file = 0
+    for (d, engine, lock_file) in changed_lock_files(state):
+        if lock_file is None:
+            no_lock_file += 1
+            continue
+
+        env = state.env.copy()
+        set_engine_env(env,
+                       state.repo_config,
+                       engine,
+                       state.working_dir,
+                       os.path.join(state.working_dir, d['path']))
+
+        for p in read_lock_file(lock_file):
+            if _cached(cache, p):
+                hits.add(p)
+            elif p not in misses:
+                misses.add(p)
+                by_tf_cmd.setdefault(env['TERRATEAM_TF_CMD'], (env, set()))[1].add(p)
+
+    logging.info('PLUGIN_CACHE : %s : hits=%d : misses=%d : no_lock_file=%d',
+                 cache,
+                 len(hits),
+                 len(misses),
+                 no_lock_file)
+
+    idx = 0
+    for tf_cmd, (env, providers) in by_tf_cmd.items():
+        for sources in _passes(providers):
+            logging.info('PLUGIN_CACHE : RESOLVE : %s : %r', tf_cmd, sources)
+            _resolve(state, env, idx, sources)
+            idx += 1
+
+    if misses:
+        resolved = [p for p in misses if _cached(cache, p)]
+        logging.info('PLUGIN_CACHE : RESOLVED : %d/%d', len(resolved), len(misses))
@@ -0,0 +1,211 @@
+# Pre-warm a local filesystem mirror with every provider package named in the
+# lock files of the changed dirspaces, and point every init at it with a
+# generated CLI configuration.
+#
+# Each dirspace's init otherwise downloads its providers from the registry on
+# its own.  The mirror downloads each (provider, version, platform) once, with a
+# bounded number of downloads at a time.  The generated configuration keeps the
+# "direct" installation method for everything, so a provider or version that is
+# not in the mirror, for example in a dir without a lock file, is still
+# installed from the registry as before.
+import concurrent.futures
+import hashlib
+import logging
+import os
+import time
+import urllib.parse
+
+import plugin_cache
+import requests_retry
+
+
+DEFAULT_CONCURRENCY = 4
+CHUNK_SIZE = 1024 * 1024
+
+
+def enabled(env):
+    return env.get('TERRATEAM_PROVIDER_MIRROR', '').lower() in ('1', 'true')
+
+
+def _package_path(mirror, source, version, target):
+    # The "packed" layout of a filesystem mirror.
+    (hostname, namespace, type_) = source.split('/')
+    return os.path.join(mirror,
+                        hostname,
+                        namespace,
+                        type_,
+                        'terraform-provider-{}_{}_{}.zip'.format(type_, version, target))
+
+
+def _registry_headers(env, hostname):
+    # Same convention Terraform uses for registry credentials in the
+    # environment.
+    token = env.get('TF_TOKEN_' + hostname.replace('.', '_').replace('-', '__'))
+    if token:
+        return {'authorization': 'bearer ' + token}
+    else:
+        return {}
+
+
+def _providers_url(env, hostname, discovered):
+    if hostname not in discovered:
+        res = requests_retry.get('https://{}/.well-known/terraform.json'.format(hostname),
+                                 headers=_registry_headers(env, hostname))
+        res.raise_for_status()
+        discovered[hostname] = urllib.parse.urljoin('https://{}/'.format(hostname),
+                                                    res.json()['providers.v1'])
+
+    return discovered[hostname]
+
+
+def _download(env, mirror, source, version, target, providers_url):
+    (hostname, namespace, type_) = source.split('/')
+    (os_, arch) = target.split('_', 1)
+    headers = _registry_headers(env, hostname)
+
+    start = time.monotonic()
+    res = requests_retry.get(
+        '{}{}/{}/{}/download/{}/{}'.format(providers_url, namespace, type_, version, os_, arch),
+        headers=headers)
+    res.raise_for_status()
+    package = res.json()
+
+    path = _package_path(mirror, source, version, target)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+    sha256 = hashlib.sha256()
+    res = requests_retry.get(package['download_url'], stream=True)
+    res.raise_for_status()
+    with open(tmp_path, 'wb') as f:
+        for chunk in res.iter_content(CHUNK_SIZE):
+            sha256.update(chunk)
+            f.write(chunk)
+
+    if sha256.hexdigest() != package['shasum']:
+        os.remove(tmp_path)
+        raise Exception('Checksum mismatch for {} {}: expected {} got {}'.format(
+            source,
+            version,
+            package['shasum'],
+            sha256.hexdigest()))
+
+    os.replace(tmp_path, path)
+    return time.monotonic() - start
+
+
+def _existing_cli_config(env):
+    path = env.get('TF_CLI_CONFIG_FILE', os.path.expanduser('~/.terraformrc'))
+    if os.path.exists(path):
+        with open(path) as f:
+            return f.read()
+    else:
+        return ''
+
+
+def _cli_config(existing, mirror, sources):
+    return '\n'.join([
+        existing,
+        'provider_installation {',
+        '  filesystem_mirror {',
+        '    path    = "{}"'.format(mirror),
+        '    include = [{}]'.format(', '.join('"{}"'.format(s) for s in sorted(sources))),
+        '  }',
+        '  direct {}',
+        '}',
+        '',
+    ])
+
+
+def prepare(state):
+    """Fill the mirror and return the state with TF_CLI_CONFIG_FILE pointing at
+    a configuration that uses it.  The state is returned unchanged if the
+    mirror is not enabled or nothing could be mirrored.
+
+    """
+    if not enabled(state.env):
+        return state
+
+    mirror = state.env.get('TERRATEAM_PROVIDER_MIRROR_DIR',
+                           os.path.join(state.tmpdir, 'provider-mirror'))
+    concurrency = int(state.env.get('TERRATEAM_PROVIDER_MIRROR_CONCURRENCY', DEFAULT_CONCURRENCY))
+    target = plugin_cache.current_platform()
+
+    existing = _existing_cli_config(state.env)
+    if 'provider_installation' in existing:
+        logging.info('PROVIDER_MIRROR : SKIP : CLI configuration already has provider_installation')
+        return state
+
+    providers = set()
+    no_lock_file = 0
+    for (_d, _engine, lock_file) in plugin_cache.changed_lock_files(state):
+        if lock_file is None:
+            no_lock_file += 1
+        else:
+            providers.update(plugin_cache.read_lock_file(lock_file))
+
+    missing = [(source, version) for (source, version) in sorted(providers)
+               if not os.path.exists(_package_path(mirror, source, version, target))]
+
+    logging.info('PROVIDER_MIRROR : %s : providers=%d : missing=%d : no_lock_file=%d',
+                 mirror,
+                 len(providers),
+                 len(missing),
+                 no_lock_file)
+
+    failed = set()
+    start = time.monotonic()
+    discovered = {}
+    for source in set(source for (source, _version) in missing):
+        hostname = source.split('/')[0]
+        try:
+            _providers_url(state.env, hostname, discovered)
+        except Exception as exn:
+            logging.warning('PROVIDER_MIRROR : DISCOVERY : FAILED : %s : %s', hostname, exn)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {}
+        for (source, version) in missing:
+            hostname = source.split('/')[0]
+            if hostname in discovered:
+                futures[executor.submit(_download,
+                                        state.env,
+                                        mirror,
+                                        source,
+                                        version,
+                                        target,
+                                        discovered[hostname])] = (source, version)
+            else:
+                failed.add(source)
+
+        for future in concurrent.futures.as_completed(futures):
+            (source, version) = futures[future]
+            try:
+                logging.info('PROVIDER_MIRROR : DOWNLOAD : %s : %s : time=%.2fs',
+                             source,
+                             version,
+                             future.result())
+            except Exception as exn:
+                logging.warning('PROVIDER_MIRROR : DOWNLOAD : FAILED : %s : %s : %s',
+                                source,
+                                version,
+                                exn)
+                failed.add(source)
+
+    logging.info('PROVIDER_MIRROR : DONE : time=%.2fs : failed=%d',
+                 time.monotonic() - start,
+                 len(failed))
+
+    # Only send a provider to the mirror if every version of it that a lock
+    # file asks for is there.
+    sources = set(source for (source, _version) in providers) - failed
+    if not sources:
+        return state
+
+    cli_config = os.path.join(state.tmpdir, 'provider-mirror.tfrc')
+    with open(cli_config, 'w') as f:
+        f.write(_cli_config(existing, mirror, sources))
+
+    env = state.env.copy()
+    env['TF_CLI_CONFIG_FILE'] = cli_config
+    return state._replace(env=env)
@@ -0,0 +1,116 @@
+# Client-side rate limits on HTTP requests, per destination host, shared by
+# every process of the runner.
+#
+# Each host has a token bucket stored in a small file.  A request takes a token
+# while holding a lock on the file, letting the bucket go into debt if it is
+# empty, and then sleeps, outside the lock, until its token would have been
+# refilled.  Processes that ask at the same time are spread out at the
+# configured rate instead of all being let through at once.
+#
+# Limits are configured in TERRATEAM_RATE_LIMITS as a comma separated list of
+# host=rate or host=rate:burst, where rate is requests per second and burst is
+# the most requests allowed at once.  Hosts without a limit are not limited,
+# and nothing is limited by default.  Runners that share a GitHub token and hit
+# its secondary rate limits, 900 points a minute for REST requests, can set
+# api.github.com=15:30.
+import fcntl
+import logging
+import os
+import tempfile
+import time
+import urllib.parse
+
+
+DEFAULT_RATE_LIMITS = ''
+
+_WAITED = {'requests': 0, 'waited': 0.0}
+
+
+def _reset():
+    _WAITED['requests'] = 0
+    _WAITED['waited'] = 0.0
+
+
+os.register_at_fork(after_in_child=_reset)
+
+
+def parse(s):
+    """Parse a list of limits into a dict of host to (rate, burst)."""
+    limits = {}
+    for entry in s.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+
+        (host, limit) = entry.split('=', 1)
+        if ':' in limit:
+            (rate, burst) = limit.split(':', 1)
+        else:
+            (rate, burst) = (limit, limit)
+        limits[host.strip().lower()] = (float(rate), max(1.0, float(burst)))
+
+    return limits
+
+
+def _limits():
+    return parse(os.environ.get('TERRATEAM_RATE_LIMITS', DEFAULT_RATE_LIMITS))
+
+
+def _state_dir():
+    return os.environ.get('TERRATEAM_RATE_LIMIT_DIR',
+                          os.path.join(tempfile.gettempdir(), 'terrateam-rate-limit'))
+
+
+def _reserve(path, rate, burst, now):
+    # Take a token and return how long to wait until it is available.
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                (tokens, updated) = [float(v) for v in f.read().split()]
+            except ValueError:
+                (tokens, updated) = (burst, now)
+
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate) - 1
+
+            f.seek(0)
+            f.truncate()
+            f.write('{} {}'.format(tokens, now))
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+    if tokens >= 0:
+        return 0.0
+    else:
+        return -tokens / rate
+
+
+def acquire(url):
+    """Wait until a request to [url] is allowed.  Returns how many seconds were
+    waited."""
+    host = (urllib.parse.urlsplit(url).hostname or '').lower()
+    limit = _limits().get(host)
+    if limit is None:
+        return 0.0
+
+    (rate, burst) = limit
+    state_dir = _state_dir()
+    os.makedirs(state_dir, exist_ok=True)
+
+    wait = _reserve(os.path.join(state_dir, host), rate, burst, time.time())
+
+    _WAITED['requests'] += 1
+    if wait > 0:
+        logging.info('RATE_LIMIT : %s : waited=%.2fs', host, wait)
+        _WAITED['waited'] += wait
+        time.sleep(wait)
+
+    return wait
+
+
+def stats():
+    """Return the number of rate limited requests made by this process and how
+    long they waited in total."""
+    return dict(_WAITED)
@@ -169,6 +169,14 @@ def get_default_workflow(repo_config):
     }
 
 
+def get_dirspace_workflow(repo_config, dirspace):
+    """Return the workflow a dirspace from a work manifest runs with."""
+    if dirspace.get('workflow') is None:
+        return get_default_workflow(repo_config)
+    else:
+        return get_workflow(repo_config, dirspace['workflow'])
+
+
 def get_default_tf_version(repo_config):
     return repo_config.get('default_tf_version')
 
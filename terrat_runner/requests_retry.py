@@ -1,13 +1,116 @@
+import email.utils
 import logging
+import os
+import time
 
 import requests
+import requests.adapters
 
+import rate_limit
 import retry
 
 TIMEOUT = 120
 TRIES = 5
 INITIAL_SLEEP = 1
-BACKOFF = 1.5
+# No retry is started after this many seconds.  This bounds how long a server
+# asking us to wait, for example until a GitHub rate limit resets, can hold up
+# a run.
+DEADLINE = 300
+
+POLICY = retry.Policy('REQUESTS', TRIES, INITIAL_SLEEP, deadline=DEADLINE)
+
+# Number of hosts to keep connections to, and connections kept per host.
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+
+# Every request goes through one session per process, so connections are kept
+# alive and reused by all calls to the same host, including across the tasks a
+# dir_exec worker runs.  A forked child must not share the parent's
+# connections, so it starts with a new session, see [_reset].
+_SESSION = None
+_SESSION_PID = None
+
+# Counts of pools that have been discarded, see [stats].
+_CLOSED_STATS = {'requests': 0, 'connections': 0}
+
+
+def _pool_size(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _session():
+    global _SESSION, _SESSION_PID
+
+    if _SESSION is None or _SESSION_PID != os.getpid():
+        _SESSION = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=_pool_size('TERRATEAM_HTTP_POOL_CONNECTIONS', POOL_CONNECTIONS),
+            pool_maxsize=_pool_size('TERRATEAM_HTTP_POOL_MAXSIZE', POOL_MAXSIZE))
+        _SESSION.mount('https://', adapter)
+        _SESSION.mount('http://', adapter)
+        _SESSION_PID = os.getpid()
+
+    return _SESSION
+
+
+def _pools():
+    if _SESSION is None:
+        return []
+
+    pools = []
+    for adapter in set(_SESSION.adapters.values()):
+        pools.extend(adapter.poolmanager.pools[k] for k in adapter.poolmanager.pools.keys())
+    return pools
+
+
+def _reset():
+    # Only the parent may use or close the inherited connections, so drop them
+    # without closing.
+    global _SESSION, _SESSION_PID
+
+    _SESSION = None
+    _SESSION_PID = None
+    _CLOSED_STATS['requests'] = 0
+    _CLOSED_STATS['connections'] = 0
+
+
+os.register_at_fork(after_in_child=_reset)
+
+
+def stats():
+    """Return the number of requests made by this process, and the number of
+    connections opened for them.  Every other request reused a connection."""
+    ret = dict(_CLOSED_STATS)
+    for pool in _pools():
+        ret['requests'] += pool.num_requests
+        ret['connections'] += pool.num_connections
+    ret['reused'] = ret['requests'] - ret['connections']
+    return ret
+
+
+def log_stats():
+    s = stats()
+    limited = rate_limit.stats()
+    logging.info('REQUESTS : STATS : pid=%d : requests=%d : connections=%d : reused=%d : '
+                 'rate_limited=%d : rate_limit_wait=%.2fs',
+                 os.getpid(),
+                 s['requests'],
+                 s['connections'],
+                 s['reused'],
+                 limited['requests'],
+                 limited['waited'])
+
+
+def close():
+    global _SESSION, _SESSION_PID
+
+    if _SESSION is not None and _SESSION_PID == os.getpid():
+        s = stats()
+        _CLOSED_STATS['requests'] = s['requests']
+        _CLOSED_STATS['connections'] = s['connections']
+        _SESSION.close()
+    _SESSION = None
+    _SESSION_PID = None
 
 
 def _wrap_call(f):
@@ -17,20 +120,54 @@ def _wrap_call(f):
         return (False, exn)
 
 
+def _retry_after(v):
+    """Return how many seconds the response asks to wait before trying again,
+    from a Retry-After header or an exhausted GitHub rate limit, or [None]."""
+    success, ret = v
+    if not success:
+        return None
+
+    retry_after = ret.headers.get('retry-after')
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+
+    reset = ret.headers.get('x-ratelimit-reset')
+    if ret.headers.get('x-ratelimit-remaining') == '0' and reset is not None:
+        try:
+            return max(0.0, float(reset) - time.time())
+        except ValueError:
+            return None
+
+    return None
+
+
 def _test_success(v):
     success, ret = v
-    if not success or (ret.status_code >= 500 and ret.status_code < 600) or ret.status_code == 429:
+    if (not success
+        or (ret.status_code >= 500 and ret.status_code < 600)
+        or ret.status_code == 429
+        # GitHub answers an exhausted rate limit with a 403 and says when to
+        # try again.
+        or (ret.status_code == 403 and _retry_after(v) is not None)):
         logging.error('REQUESTS : FAILED : %r', ret)
         return False
 
     return True
 
 
-def _wrap(f):
-    (success, res) = retry.run(
-        lambda: _wrap_call(f),
-        retry.finite_tries(TRIES, _test_success),
-        retry.betwixt_sleep_with_backoff(INITIAL_SLEEP, BACKOFF))
+def _wrap(url, f):
+    # Every try, including retries, counts against the host's rate limit.
+    def _call():
+        rate_limit.acquire(url)
+        return f()
+
+    (success, res) = POLICY.run(lambda: _wrap_call(_call), _test_success, _retry_after)
 
     if not success:
         raise res
@@ -38,13 +175,21 @@ def _wrap(f):
     return res
 
 
-def post(*args, **kwargs):
-    return _wrap(lambda: requests.post(*args, timeout=TIMEOUT, **kwargs))
+def post(url, *args, **kwargs):
+    return _wrap(url, lambda: _session().post(url, *args, timeout=TIMEOUT, **kwargs))
+
+
+def put(url, *args, **kwargs):
+    return _wrap(url, lambda: _session().put(url, *args, timeout=TIMEOUT, **kwargs))
+
+
+def get(url, *args, **kwargs):
+    return _wrap(url, lambda: _session().get(url, *args, timeout=TIMEOUT, **kwargs))
 
 
-def put(*args, **kwargs):
-    return _wrap(lambda: requests.put(*args, timeout=TIMEOUT, **kwargs))
+def head(url, *args, **kwargs):
+    return _wrap(url, lambda: _session().head(url, *args, timeout=TIMEOUT, **kwargs))
 
 
-def get(*args, **kwargs):
-    return _wrap(lambda: requests.get(*args, timeout=TIMEOUT, **kwargs))
+def delete(url, *args, **kwargs):
+    return _wrap(url, lambda: _session().delete(url, *args, timeout=TIMEOUT, **kwargs))
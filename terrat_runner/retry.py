@@ -1,6 +1,12 @@
+import logging
+import random
 import time
 
 
+# Longest time to sleep between tries, unless the result asks for longer.
+MAX_SLEEP = 60
+
+
 def betwixt_sleep_with_backoff(initial_sleep, backoff):
     """Given an initial sleep and a backup, sleep for the time and increase it
     by the backoff time.
@@ -40,9 +46,85 @@ def run(f, test, betwixt):
     This does NOT catch any exceptions.
 
     """
-    ret = f()
-    if test(ret):
-        return ret
-    else:
+    while True:
+        ret = f()
+        if test(ret):
+            return ret
         betwixt()
-        return run(f, test, betwixt)
+
+
+class Policy:
+    """How to retry an operation.
+
+    Sleeps between tries use decorrelated jitter: each sleep is random between
+    [initial_sleep] and three times the previous sleep, capped at [max_sleep],
+    so callers that fail at the same time do not retry at the same time.  A
+    result can ask for a longer sleep, for example because the server sent a
+    Retry-After header.  No try is started after [deadline] seconds, if given.
+
+    Every retry is logged as an event with the policy's [name].
+
+    """
+    def __init__(self, name, tries, initial_sleep, max_sleep=MAX_SLEEP, deadline=None):
+        self.name = name
+        self.tries = tries
+        self.initial_sleep = initial_sleep
+        self.max_sleep = max_sleep
+        self.deadline = deadline
+
+    def _next_sleep(self, sleep):
+        return min(self.max_sleep, random.uniform(self.initial_sleep, sleep * 3))
+
+    def run(self, f, test, retry_after=None):
+        """Run [f] until [test] of its result returns [True], then return the
+        result.  If it never does, the last result is returned.
+
+        [retry_after] is an optional function of a result which returns the
+        number of seconds the result asks to wait before trying again, or
+        [None].
+
+        This does NOT catch any exceptions.
+
+        """
+        start = time.monotonic()
+        sleep = self.initial_sleep
+        attempt = 1
+        while True:
+            ret = f()
+            if test(ret):
+                if attempt > 1:
+                    logging.info('RETRY : %s : event=success : attempt=%d : elapsed=%.2f',
+                                 self.name,
+                                 attempt,
+                                 time.monotonic() - start)
+                return ret
+
+            if attempt >= self.tries:
+                logging.info('RETRY : %s : event=give_up : attempt=%d : reason=tries : elapsed=%.2f',
+                             self.name,
+                             attempt,
+                             time.monotonic() - start)
+                return ret
+
+            sleep = self._next_sleep(sleep)
+            hint = retry_after(ret) if retry_after is not None else None
+            if hint is not None:
+                sleep = max(sleep, hint)
+
+            elapsed = time.monotonic() - start
+            if self.deadline is not None and elapsed + sleep > self.deadline:
+                logging.info('RETRY : %s : event=give_up : attempt=%d : reason=deadline : '
+                             'elapsed=%.2f : sleep=%.2f',
+                             self.name,
+                             attempt,
+                             elapsed,
+                             sleep)
+                return ret
+
+            logging.info('RETRY : %s : event=retry : attempt=%d : sleep=%.2f : retry_after=%s',
+                         self.name,
+                         attempt,
+                         sleep,
+                         'none' if hint is None else '{:.2f}'.format(hint))
+            time.sleep(sleep)
+            attempt += 1
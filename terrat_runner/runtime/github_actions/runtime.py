@@ -138,7 +138,8 @@ class Runtime(object):
 
         return secrets
 
-    def add_reviewers(self, env, reviewers):
+    def add_reviewers(self, state, reviewers):
+        env = state.env
         if env['TERRATEAM_RUN_KIND'] == 'pr' and reviewers:
             data = json.loads(env['TERRATEAM_RUN_KIND_DATA'])
             pr_number = data['id']
@@ -157,12 +158,22 @@ class Runtime(object):
                 'team_reviewers': team_reviewers
             }
 
-            headers = {
-                'content-type': 'application/json',
-                'authorization': 'bearer {}'.format(env['TERRATEAM_GITHUB_TOKEN'])
-            }
+            def _post(token):
+                headers = {
+                    'content-type': 'application/json',
+                    'authorization': 'bearer {}'.format(token)
+                }
+
+                return requests_retry.post(url, headers=headers, json=data)
+
+            res = _post(env['TERRATEAM_GITHUB_TOKEN'])
 
-            res = requests_retry.post(url, headers=headers, json=data)
+            if res.status_code == 401:
+                # The token is shared by the whole run, so it may have expired
+                # since it was fetched.
+                logging.info('ADD_REVIEWERS : UNAUTHORIZED : REFRESHING_TOKEN')
+                state = workflow_step_update_terrateam_github_token.refresh(state)
+                res = _post(state.env['TERRATEAM_GITHUB_TOKEN'])
 
             if res.status_code != 201:
                 raise Exception('Could not add reviewers')
@@ -1,8 +1,7 @@
 import json
 import logging
-import os
-import tempfile
 
+import plan_render
 import workflow
 import workflow_step_run
 
@@ -10,53 +9,35 @@ import workflow_step_run
 def run(state, config):
     extra_args = config.get('extra_args', [])
 
-    res = state.engine.show(state, config)
-
-    if res is None:
-        return workflow.Result2(
-            payload={
-                'text': 'Unsable to show plan'
-            },
-            state=state,
-            step='run',
-            success=False)
-
-    (success, stdout, stderr) = res
+    (success, json_file, error) = plan_render.show_json(state)
 
     if not success:
         return workflow.Result2(
             payload={
-                'text': '\n'.join([stderr, stdout])
+                'text': error
             },
             state=state,
             step='run',
             success=False)
 
-    plan_json = stdout
-
-    with tempfile.TemporaryDirectory() as tmpdir:
-        json_file = os.path.join(tmpdir, 'json')
-        with open(json_file, 'w') as f:
-            f.write(plan_json)
-
-        run_config = {
-            'cmd': ['resourcely-cli',
-                    '--no_color',
-                    'evaluate',
-                    '--error_on_violations',
-                    '--format',
-                    'json',
-                    '--change_request_url',
-                    'https://github.com/{}/pull/{}'.format(state.env['GITHUB_REPOSITORY'],
-                                                           state.work_manifest['run_kind_data']['id']),
-                    '--change_request_sha',
-                    '${GITHUB_SHA}',
-                    '--plan',
-                    json_file] + extra_args,
-            'capture_output': True
-        }
-
-        result = workflow_step_run.run(state, run_config)
+    run_config = {
+        'cmd': ['resourcely-cli',
+                '--no_color',
+                'evaluate',
+                '--error_on_violations',
+                '--format',
+                'json',
+                '--change_request_url',
+                'https://github.com/{}/pull/{}'.format(state.env['GITHUB_REPOSITORY'],
+                                                       state.work_manifest['run_kind_data']['id']),
+                '--change_request_sha',
+                '${GITHUB_SHA}',
+                '--plan',
+                json_file] + extra_args,
+        'capture_output': True
+    }
+
+    result = workflow_step_run.run(state, run_config)
 
     if not result.success:
         errors = []
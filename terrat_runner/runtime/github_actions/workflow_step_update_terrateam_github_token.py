@@ -1,28 +1,83 @@
+import datetime
+import time
+
 import api
+import credential_cache
 import workflow
 
 
-def run(state, config):
+CACHE_NAME = 'terrateam-github-token'
+
+# Lifetime of a token if the server does not say when it expires.  GitHub
+# installation tokens are valid for an hour.
+DEFAULT_TTL = 3600
+
+
+class AccessTokenError(Exception):
+    def __init__(self, res):
+        self.res = res
+
+
+def _expires_at(body):
+    expires_at = body.get('expires_at')
+    if expires_at:
+        try:
+            return datetime.datetime.fromisoformat(expires_at.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            pass
+
+    return time.time() + DEFAULT_TTL
+
+
+def _fetch(state):
     res = api.work_manifest_post(state, 'access-token')
 
-    if res.status_code == 200:
-        access_token = res.json()['access_token']
-        state.runtime.set_secret(access_token)
-        env = state.env.copy()
-        env['TERRATEAM_GITHUB_TOKEN'] = access_token
-        state = state._replace(env=env)
+    if res.status_code != 200:
+        raise AccessTokenError(res)
+
+    body = res.json()
+    return (body['access_token'], _expires_at(body))
+
+
+def _cache_key(state):
+    return state.work_token
+
+
+def get_token(state):
+    """Return an access token, fetching one only if the run does not already
+    have one that is far enough from expiring."""
+    return credential_cache.get(state.env, CACHE_NAME, _cache_key(state), lambda: _fetch(state))
+
+
+def refresh(state):
+    """Fetch a new access token, for when the current one was rejected, and
+    return the state with it set."""
+    credential_cache.invalidate(state.env, CACHE_NAME, _cache_key(state))
+    return _set_token(state, get_token(state))
+
+
+def _set_token(state, access_token):
+    state.runtime.set_secret(access_token)
+    env = state.env.copy()
+    env['TERRATEAM_GITHUB_TOKEN'] = access_token
+    return state._replace(env=env)
+
+
+def run(state, config):
+    try:
+        state = _set_token(state, get_token(state))
         return workflow.make(success=True,
                                 state=state,
                                 step='auth/update-terrateam-github-token',
                                 payload={
                                     'visible_on': 'error'
                                 })
-    else:
+    except AccessTokenError as exn:
         text = """
         Status {}
 
         {}
-        """.format(res.status_code, res.text)
+        """.format(exn.res.status_code, exn.res.text)
         return workflow.make(success=False,
                                 state=state,
                                 step='auth/update-terrateam-github-token',
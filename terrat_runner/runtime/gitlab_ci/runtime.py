@@ -109,6 +109,6 @@ class Runtime(object):
 
         return secrets
 
-    def add_reviewers(self, env, reviewers):
+    def add_reviewers(self, state, reviewers):
         pass
 
@@ -0,0 +1,139 @@
+# Mask secrets in output before it is sent anywhere.
+#
+# The set of secrets is compiled once into a [Masker], which is then used for
+# every string in the results.  Secrets are masked longest first: if two
+# secrets overlap, the longer one is masked and the shorter one is left as is.
+#
+# If the pyahocorasick module is installed (the image installs it with the
+# python3-ahocorasick package) and there are enough secrets for it to pay off,
+# the secrets are compiled into an Aho-Corasick automaton and every string is
+# scanned once for all of them.  Otherwise each secret is searched for in turn,
+# which for a few dozen secrets is faster because of how quickly Python searches
+# for a single substring.  Run bench/bench_secret_mask.py to compare the two on
+# a given machine.
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+MASK = '***'
+
+# Searching for a secret gets slower the shorter it is, so each secret is
+# weighted by how short it is, and the automaton is used once the total weight
+# reaches this.  Measured with bench/bench_secret_mask.py, that is around 150
+# secrets of typical token length, or a third of that for secrets of a few
+# characters.
+AUTOMATON_MIN_WEIGHT = 150
+SHORT_SECRET_LEN = 16
+
+
+def _weight(secrets):
+    return sum(max(1, SHORT_SECRET_LEN / len(s)) for s in secrets)
+
+
+class Masker:
+    def __init__(self, secrets, unmasked=(), use_automaton=None):
+        # Longest first, ties broken so the order does not depend on the order
+        # of the input.
+        self.secrets = sorted(set(s for s in secrets if s), key=lambda s: (-len(s), s))
+        self.unmasked = set(unmasked)
+
+        if use_automaton is None:
+            use_automaton = (ahocorasick is not None
+                             and _weight(self.secrets) >= AUTOMATON_MIN_WEIGHT)
+
+        if use_automaton:
+            self.automaton = ahocorasick.Automaton()
+            for priority, s in enumerate(self.secrets):
+                self.automaton.add_word(s, (priority, len(s)))
+            self.automaton.make_automaton()
+        else:
+            self.automaton = None
+
+    def _replace_each(self, s):
+        for secret in self.secrets:
+            if secret in s:
+                s = s.replace(secret, MASK)
+        return s
+
+    def _spans_each(self, s):
+        taken = []
+        for secret in self.secrets:
+            start = s.find(secret)
+            while start != -1:
+                end = start + len(secret)
+                if not any(start < e and b < end for (b, e) in taken):
+                    taken.append((start, end))
+                start = s.find(secret, end)
+        return sorted(taken)
+
+    def _spans_automaton(self, s):
+        # Find every occurrence of every secret, then take them in the order
+        # [_replace_each] would, longest secret first and left to right, and
+        # drop any that overlap one already taken.
+        matches = sorted((priority, end - length + 1, end + 1)
+                         for (end, (priority, length)) in self.automaton.iter(s))
+        taken = []
+        covered = set()
+        for (_, start, end) in matches:
+            if not any(idx in covered for idx in range(start, end)):
+                covered.update(range(start, end))
+                taken.append((start, end))
+        return sorted(taken)
+
+    def _replace_automaton(self, s):
+        spans = self._spans_automaton(s)
+        if not spans:
+            return s
+        return self.replace_spans(s, spans)
+
+    def spans(self, s):
+        """Return the (start, end) of every secret [replace] masks in [s], in
+        order."""
+        if not self.secrets:
+            return []
+        elif self.automaton is not None:
+            return self._spans_automaton(s)
+        else:
+            return self._spans_each(s)
+
+    def replace_spans(self, s, spans):
+        """Mask [spans] of [s], as returned by [spans]."""
+        parts = []
+        pos = 0
+        for (start, end) in spans:
+            parts.append(s[pos:start])
+            parts.append(MASK)
+            pos = end
+        parts.append(s[pos:])
+        return ''.join(parts)
+
+    def replace(self, s):
+        """Mask every secret in [s]."""
+        if not self.secrets:
+            return s
+        elif self.automaton is not None:
+            return self._replace_automaton(s)
+        else:
+            return self._replace_each(s)
+
+    def mask(self, s):
+        """Same as [replace] unless [s] is exactly one of the unmasked values, in
+        which case it is returned unchanged."""
+        if s in self.unmasked:
+            return s
+        else:
+            return self.replace(s)
+
+    def mask_value(self, value):
+        """Mask every string in [value], which is any combination of dicts, lists
+        and scalars."""
+        if isinstance(value, str):
+            return self.mask(value)
+        elif isinstance(value, dict):
+            return {k: self.mask_value(v) for k, v in value.items()}
+        elif isinstance(value, list):
+            return [self.mask_value(v) for v in value]
+        else:
+            return value
@@ -0,0 +1,80 @@
+import collections
+import sys
+import unittest
+
+import cmd
+
+
+class Runtime:
+    def is_command(self, s):
+        return s.startswith('::add-mask::')
+
+
+State = collections.namedtuple('State', ['env', 'runtime', 'working_dir'])
+
+
+def state(**env):
+    return State(env=env, runtime=Runtime(), working_dir='.')
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+class AnsiStripperTest(unittest.TestCase):
+    def test_escape_split_across_chunks(self):
+        stripper = cmd._AnsiStripper()
+        out = ''.join([stripper.feed('a\033'), stripper.feed('[1;3'), stripper.feed('2mb')])
+        self.assertEqual(out + stripper.flush(), 'ab')
+
+    def test_unfinished_escape_is_kept(self):
+        stripper = cmd._AnsiStripper()
+        self.assertEqual(stripper.feed('a\033[1') + stripper.flush(), 'a\033[1')
+
+
+class OutputTest(unittest.TestCase):
+    def test_spills_and_slices(self):
+        output = cmd.Output(spill_bytes=4)
+        for s in ['abc', 'def', 'ghi']:
+            output.write(s)
+        self.assertTrue(output.spilled)
+        self.assertEqual(len(output), 9)
+        self.assertEqual(output.head(2), 'ab')
+        self.assertEqual(output.tail(2), 'hi')
+        self.assertEqual(''.join(output.chunks(4)), 'abcdefghi')
+        self.assertEqual(output.read(), 'abcdefghi')
+        output.close()
+
+    def test_slices_do_not_split_characters(self):
+        output = cmd.Output()
+        output.write('é' * 3)
+        self.assertEqual(output.head(3), 'é')
+        self.assertEqual(output.tail(3), 'é')
+        self.assertEqual(''.join(output.chunks(3)), 'é' * 3)
+
+
+class RunWithOutputTest(unittest.TestCase):
+    def test_output_larger_than_chunks_and_spill(self):
+        code = 'import sys; sys.stdout.write("\\033[31mx\\033[0m" * 100000); sys.stderr.write("err")'
+        (proc, stdout, stderr) = cmd.run_with_output(
+            state(TERRATEAM_OUTPUT_SPILL_BYTES='1000'),
+            {'cmd': python(code), 'log_output': False})
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(stdout, 'x' * 100000)
+        self.assertEqual(stderr, 'err')
+
+    def test_line_handler(self):
+        lines = []
+        (_, stdout, _) = cmd.run_with_output(
+            state(),
+            {
+                'cmd': python('print("a"); print("b", end="")'),
+                'log_output': False,
+                'stdout_line_handler': lines.append,
+            })
+        self.assertEqual(lines, ['a\n', 'b'])
+        self.assertEqual(stdout, '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import time
+import unittest
+
+import credential_cache
+
+
+class CredentialCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.env = {credential_cache.ENV_NAME: os.path.join(self.tmpdir.name, 'credentials')}
+        self.fetches = 0
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def fetch(self, ttl=3600):
+        def _f():
+            self.fetches += 1
+            return ('token-{}'.format(self.fetches), time.time() + ttl)
+        return _f
+
+    def test_reuses_until_invalidated(self):
+        self.assertEqual(credential_cache.get(self.env, 'tok', 'k', self.fetch()), 'token-1')
+        self.assertEqual(credential_cache.get(self.env, 'tok', 'k', self.fetch()), 'token-1')
+        credential_cache.invalidate(self.env, 'tok', 'k')
+        self.assertEqual(credential_cache.get(self.env, 'tok', 'k', self.fetch()), 'token-2')
+        self.assertEqual(credential_cache.stats(self.env), {'tok': {'hits': 1, 'fetches': 2}})
+
+    def test_refetches_near_expiry(self):
+        credential_cache.get(self.env, 'tok', 'k', self.fetch(ttl=credential_cache.MARGIN - 1))
+        self.assertEqual(credential_cache.get(self.env, 'tok', 'k', self.fetch()), 'token-2')
+
+    def test_keys_are_separate(self):
+        credential_cache.get(self.env, 'tok', ['role', 'a'], self.fetch())
+        self.assertEqual(credential_cache.get(self.env, 'tok', ['role', 'b'], self.fetch()), 'token-2')
+
+    def test_failed_fetch_is_not_cached(self):
+        def _fail():
+            raise Exception('no')
+        with self.assertRaises(Exception):
+            credential_cache.get(self.env, 'tok', 'k', _fail)
+        self.assertEqual(credential_cache.get(self.env, 'tok', 'k', self.fetch()), 'token-1')
+
+    def test_no_cache_dir(self):
+        credential_cache.get({}, 'tok', 'k', self.fetch())
+        self.assertEqual(credential_cache.get({}, 'tok', 'k', self.fetch()), 'token-2')
+
+
+if __name__ == '__main__':
+    unittest.main()
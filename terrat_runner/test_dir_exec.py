@@ -0,0 +1,120 @@
+import os
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import dir_exec
+
+
+def ds(rank, path, workspace):
+    return {'rank': rank, 'path': path, 'workspace': workspace}
+
+
+def key(d):
+    return (d['path'], d['workspace'])
+
+
+def _exec(log, d):
+    return (log, key(d))
+
+
+def _fail_or_mark(tmpdir, d):
+    # 'a' fails straight away while 'b' is still running.
+    if d['path'] == 'a':
+        raise Exception('failed')
+    time.sleep(0.5)
+    open(os.path.join(tmpdir, d['path']), 'w').close()
+    return key(d)
+
+
+class BuildGraphTest(unittest.TestCase):
+    def deps(self, dirs):
+        (nodes, preds) = dir_exec._build_graph(dirs)
+        return {key(nodes[idx]): set(key(nodes[p]) for p in ps)
+                for idx, ps in enumerate(preds)}
+
+    def test_same_rank_different_dirs_are_independent(self):
+        self.assertEqual(self.deps([ds(0, 'a', 'default'), ds(0, 'b', 'default')]),
+                         {('a', 'default'): set(), ('b', 'default'): set()})
+
+    def test_workspaces_of_a_dir_only_wait_on_each_other(self):
+        # The second workspace of 'a' must not wait on 'b', which the rows put
+        # in the same row as the first workspace of 'a'.
+        dirs = [ds(0, 'a', 'w1'), ds(0, 'a', 'w2'), ds(0, 'b', 'default')]
+        (nodes, _) = dir_exec._build_graph(dirs)
+        (first_a, second_a) = [key(n) for n in nodes if n['path'] == 'a']
+        deps = self.deps(dirs)
+        self.assertEqual(deps[first_a], set())
+        self.assertEqual(deps[second_a], set([first_a]))
+        self.assertEqual(deps[('b', 'default')], set())
+
+    def test_higher_rank_waits_on_the_last_workspace_of_every_dir(self):
+        dirs = [ds(0, 'a', 'w1'), ds(0, 'a', 'w2'), ds(0, 'b', 'default'), ds(1, 'c', 'default')]
+        (nodes, _) = dir_exec._build_graph(dirs)
+        last_a = [key(n) for n in nodes if n['path'] == 'a'][-1]
+        self.assertEqual(self.deps(dirs)[('c', 'default')], set([last_a, ('b', 'default')]))
+
+    def test_concurrent_workspaces_do_not_wait_on_each_other(self):
+        dirs = [ds(0, 'a', 'w1'), ds(0, 'a', 'w2'), ds(1, 'b', 'default')]
+        (nodes, preds) = dir_exec._build_graph(dirs, lambda d: d['path'] == 'a')
+        deps = {key(nodes[idx]): set(key(nodes[p]) for p in ps) for idx, ps in enumerate(preds)}
+        self.assertEqual(deps[('a', 'w1')], set())
+        self.assertEqual(deps[('a', 'w2')], set())
+        self.assertEqual(deps[('b', 'default')], set([('a', 'w1'), ('a', 'w2')]))
+
+    def test_empty(self):
+        self.assertEqual(dir_exec._build_graph([]), ([], []))
+
+
+class RunTest(unittest.TestCase):
+    def tearDown(self):
+        dir_exec.shutdown()
+
+    def test_runs_every_dirspace_once(self):
+        dirs = [ds(0, 'a', 'w1'), ds(0, 'a', 'w2'), ds(0, 'b', 'default'), ds(1, 'c', 'default')]
+        res = dir_exec.run(2, dirs, _exec, ('log',))
+        self.assertEqual(sorted(r[1] for r in res), sorted(key(d) for d in dirs))
+        self.assertTrue(all(r[0] == 'log' for r in res))
+
+    def test_pool_is_reused_across_runs(self):
+        dir_exec.run(2, [ds(0, 'a', 'default')], _exec, ('log',))
+        pool = dir_exec._POOL
+        dir_exec.run(1, [ds(0, 'b', 'default')], _exec, ('log',))
+        self.assertIs(pool, dir_exec._POOL)
+
+    def test_on_result_is_called_for_every_dirspace(self):
+        dirs = [ds(0, 'a', 'default'), ds(1, 'b', 'default')]
+        seen = []
+        dir_exec.run(2, dirs, _exec, ('log',), on_result=lambda d, r: seen.append((key(d), r)))
+        self.assertEqual(seen, [(('a', 'default'), ('log', ('a', 'default'))),
+                                (('b', 'default'), ('log', ('b', 'default')))])
+
+    def test_failed_run_waits_for_running_tasks(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dirs = [ds(0, 'a', 'default'), ds(0, 'b', 'default'), ds(1, 'c', 'default')]
+            with self.assertRaises(Exception):
+                dir_exec.run(2, dirs, _fail_or_mark, (tmpdir,))
+            self.assertEqual(os.listdir(tmpdir), ['b'])
+
+        self.assertEqual(dir_exec.run(2, [ds(0, 'd', 'default')], _exec, ('log',)),
+                         [('log', ('d', 'default'))])
+
+    def test_no_dirs(self):
+        self.assertEqual(dir_exec.run(2, [], _exec, ('log',)), [])
+
+    def test_workers_log_stats_on_shutdown(self):
+        # The workers are forked, so they inherit the patched log_stats.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def log_stats():
+                open(os.path.join(tmpdir, str(os.getpid())), 'w').close()
+
+            with unittest.mock.patch('requests_retry.log_stats', log_stats):
+                dir_exec.run(2, [ds(0, 'a', 'default'), ds(0, 'b', 'default')], _exec, ('log',))
+                dir_exec.shutdown()
+
+            self.assertEqual(len(os.listdir(tmpdir)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import datetime
+import json
+import os
+import tempfile
+import unittest
+
+import infracost_cache
+import run_state
+
+
+def _state(env):
+    return run_state.create(api_base_url='https://app.terrateam.io',
+                            api_token='token-abc',
+                            repo_config={},
+                            result_version=2,
+                            runtime=None,
+                            env=env,
+                            sha='deadbeef',
+                            work_manifest={},
+                            work_token='wm-123',
+                            working_dir='/tmp')
+
+
+class InfracostCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.state = _state({'TERRATEAM_INFRACOST_CACHE_DIR': os.path.join(self.tmpdir.name, 'cache')})
+        self.breakdown = os.path.join(self.tmpdir.name, 'breakdown.json')
+        self.dst = os.path.join(self.tmpdir.name, 'dst.json')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _write_breakdown(self, age):
+        generated = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=age)
+        with open(self.breakdown, 'w') as f:
+            json.dump({'timeGenerated': generated.isoformat().replace('+00:00', 'Z'),
+                       'projects': []},
+                      f)
+
+    def test_hit(self):
+        self.assertFalse(infracost_cache.get(self.state, 'key', self.dst))
+        self._write_breakdown(age=0)
+        infracost_cache.put(self.state, 'key', self.breakdown)
+        self.assertTrue(infracost_cache.get(self.state, 'key', self.dst))
+        with open(self.dst) as f:
+            self.assertEqual(json.load(f)['projects'], [])
+
+    def test_stale_breakdown_is_not_used(self):
+        self._write_breakdown(age=infracost_cache.TTL + 60)
+        infracost_cache.put(self.state, 'key', self.breakdown)
+        self.assertFalse(infracost_cache.get(self.state, 'key', self.dst))
+
+    def test_disabled(self):
+        self.assertFalse(infracost_cache.enabled(_state({})))
+        self.assertTrue(infracost_cache.enabled(self.state))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import subprocess
+import tempfile
+import unittest
+
+import main
+import tf_modules
+
+
+def _git(cwd, *args):
+    return subprocess.check_output(['git'] + list(args), cwd=cwd, stderr=subprocess.STDOUT)
+
+
+def _write(root, path, content):
+    path = os.path.join(root, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class PartialMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.origin = os.path.join(self.tmpdir.name, 'origin')
+        self.clone = os.path.join(self.tmpdir.name, 'clone')
+
+        os.makedirs(self.origin)
+        _git(self.origin, 'init', '-q', '-b', 'main')
+        _git(self.origin, 'config', 'user.email', 'test@example.com')
+        _git(self.origin, 'config', 'user.name', 'Test')
+        _git(self.origin, 'config', 'uploadpack.allowfilter', 'true')
+        _write(self.origin, '.terrateam/config.yml', 'cost_estimation:\n  enabled: false\n')
+        _write(self.origin, 'app/main.tf', 'module "vpc" {\n  source = "../modules/vpc"\n}\n')
+        _write(self.origin, 'modules/vpc/main.tf', 'module "sg" {\n  source = "../sg"\n}\n')
+        _write(self.origin, 'modules/sg/main.tf', '')
+        _write(self.origin, 'other/main.tf', '')
+        _git(self.origin, 'add', '.')
+        _git(self.origin, 'commit', '-q', '-m', 'initial')
+        for i in range(5):
+            _write(self.origin, 'history.txt', str(i))
+            _git(self.origin, 'add', 'history.txt')
+            _git(self.origin, 'commit', '-q', '-m', str(i))
+
+        _git(self.origin, 'checkout', '-q', '-b', 'feature')
+        _write(self.origin, 'app/main.tf', 'module "vpc" {\n  source = "../modules/vpc"\n}\n# feature\n')
+        _git(self.origin, 'commit', '-q', '-a', '-m', 'feature')
+        _git(self.origin, 'checkout', '-q', 'main')
+        _write(self.origin, 'other/main.tf', '# main\n')
+        _git(self.origin, 'commit', '-q', '-a', '-m', 'main')
+
+        _git(self.tmpdir.name,
+             'clone', '-q', '--depth=1', '--branch', 'feature',
+             'file://' + self.origin, self.clone)
+        _git(self.clone, 'config', 'user.email', 'test@example.com')
+        _git(self.clone, 'config', 'user.name', 'Test')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_module_closure(self):
+        self.assertEqual(tf_modules.closure(self.clone, ['app']),
+                         ['app', 'modules/sg', 'modules/vpc'])
+
+    def test_partial_merge(self):
+        main.perform_merge(self.clone, 'main', main.MERGE_STRATEGY_PARTIAL)
+        self.assertEqual(_git(self.clone, 'rev-parse', '--is-shallow-repository').strip(), b'false')
+        with open(os.path.join(self.clone, 'other/main.tf')) as f:
+            self.assertEqual(f.read(), '# main\n')
+
+    def test_partial_merge_with_sparse_checkout(self):
+        main.perform_merge(self.clone, 'main', main.MERGE_STRATEGY_PARTIAL, sparse_paths=['app'])
+        self.assertTrue(os.path.exists(os.path.join(self.clone, 'modules/sg/main.tf')))
+        self.assertTrue(os.path.exists(os.path.join(self.clone, '.terrateam/config.yml')))
+        self.assertFalse(os.path.exists(os.path.join(self.clone, 'other')))
+        self.assertIn(b'main', _git(self.clone, 'log', '--format=%s', '-n', '3'))
+
+    def test_merge_after_sparse_checkout_has_the_whole_repo(self):
+        main.perform_merge(self.clone, 'main', main.MERGE_STRATEGY_PARTIAL, sparse_paths=['app'])
+        main.perform_merge(self.clone, 'main', main.MERGE_STRATEGY_PARTIAL)
+        self.assertTrue(os.path.exists(os.path.join(self.clone, 'other/main.tf')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+import unittest.mock
+
+import cmd
+import output_budget
+import secret_mask
+
+
+def step(name, **payload):
+    return {'step': name, 'payload': payload}
+
+
+def env(step_budget, run_budget):
+    return {
+        'TERRATEAM_OUTPUT_STEP_BUDGET_BYTES': str(step_budget),
+        'TERRATEAM_OUTPUT_RUN_BUDGET_BYTES': str(run_budget),
+    }
+
+
+class FillTest(unittest.TestCase):
+    def test_small_entries_give_their_share_to_large_ones(self):
+        self.assertEqual(output_budget._fill([10, 1000, 1000], 310), [10, 150, 150])
+
+    def test_everything_fits(self):
+        self.assertEqual(output_budget._fill([1, 2], 10), [1, 2])
+
+
+class TruncateTest(unittest.TestCase):
+    def test_keeps_head_and_tail(self):
+        (s, dropped) = output_budget.truncate('a' * 10 + 'b' * 10, 4)
+        self.assertEqual(dropped, 16)
+        self.assertEqual(s, 'aa' + output_budget.MARKER.format(16) + 'bb')
+
+    def test_fits(self):
+        self.assertEqual(output_budget.truncate('abc', 3), ('abc', 0))
+
+    def test_does_not_split_characters(self):
+        (s, _) = output_budget.truncate('é' * 10, 5)
+        self.assertEqual(s, 'é' + output_budget.MARKER.format(15) + 'é')
+
+    def test_secret_spanning_cut_is_dropped(self):
+        masker = secret_mask.Masker(['SECRET'])
+        (s, dropped) = output_budget.truncate('xxSECRETxxxxxxxxxxxxxxxxxxxxxxxx', 8, masker)
+        self.assertEqual(s, 'xx' + output_budget.MARKER.format(26) + 'xxxx')
+        self.assertEqual(dropped, 26)
+
+    def test_secret_spanning_tail_cut_is_dropped(self):
+        masker = secret_mask.Masker(['SECRET'])
+        (s, _) = output_budget.truncate('x' * 24 + 'SECRETyy', 8, masker)
+        self.assertEqual(s, 'xxxx' + output_budget.MARKER.format(26) + 'yy')
+
+    def test_masks_shorter_than_secrets_do_not_move_the_cut(self):
+        # Masking a secret shortens the text, which must not pull part of the
+        # next secret into what is kept.
+        masker = secret_mask.Masker(['LONGSECRET', 'PASSWORD'])
+        (s, _) = output_budget.truncate('xxxxxxLONGSECRETxxPASSWORD' + 'y' * 34, 16, masker)
+        self.assertEqual(s, 'xxxxxx' + output_budget.MARKER.format(46) + 'yyyyyyyy')
+
+
+class ApplyTest(unittest.TestCase):
+    def test_step_budget(self):
+        results = {'steps': [step('run', text='a' * 100, stderr='b' * 10, cmd=['x'])]}
+        res = output_budget.apply(env(50, 0), results)
+        payload = res['steps'][0]['payload']
+        self.assertEqual(payload['stderr'], 'b' * 10)
+        self.assertTrue(payload['text'].startswith('a' * 20))
+        self.assertIn(output_budget.MARKER.format(60), payload['text'])
+        self.assertEqual(payload['cmd'], ['x'])
+        # The original results are not modified.
+        self.assertEqual(results['steps'][0]['payload']['text'], 'a' * 100)
+
+    def test_run_budget(self):
+        results = {'steps': [step('a', text='a' * 100), step('b', text='b' * 100)]}
+        res = output_budget.apply(env(0, 100), results)
+        for s in res['steps']:
+            self.assertIn(output_budget.MARKER.format(50), s['payload']['text'])
+
+    def test_disabled(self):
+        results = {'steps': [step('a', text='a' * 100)]}
+        self.assertIs(output_budget.apply(env(0, 0), results), results)
+
+
+
+class ReadTest(unittest.TestCase):
+    def output(self, s):
+        output = cmd.Output(spill_bytes=16)
+        output.write(s)
+        self.addCleanup(output.close)
+        return output
+
+    def test_small_output_is_read_whole(self):
+        self.assertEqual(output_budget.read(env(10, 0), self.output('abc')), 'abc')
+
+    @unittest.mock.patch('output_budget.READ_MARGIN_BYTES', 2)
+    def test_large_output_is_cut_and_counted_by_apply(self):
+        text = output_budget.read(env(10, 0), self.output('a' * 50 + 'b' * 50))
+        self.assertEqual(text, 'a' * 7 + output_budget.MARKER.format(86) + 'b' * 7)
+
+        # Cutting it again to the step budget counts what reading dropped.
+        res = output_budget.apply(env(10, 0), {'steps': [step('run', text=text)]})
+        self.assertEqual(res['steps'][0]['payload']['text'],
+                         'a' * 5 + output_budget.MARKER.format(90) + 'b' * 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+import plan_cache
+
+
+class PlanCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.env = {plan_cache.ENV_NAME: os.path.join(self.tmpdir.name, 'cache')}
+        self.plan = os.path.join(self.tmpdir.name, 'plan')
+        self.dst = os.path.join(self.tmpdir.name, 'dst')
+        with open(self.plan, 'wb') as f:
+            f.write(b'plan data')
+        self.digest = plan_cache.digest(self.plan)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_hit_and_miss(self):
+        self.assertFalse(plan_cache.get(self.env, self.digest, self.dst))
+        plan_cache.put(self.env, self.digest, self.plan)
+        self.assertTrue(plan_cache.get(self.env, self.digest, self.dst))
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), b'plan data')
+
+    def test_corrupt_entry_is_removed(self):
+        plan_cache.put(self.env, self.digest, self.plan)
+        with open(os.path.join(self.env[plan_cache.ENV_NAME], self.digest), 'wb') as f:
+            f.write(b'something else')
+        self.assertFalse(plan_cache.get(self.env, self.digest, self.dst))
+        self.assertFalse(os.path.exists(os.path.join(self.env[plan_cache.ENV_NAME], self.digest)))
+
+    def test_least_recently_used_is_evicted(self):
+        env = dict(self.env, **{plan_cache.MAX_MB_ENV_NAME: '1'})
+        plans = []
+        for i in range(3):
+            plan = os.path.join(self.tmpdir.name, 'plan{}'.format(i))
+            with open(plan, 'wb') as f:
+                f.write(bytes([i]) * (300 * 1024))
+            plans.append(plan_cache.digest(plan))
+            plan_cache.put(env, plans[-1], plan)
+            os.utime(os.path.join(env[plan_cache.ENV_NAME], plans[-1]), (i, i))
+
+        # Using the oldest plan makes the second one the least recently used.
+        self.assertTrue(plan_cache.get(env, plans[0], self.dst))
+
+        plan = os.path.join(self.tmpdir.name, 'plan3')
+        with open(plan, 'wb') as f:
+            f.write(b'\x03' * (300 * 1024))
+        plan_cache.put(env, plan_cache.digest(plan), plan)
+
+        self.assertEqual(sorted(os.listdir(env[plan_cache.ENV_NAME])),
+                         sorted([plans[0], plans[2], plan_cache.digest(plan)]))
+
+    def test_disabled_without_dir(self):
+        plan_cache.put({}, self.digest, self.plan)
+        self.assertFalse(plan_cache.get({}, self.digest, self.dst))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import base64
+import json
+import os
+import tempfile
+import unittest
+
+import plan_codec
+
+
+class PlanCodecTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, 'plan')
+        self.dst = os.path.join(self.tmpdir.name, 'plan.out')
+        self.plan = os.urandom(1000) + b'resource' * 100000
+        with open(self.src, 'wb') as f:
+            f.write(self.plan)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _roundtrip(self, compression):
+        (data, md5) = plan_codec.encode(self.src, compression)
+        self.assertTrue(plan_codec.is_encoded(data))
+        self.assertEqual(plan_codec.decode_to_file(data, self.dst), md5)
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), self.plan)
+        return data
+
+    def test_gzip(self):
+        data = self._roundtrip('gzip')
+        self.assertLess(len(data), len(self.plan) / 10)
+
+    def test_none(self):
+        self._roundtrip('none')
+
+    @unittest.skipIf(plan_codec.zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        self._roundtrip('zstd')
+
+    def test_compression_setting(self):
+        self.assertEqual(plan_codec.compression({'TERRATEAM_PLAN_COMPRESSION': 'none'}), 'none')
+        self.assertEqual(plan_codec.compression({'TERRATEAM_PLAN_COMPRESSION': 'gzip'}), 'gzip')
+        self.assertIn(plan_codec.compression({}), ('gzip', 'zstd'))
+
+    def test_truncated_plan_is_rejected(self):
+        (data, _) = plan_codec.encode(self.src, 'none')
+        with self.assertRaises(plan_codec.Error):
+            plan_codec.decode_to_file(data[:-1], self.dst)
+
+    def test_version_1_is_not_encoded(self):
+        # Plans stored before version 2 are JSON, or the raw plan.
+        v1 = json.dumps({'method': 'terrateam',
+                         'data': base64.b64encode(self.plan).decode('utf-8'),
+                         'version': 1}).encode('utf-8')
+        self.assertFalse(plan_codec.is_encoded(v1))
+        self.assertFalse(plan_codec.is_encoded(self.plan))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import subprocess
+import tempfile
+import unittest
+import unittest.mock
+
+import plan_render
+import run_state
+
+
+class PlanRenderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.plan_file = os.path.join(self.tmpdir.name, 'plan')
+        self.write_plan(b'plan one')
+        self.state = run_state.create(api_base_url='https://app.terrateam.io',
+                                      api_token='token-abc',
+                                      repo_config={},
+                                      result_version=2,
+                                      runtime=None,
+                                      env={'TERRATEAM_PLAN_FILE': self.plan_file,
+                                           'TERRATEAM_TMPDIR': self.tmpdir.name},
+                                      sha='deadbeef',
+                                      work_manifest={},
+                                      work_token='wm-123',
+                                      working_dir=self.tmpdir.name)._replace(path='app')
+        self.calls = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write_plan(self, contents):
+        with open(self.plan_file, 'wb') as f:
+            f.write(contents)
+
+    def run_with_output(self, state, config):
+        self.calls.append(config['cmd'])
+        with open(self.plan_file) as f:
+            plan = f.read()
+        return (subprocess.CompletedProcess(config['cmd'], 0), 'shown ' + plan, '')
+
+    def render(self, show):
+        with unittest.mock.patch('cmd.run_with_output', self.run_with_output):
+            (success, path, error) = show(self.state)
+        self.assertTrue(success, error)
+        return plan_render.read(path)
+
+    def test_show_runs_once_per_plan_and_kind(self):
+        self.assertEqual(self.render(plan_render.show_json), 'shown plan one')
+        self.assertEqual(self.render(plan_render.show_json), 'shown plan one')
+        self.assertEqual(self.render(plan_render.show_text), 'shown plan one')
+        self.assertEqual(self.render(plan_render.show_text), 'shown plan one')
+        self.assertEqual(self.calls,
+                         [['${TERRATEAM_TF_CMD}', 'show', '-json', '${TERRATEAM_PLAN_FILE}'],
+                          ['${TERRATEAM_TF_CMD}', 'show', '${TERRATEAM_PLAN_FILE}']])
+
+    def test_changed_plan_is_rendered_again(self):
+        self.assertEqual(self.render(plan_render.show_json), 'shown plan one')
+        self.write_plan(b'plan two')
+        self.assertEqual(self.render(plan_render.show_json), 'shown plan two')
+        self.assertEqual(len(self.calls), 2)
+
+    def test_failed_show_is_not_kept(self):
+        failed = (subprocess.CompletedProcess([], 1), 'out', 'err')
+        with unittest.mock.patch('cmd.run_with_output', return_value=failed):
+            self.assertEqual(plan_render.show_json(self.state), (False, None, 'err\nout'))
+        self.assertEqual(self.render(plan_render.show_json), 'shown plan one')
+
+    def test_missing_plan_file_fails(self):
+        os.remove(self.plan_file)
+        with unittest.mock.patch('cmd.run_with_output') as run_with_output:
+            (success, path, error) = plan_render.show_json(self.state)
+        run_with_output.assert_not_called()
+        self.assertFalse(success)
+        self.assertIsNone(path)
+        self.assertIn(self.plan_file, error)
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir.name, 'plan-render')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+
+import plugin_cache
+
+
+LOCK_FILE = '''
+# This file is maintained automatically by "terraform init".
+# Manual edits may be lost in future updates.
+
+provider "registry.terraform.io/hashicorp/aws" {
+  version     = "5.31.0"
+  constraints = ">= 5.0.0"
+  hashes = [
+    "h1:ltxyuBWIy9cq0kIKDJH1jeWJy/y7XJLjS4QrsQK4plA=",
+    "zh:0cdb9c2083bf0902442384f7309367791e4640581652dda456f2d6d7abf0de8d",
+  ]
+}
+
+provider "registry.terraform.io/hashicorp/random" {
+  version = "3.6.0"
+  hashes = [
+    "h1:R5Ucn26riKIEijcsiOMBR3uOAjuOMfI1x7XvH4P6B1w=",
+  ]
+}
+'''
+
+
+class ReadLockFileTest(unittest.TestCase):
+    def test_reads_source_and_version(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, plugin_cache.LOCK_FILE)
+            with open(path, 'w') as f:
+                f.write(LOCK_FILE)
+
+            self.assertEqual(plugin_cache.read_lock_file(path),
+                             [('registry.terraform.io/hashicorp/aws', '5.31.0'),
+                              ('registry.terraform.io/hashicorp/random', '3.6.0')])
+
+
+class PassesTest(unittest.TestCase):
+    def test_one_version_of_a_source_per_pass(self):
+        passes = plugin_cache._passes(set([('a', '1.0.0'), ('a', '2.0.0'), ('b', '1.0.0')]))
+        self.assertEqual(passes, [{'a': '1.0.0', 'b': '1.0.0'}, {'a': '2.0.0'}])
+
+
+class RequiredProvidersTest(unittest.TestCase):
+    def test_names_are_unique(self):
+        tf = plugin_cache._required_providers_tf({'example.com/a/aws': '1.0.0',
+                                                  'example.com/b/aws2': '1.0.0',
+                                                  'example.com/c/aws': '1.0.0'})
+        self.assertEqual([line.split()[0] for line in tf.splitlines() if line.endswith('= {')],
+                         ['aws', 'aws2', 'aws1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
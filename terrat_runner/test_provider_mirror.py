@@ -0,0 +1,166 @@
+import hashlib
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import plugin_cache
+import provider_mirror
+import run_state
+
+
+PACKAGE = b'provider package'
+
+LOCK_FILE = '''
+provider "registry.terraform.io/hashicorp/aws" {
+  version     = "5.0.0"
+  constraints = "~> 5.0"
+}
+'''
+
+
+class Response:
+    def __init__(self, json=None, content=b''):
+        self._json = json
+        self.content = content
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._json
+
+    def iter_content(self, chunk_size):
+        return [self.content[i:i + chunk_size] for i in range(0, len(self.content), chunk_size)]
+
+
+class Registry:
+    """Stands in for [requests_retry.get], answering like a provider registry
+    that serves [PACKAGE] with [shasum]."""
+    def __init__(self, shasum=hashlib.sha256(PACKAGE).hexdigest()):
+        self.shasum = shasum
+        self.urls = []
+
+    def get(self, url, headers=None, stream=False):
+        self.urls.append((url, headers))
+        if url.endswith('/.well-known/terraform.json'):
+            return Response(json={'providers.v1': '/v1/providers/'})
+        elif '/download/' in url:
+            return Response(json={'download_url': 'https://releases.example.com/aws.zip',
+                                  'shasum': self.shasum})
+        else:
+            return Response(content=PACKAGE)
+
+
+class ProviderMirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.mirror = os.path.join(self.tmpdir.name, 'mirror')
+        self.repo = os.path.join(self.tmpdir.name, 'repo')
+        os.makedirs(os.path.join(self.repo, 'app'))
+        with open(os.path.join(self.repo, 'app', plugin_cache.LOCK_FILE), 'w') as f:
+            f.write(LOCK_FILE)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def state(self, env=None):
+        return run_state.create(api_base_url='https://app.terrateam.io',
+                                api_token='token-abc',
+                                repo_config={},
+                                result_version=2,
+                                runtime=None,
+                                env=dict({'TERRATEAM_PROVIDER_MIRROR': 'true',
+                                          'TERRATEAM_PROVIDER_MIRROR_DIR': self.mirror,
+                                          'TF_CLI_CONFIG_FILE': os.path.join(self.tmpdir.name,
+                                                                             'none.tfrc')},
+                                         **(env or {})),
+                                sha='deadbeef',
+                                work_manifest={'changed_dirspaces': [{'path': 'app',
+                                                                      'workspace': 'default'}]},
+                                work_token='wm-123',
+                                working_dir=self.repo)._replace(tmpdir=self.tmpdir.name)
+
+    def test_package_path_uses_packed_layout(self):
+        self.assertEqual(provider_mirror._package_path('/mirror',
+                                                       'registry.terraform.io/hashicorp/aws',
+                                                       '5.0.0',
+                                                       'linux_amd64'),
+                         '/mirror/registry.terraform.io/hashicorp/aws/'
+                         'terraform-provider-aws_5.0.0_linux_amd64.zip')
+
+    def test_discovery_is_done_once_per_host(self):
+        registry = Registry()
+        discovered = {}
+        env = {'TF_TOKEN_registry_terraform_io': 'tok'}
+        with unittest.mock.patch('requests_retry.get', registry.get):
+            for _ in range(2):
+                self.assertEqual(provider_mirror._providers_url(env,
+                                                                'registry.terraform.io',
+                                                                discovered),
+                                 'https://registry.terraform.io/v1/providers/')
+        self.assertEqual(registry.urls,
+                         [('https://registry.terraform.io/.well-known/terraform.json',
+                           {'authorization': 'bearer tok'})])
+
+    def test_checksum_mismatch_is_rejected(self):
+        with unittest.mock.patch('requests_retry.get', Registry(shasum='0' * 64).get):
+            with self.assertRaises(Exception):
+                provider_mirror._download({},
+                                          self.mirror,
+                                          'registry.terraform.io/hashicorp/aws',
+                                          '5.0.0',
+                                          'linux_amd64',
+                                          'https://registry.terraform.io/v1/providers/')
+        self.assertEqual(os.listdir(os.path.join(self.mirror, 'registry.terraform.io',
+                                                 'hashicorp', 'aws')),
+                         [])
+
+    def test_prepare_fills_mirror_and_writes_cli_config(self):
+        registry = Registry()
+        with unittest.mock.patch('requests_retry.get', registry.get):
+            state = provider_mirror.prepare(self.state())
+
+        path = provider_mirror._package_path(self.mirror,
+                                             'registry.terraform.io/hashicorp/aws',
+                                             '5.0.0',
+                                             plugin_cache.current_platform())
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), PACKAGE)
+        self.assertIn(('https://registry.terraform.io/v1/providers/hashicorp/aws/5.0.0/download/{}'
+                       .format(plugin_cache.current_platform().replace('_', '/', 1)),
+                       {}),
+                      registry.urls)
+
+        self.assertEqual(state.env['TF_CLI_CONFIG_FILE'],
+                         os.path.join(self.tmpdir.name, 'provider-mirror.tfrc'))
+        with open(state.env['TF_CLI_CONFIG_FILE']) as f:
+            self.assertEqual(f.read(),
+                             '\n'.join(['',
+                                        'provider_installation {',
+                                        '  filesystem_mirror {',
+                                        '    path    = "{}"'.format(self.mirror),
+                                        '    include = ["registry.terraform.io/hashicorp/aws"]',
+                                        '  }',
+                                        '  direct {}',
+                                        '}',
+                                        '']))
+
+    def test_failed_download_is_not_mirrored(self):
+        with unittest.mock.patch('requests_retry.get', Registry(shasum='0' * 64).get):
+            state = self.state()
+            self.assertIs(provider_mirror.prepare(state), state)
+
+    def test_existing_provider_installation_is_kept(self):
+        cli_config = os.path.join(self.tmpdir.name, 'user.tfrc')
+        with open(cli_config, 'w') as f:
+            f.write('provider_installation {\n  direct {}\n}\n')
+
+        state = self.state({'TF_CLI_CONFIG_FILE': cli_config})
+        with unittest.mock.patch('requests_retry.get') as get:
+            self.assertIs(provider_mirror.prepare(state), state)
+        get.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import rate_limit
+
+
+class ParseTest(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(rate_limit.parse('api.github.com=10:20, Example.com=2,'),
+                         {'api.github.com': (10.0, 20.0), 'example.com': (2.0, 2.0)})
+
+
+class ReserveTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'host')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_burst_then_spaced_out(self):
+        waits = [rate_limit._reserve(self.path, 2.0, 3.0, 100.0) for _ in range(5)]
+        self.assertEqual(waits, [0.0, 0.0, 0.0, 0.5, 1.0])
+
+    def test_refills(self):
+        for _ in range(3):
+            rate_limit._reserve(self.path, 2.0, 3.0, 100.0)
+        self.assertEqual(rate_limit._reserve(self.path, 2.0, 3.0, 101.0), 0.0)
+        # Never more than the burst.
+        waits = [rate_limit._reserve(self.path, 2.0, 3.0, 1000.0) for _ in range(4)]
+        self.assertEqual(waits, [0.0, 0.0, 0.0, 0.5])
+
+
+class AcquireTest(unittest.TestCase):
+    def test_unlimited_host(self):
+        self.assertEqual(rate_limit.acquire('https://unlimited.example.com/x'), 0.0)
+
+    def test_nothing_is_limited_by_default(self):
+        with unittest.mock.patch.dict('os.environ'):
+            os.environ.pop('TERRATEAM_RATE_LIMITS', None)
+            self.assertEqual(rate_limit._limits(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import http.server
+import os
+import threading
+import unittest
+
+import requests_retry
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('content-length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class SessionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+        requests_retry.close()
+        requests_retry._reset()
+
+    def tearDown(self):
+        requests_retry.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connections_are_reused(self):
+        for _ in range(3):
+            self.assertEqual(requests_retry.get(self.url).text, 'ok')
+        self.assertEqual(requests_retry.stats(),
+                         {'requests': 3, 'connections': 1, 'reused': 2})
+
+    def test_forked_child_gets_its_own_session(self):
+        requests_retry.get(self.url)
+        (r, w) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            fresh = requests_retry._SESSION is None and requests_retry.stats()['requests'] == 0
+            os.write(w, b'1' if fresh else b'0')
+            os._exit(0)
+        os.close(w)
+        self.assertEqual(os.read(r, 1), b'1')
+        os.close(r)
+        os.waitpid(pid, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import unittest.mock
+
+import requests_retry
+import retry
+
+
+class Response:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class PolicyTest(unittest.TestCase):
+    def run_policy(self, policy, results, retry_after=None):
+        results = iter(results)
+        with unittest.mock.patch('time.sleep') as sleep:
+            ret = policy.run(lambda: next(results), lambda r: r == 'ok', retry_after)
+        return (ret, [c.args[0] for c in sleep.call_args_list])
+
+    def test_retries_until_success(self):
+        (ret, sleeps) = self.run_policy(retry.Policy('t', 5, 1), ['fail', 'fail', 'ok'])
+        self.assertEqual(ret, 'ok')
+        self.assertEqual(len(sleeps), 2)
+
+    def test_gives_up_after_tries(self):
+        (ret, sleeps) = self.run_policy(retry.Policy('t', 3, 1), ['a', 'b', 'c', 'ok'])
+        self.assertEqual(ret, 'c')
+        self.assertEqual(len(sleeps), 2)
+
+    def test_sleeps_are_jittered_and_capped(self):
+        (_, sleeps) = self.run_policy(retry.Policy('t', 20, 1, max_sleep=10), ['fail'] * 20)
+        self.assertTrue(all(1 <= s <= 10 for s in sleeps))
+        self.assertGreater(len(set(sleeps)), 1)
+
+    def test_retry_after_is_honoured(self):
+        (_, sleeps) = self.run_policy(retry.Policy('t', 2, 1, max_sleep=2),
+                                      ['fail', 'ok'],
+                                      lambda r: 30)
+        self.assertEqual(sleeps, [30])
+
+    def test_deadline(self):
+        (ret, sleeps) = self.run_policy(retry.Policy('t', 5, 1, deadline=10),
+                                        ['fail', 'ok'],
+                                        lambda r: 60)
+        self.assertEqual(ret, 'fail')
+        self.assertEqual(sleeps, [])
+
+    def test_run_does_not_recurse(self):
+        tries = retry.finite_tries(5000, lambda r: False)
+        self.assertEqual(retry.run(lambda: 1, tries, lambda: None), 1)
+
+
+class RetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(requests_retry._retry_after((True, Response(429, {'retry-after': '7'}))), 7)
+
+    def test_http_date_in_the_past(self):
+        res = Response(503, {'retry-after': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(requests_retry._retry_after((True, res)), 0)
+
+    def test_github_rate_limit(self):
+        with unittest.mock.patch('time.time', return_value=1000):
+            res = Response(403, {'x-ratelimit-remaining': '0', 'x-ratelimit-reset': '1042'})
+            self.assertEqual(requests_retry._retry_after((True, res)), 42)
+            self.assertFalse(requests_retry._test_success((True, res)))
+
+    def test_plain_forbidden_is_not_retried(self):
+        self.assertTrue(requests_retry._test_success((True, Response(403))))
+
+
+if __name__ == '__main__':
+    unittest.main()
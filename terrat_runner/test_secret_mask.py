@@ -0,0 +1,59 @@
+import unittest
+
+import secret_mask
+
+
+def old_mask(secrets, unmasked, output):
+    # The implementation the masker replaced.
+    if output in unmasked:
+        return output
+    for secret in sorted(secrets, key=len, reverse=True):
+        if secret in output:
+            output = output.replace(secret, '***')
+    return output
+
+
+CASES = [
+    (['abc'], 'xabcxabc'),
+    (['aa'], 'aaaaa'),
+    # The longer secret wins where they overlap.
+    (['bcd', 'ab'], 'abcd'),
+    (['abcd', 'bc'], 'abcd bc'),
+    (['cdef', 'ab'], 'abcdef'),
+    (['secret', 'sec', 'cret'], 'secret sec cret secre'),
+    (['é1', 'ü'], 'aé1üb'),
+    ([], 'nothing'),
+]
+
+
+class MaskerTest(unittest.TestCase):
+    def check(self, use_automaton):
+        for (secrets, s) in CASES:
+            masker = secret_mask.Masker(secrets, use_automaton=use_automaton)
+            self.assertEqual(masker.mask(s), old_mask(secrets, set(), s), (secrets, s))
+            self.assertEqual(masker.replace_spans(s, masker.spans(s)), masker.replace(s))
+
+    def test_matches_old_implementation(self):
+        self.check(False)
+
+    @unittest.skipIf(secret_mask.ahocorasick is None, 'pyahocorasick is not installed')
+    def test_automaton_matches_old_implementation(self):
+        self.check(True)
+
+    def test_unmasked(self):
+        masker = secret_mask.Masker(['dev'], ['dev'])
+        self.assertEqual(masker.mask('dev'), 'dev')
+        self.assertEqual(masker.mask('dev env'), '*** env')
+        self.assertEqual(masker.replace('dev'), '***')
+
+    def test_empty_secret_is_ignored(self):
+        self.assertEqual(secret_mask.Masker(['']).mask('abc'), 'abc')
+
+    def test_mask_value(self):
+        masker = secret_mask.Masker(['pw'])
+        self.assertEqual(masker.mask_value({'a': ['pw', 1, {'b': 'xpw'}], 'c': None}),
+                         {'a': ['***', 1, {'b': 'x***'}], 'c': None})
+
+
+if __name__ == '__main__':
+    unittest.main()
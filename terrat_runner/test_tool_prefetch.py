@@ -0,0 +1,142 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import repo_config as rc
+import run_state
+import tool_prefetch
+import work_exec
+
+
+REPO_CONFIG = {
+    'workflows': [
+        {
+            'tag_query': 'dir:infra',
+            'engine': {'name': 'terragrunt', 'version': '0.60.0'},
+            'plan': [{'type': 'init'}, {'type': 'plan'}, {'type': 'checkov'}],
+        },
+        {
+            'tag_query': 'dir:app',
+            'engine': {'name': 'pulumi'},
+        },
+    ],
+    'hooks': {'plan': {'pre': [{'type': 'opa'}]}},
+}
+
+
+def _state(work_manifest_type):
+    env = {}
+    work_exec.set_engine_env(env, REPO_CONFIG, rc.get_engine(REPO_CONFIG), '/tmp', '/tmp')
+    return run_state.create(api_base_url='https://app.terrateam.io',
+                            api_token='token-abc',
+                            repo_config=REPO_CONFIG,
+                            result_version=2,
+                            runtime=None,
+                            env=env,
+                            sha='deadbeef',
+                            work_manifest={'type': work_manifest_type,
+                                           'changed_dirspaces': [
+                                               {'path': 'infra', 'workspace': 'default',
+                                                'workflow': 0},
+                                               {'path': 'app', 'workspace': 'default',
+                                                'workflow': 1},
+                                           ]},
+                            work_token='wm-123',
+                            working_dir='/tmp')
+
+
+def _cmds(tools):
+    return {key: c for (key, (c, _)) in tools.items()}
+
+
+class ToolsTest(unittest.TestCase):
+    def test_plan(self):
+        self.assertEqual(_cmds(tool_prefetch.tools(_state('plan'), work_exec.set_engine_env)),
+                         {
+                             ('checkov', None): ['checkov', '--version'],
+                             ('opa', None): ['opa', 'version'],
+                             ('pulumi', None): ['pulumi', 'version'],
+                             ('terraform', work_exec.TERRAFORM_DEFAULT_VERSION): [
+                                 'tenv', 'tf', 'install', work_exec.TERRAFORM_DEFAULT_VERSION
+                             ],
+                             ('terragrunt', '0.60.0'): ['tenv', 'tg', 'install', '0.60.0'],
+                         })
+
+    def test_apply_only_uses_apply_steps(self):
+        tools = tool_prefetch.tools(_state('apply'), work_exec.set_engine_env)
+        self.assertNotIn(('checkov', None), tools)
+        self.assertNotIn(('opa', None), tools)
+
+    def test_installs_use_the_dirspace_env(self):
+        def set_engine_env(env, repo_config, engine, working_dir, path):
+            env['DIRSPACE_PATH'] = path
+            work_exec.set_engine_env(env, repo_config, engine, working_dir, path)
+
+        tools = tool_prefetch.tools(_state('plan'), set_engine_env)
+        (_, env) = tools[('checkov', None)]
+        self.assertEqual(env['DIRSPACE_PATH'], '/tmp/infra')
+        (_, env) = tools[('opa', None)]
+        self.assertNotIn('DIRSPACE_PATH', env)
+
+    def test_step_tool_version_is_in_the_key(self):
+        # Dirspaces asking for different versions of a tool each get theirs
+        # installed.
+        def set_engine_env(env, repo_config, engine, working_dir, path):
+            env['CHECKOV_VERSION'] = os.path.basename(path)
+            work_exec.set_engine_env(env, repo_config, engine, working_dir, path)
+
+        state = _state('plan')
+        state = state._replace(work_manifest=dict(state.work_manifest, changed_dirspaces=[
+            {'path': 'infra', 'workspace': 'default', 'workflow': 0},
+            {'path': 'infra2', 'workspace': 'default', 'workflow': 0},
+        ]))
+        tools = tool_prefetch.tools(state, set_engine_env)
+        self.assertIn(('checkov', 'infra'), tools)
+        self.assertIn(('checkov', 'infra2'), tools)
+        self.assertEqual(tools[('checkov', 'infra2')][1]['CHECKOV_VERSION'], 'infra2')
+
+    def test_engine_tool_version_is_in_the_key(self):
+        env = {'STATEGRAPH_VERSION': '1.2.3'}
+        self.assertEqual(tool_prefetch._engine_tools(env, {'name': 'stategraph'}),
+                         {('stategraph', '1.2.3'): (['stategraph', '--version'], env)})
+
+
+class PrepareTest(unittest.TestCase):
+    def test_failing_tools_is_only_logged(self):
+        state = _state('plan')
+        state = state._replace(env=dict(state.env, TERRATEAM_TOOL_PREFETCH='true'))
+        with unittest.mock.patch('tool_prefetch.tools', side_effect=KeyError('workflow')), \
+                self.assertLogs(level='WARNING') as logs:
+            tool_prefetch.prepare(state, work_exec.set_engine_env)
+        self.assertIn('PREFETCH : TOOLS : FAILED', logs.output[0])
+
+
+class ToolCacheTest(unittest.TestCase):
+    def test_only_exact_engine_versions_are_cached(self):
+        env = {'TERRATEAM_TOOL_CACHE': '/cache'}
+        self.assertTrue(tool_prefetch._cacheable(env, ('terraform', '1.5.7')))
+        self.assertTrue(tool_prefetch._cacheable(env, ('tofu', '1.9.0-rc1')))
+        self.assertFalse(tool_prefetch._cacheable(env, ('terraform', '~> 1.5')))
+        self.assertFalse(tool_prefetch._cacheable(env, ('opa', None)))
+        self.assertFalse(tool_prefetch._cacheable({}, ('terraform', '1.5.7')))
+
+    def test_installed_versions_are_skipped(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state = _state('plan')
+            state = state._replace(env=dict(state.env,
+                                            TENV_ROOT=tmpdir,
+                                            TERRATEAM_TOOL_CACHE=os.path.join(tmpdir, 'cache')))
+            binary = tool_prefetch._tenv_binary(state.env, 'tofu', '1.9.0')
+            self.assertEqual(binary, os.path.join(tmpdir, 'OpenTofu', '1.9.0', 'tofu'))
+            os.makedirs(os.path.dirname(binary))
+            open(binary, 'w').close()
+
+            needed = {('tofu', '1.9.0'): (['tenv', 'tofu', 'install', '1.9.0'], state.env),
+                      ('opa', None): (['opa', 'version'], state.env)}
+            self.assertEqual(tool_prefetch._from_tool_cache(state, needed),
+                             {('opa', None): (['opa', 'version'], state.env)})
+
+
+if __name__ == '__main__':
+    unittest.main()
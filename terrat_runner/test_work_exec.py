@@ -0,0 +1,120 @@
+import unittest
+import unittest.mock
+
+import run_state
+import work_exec
+
+
+class Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class Runtime:
+    def extract_secrets(self, s):
+        return [line[len('::add-mask::'):] for line in s.splitlines()
+                if line.startswith('::add-mask::')]
+
+
+def state(capabilities):
+    return run_state.create(api_base_url='https://app.terrateam.io',
+                            api_token='token-abc',
+                            repo_config={},
+                            result_version=2,
+                            runtime=Runtime(),
+                            env={},
+                            sha='deadbeef',
+                            work_manifest={'capabilities': capabilities,
+                                           'changed_dirspaces': []},
+                            work_token='wm-123',
+                            working_dir='/tmp')
+
+
+def step(text, gates=None):
+    return {'step': 'run', 'payload': {'text': text}, 'gates': gates}
+
+
+class ResultStreamTest(unittest.TestCase):
+    def run_stream(self, capabilities, status_codes, pieces, env=None, secrets=()):
+        """Add each of [pieces], a list of steps and the secrets of the dirspace
+        they are from, and finish.  Returns the final results and the body of
+        every POST, in order."""
+        st = state(capabilities)._replace(env=env or {})
+        posted = []
+
+        def post(state, path, json):
+            posted.append(json)
+            return Response(status_codes.pop(0))
+
+        with unittest.mock.patch('api.work_manifest_post', side_effect=post):
+            stream = work_exec._ResultStream(st)
+            for (p, piece_secrets) in pieces:
+                stream.add(st, p, set(piece_secrets))
+            results = stream.finish(st._replace(secrets=set(secrets)),
+                                    {'steps': [s for (p, _) in pieces for s in p],
+                                     'gates': ['g']})
+        return (results, posted)
+
+    def test_pieces_are_sent_as_they_are_added(self):
+        st = state(['incremental-results'])
+        with unittest.mock.patch('api.work_manifest_post',
+                                 return_value=Response(200)) as post:
+            stream = work_exec._ResultStream(st)
+            stream.add(st, [step('a')])
+            self.assertEqual(post.call_count, 1)
+            stream.add(st, [step('b')])
+            self.assertEqual(post.call_count, 2)
+        self.assertEqual([c.kwargs['json']['piece'] for c in post.call_args_list], [0, 1])
+
+    def test_sent_steps_are_not_in_final_results(self):
+        (results, posted) = self.run_stream(['incremental-results'],
+                                            [200, 500],
+                                            [([step('a', gates=['g'])], ()), ([step('b')], ())])
+        self.assertEqual(len(posted), 2)
+        self.assertNotIn('gates', posted[0]['steps'][0])
+        self.assertEqual([s['payload']['text'] for s in results['steps']], ['b'])
+        # Gates are only sent with the final results.
+        self.assertEqual(results['gates'], ['g'])
+
+    def test_not_supported_by_server(self):
+        (results, posted) = self.run_stream(['incremental-results'],
+                                            [404],
+                                            [([step('a')], ()), ([step('b')], ())])
+        self.assertEqual(len(posted), 1)
+        self.assertEqual(len(results['steps']), 2)
+
+    def test_no_capability(self):
+        (results, posted) = self.run_stream([], [], [([step('a')], ())])
+        self.assertEqual(posted, [])
+        self.assertEqual(len(results['steps']), 1)
+
+    def test_known_secrets_are_masked(self):
+        (_, posted) = self.run_stream(['incremental-results'],
+                                      [200, 200],
+                                      [([step('::add-mask::hunter2')], ()),
+                                       ([step('pw=hunter2 key=oidc-key')], ('oidc-key',))])
+        self.assertEqual(posted[1]['steps'][0]['payload']['text'], 'pw=*** key=***')
+
+    def test_pieces_with_later_secrets_are_sent_again(self):
+        (results, posted) = self.run_stream(['incremental-results'],
+                                            [200, 200, 200],
+                                            [([step('pw=hunter2')], ()),
+                                             ([step('key=abc')], ())],
+                                            secrets={'hunter2'})
+        self.assertEqual([p['piece'] for p in posted], [0, 1, 0])
+        self.assertEqual(posted[0]['steps'][0]['payload']['text'], 'pw=hunter2')
+        self.assertEqual(posted[2]['steps'][0]['payload']['text'], 'pw=***')
+        self.assertEqual(results['steps'], [])
+
+    def test_run_budget_covers_all_pieces(self):
+        (_, posted) = self.run_stream(['incremental-results'],
+                                      [200, 200],
+                                      [([step('a' * 100)], ()), ([step('b' * 100)], ())],
+                                      env={'TERRATEAM_OUTPUT_RUN_BUDGET_BYTES': '150'})
+        sizes = [len(p['steps'][0]['payload']['text']) for p in posted]
+        self.assertEqual(sizes[0], 100)
+        self.assertLess(sizes[1], 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
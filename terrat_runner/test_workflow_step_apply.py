@@ -0,0 +1,71 @@
+import base64
+import json
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import plan_cache
+import run_state
+import workflow_step_apply
+
+
+def _response(plan_data):
+    res = unittest.mock.Mock(status_code=200)
+    res.json.return_value = {
+        'data': base64.b64encode(json.dumps(plan_data).encode('utf-8')).decode('utf-8')
+    }
+    return res
+
+
+def _fetch(contents):
+    def _f(state, plan_data, plan_path):
+        with open(plan_path, 'wb') as f:
+            f.write(contents)
+        return True
+    return _f
+
+
+class LoadPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.plan_path = os.path.join(self.tmpdir.name, 'plan')
+        self.state = run_state.create(
+            api_base_url='https://app.terrateam.io',
+            api_token='token-abc',
+            repo_config={},
+            result_version=2,
+            runtime=None,
+            env={plan_cache.ENV_NAME: os.path.join(self.tmpdir.name, 'plans')},
+            sha='deadbeef',
+            work_manifest={},
+            work_token='wm-123',
+            working_dir='/tmp')
+        with open(self.plan_path, 'wb') as f:
+            f.write(b'stored plan')
+        self.plan_data = {'method': 'cmd',
+                          'fetch': ['fetch'],
+                          'sha256': plan_cache.digest(self.plan_path)}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def load(self, contents):
+        with unittest.mock.patch('api.work_manifest_get', return_value=_response(self.plan_data)), \
+                unittest.mock.patch('workflow_step_apply._fetch_plan_cmd', _fetch(contents)), \
+                unittest.mock.patch('workflow_step_apply._delete_plan_cmd'):
+            return workflow_step_apply._load_plan(self.state, 'dir', 'default', self.plan_path)
+
+    def test_matching_plan_is_cached(self):
+        self.assertEqual(self.load(b'stored plan'), (True, None))
+        self.assertTrue(plan_cache.get(self.state.env, self.plan_data['sha256'], self.plan_path))
+
+    def test_mismatched_plan_fails(self):
+        (success, output) = self.load(b'some other plan')
+        self.assertFalse(success)
+        self.assertIn('does not match', output)
+        self.assertFalse(plan_cache.get(self.state.env, self.plan_data['sha256'], self.plan_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,313 @@
+import datetime
+import json
+import os
+import subprocess
+import tempfile
+import unittest
+import unittest.mock
+
+import yaml
+
+import infracost
+import run_state
+import work_plan
+import workflow_step_infracost_setup as infracost_setup
+
+
+def _state(env, tmpdir):
+    return run_state.create(api_base_url='https://app.terrateam.io',
+                            api_token='token-abc',
+                            repo_config={},
+                            result_version=2,
+                            runtime=None,
+                            env=env,
+                            sha='deadbeef',
+                            work_manifest={'changed_dirspaces': [{'path': 'app',
+                                                                  'workspace': 'default'}]},
+                            work_token='wm-123',
+                            working_dir='/tmp')._replace(tmpdir=tmpdir)
+
+
+class BreakdownTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.breakdown = os.path.join(self.tmpdir.name, 'breakdown.json')
+        with open(self.breakdown, 'w') as f:
+            json.dump({'currency': 'USD',
+                       'timeGenerated': '2024-01-01T00:00:00Z',
+                       'totalMonthlyCost': '30',
+                       'projects': [{'name': 'app:default',
+                                     'metadata': {'path': '/work/app'}},
+                                    {'name': 'db:prod',
+                                     'metadata': {'path': '/work/db'}}]},
+                      f)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_split_and_join(self):
+        split = infracost_setup._split_breakdown(self.breakdown,
+                                                 os.path.join(self.tmpdir.name, 'split'))
+        self.assertEqual(sorted(split), ['app:default', 'db:prod'])
+
+        with open(split['db:prod']) as f:
+            db = json.load(f)
+        self.assertEqual(db['timeGenerated'], '2024-01-01T00:00:00Z')
+        self.assertEqual([p['name'] for p in db['projects']], ['db:prod'])
+
+        joined = os.path.join(self.tmpdir.name, 'joined.json')
+        infracost_setup._join_breakdowns([split['db:prod'], split['app:default']], joined)
+        with open(joined) as f:
+            self.assertEqual([p['name'] for p in json.load(f)['projects']],
+                             ['db:prod', 'app:default'])
+
+    def test_set_project_path(self):
+        infracost_setup._set_project_path(self.breakdown, '/other/app')
+        with open(self.breakdown) as f:
+            self.assertEqual([p['metadata']['path'] for p in json.load(f)['projects']],
+                             ['/other/app', '/other/app'])
+
+
+class BaseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def create_base(self, working_dir):
+        state = _state({'TERRATEAM_INFRACOST_CACHE_DIR': os.path.join(self.tmpdir.name, 'cache')},
+                       self.tmpdir.name)._replace(working_dir=working_dir)
+        infracost_json = os.path.join(self.tmpdir.name, 'prev.json')
+
+        def _create_base_infracost(state, infracost_dir, infracost_json, dirspaces, named):
+            with open(infracost_json, 'w') as f:
+                json.dump({'timeGenerated': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                           'projects': [{'name': 'app:default',
+                                         'metadata': {'path': os.path.join(working_dir, 'app')}}]},
+                          f)
+
+        with unittest.mock.patch('workflow_step_infracost_setup._base_cache_key',
+                                 return_value='key'), \
+                unittest.mock.patch('workflow_step_infracost_setup._create_base_infracost',
+                                    side_effect=_create_base_infracost) as create:
+            infracost_setup._create_base(state,
+                                         {'currency': 'USD'},
+                                         self.tmpdir.name,
+                                         infracost_json,
+                                         [{'path': 'app', 'workspace': 'default'}],
+                                         named=True,
+                                         worktree=False)
+        with open(infracost_json) as f:
+            return (create.call_count, json.load(f)['projects'][0]['metadata']['path'])
+
+    def test_cached_paths_are_moved_to_the_working_dir(self):
+        self.assertEqual(self.create_base('/runner-1/repo'), (1, '/runner-1/repo/app'))
+        self.assertEqual(self.create_base('/runner-2/repo'), (0, '/runner-2/repo/app'))
+
+    def test_projects_are_named_when_cached(self):
+        state = _state({'TERRATEAM_INFRACOST_CACHE_DIR': os.path.join(self.tmpdir.name, 'cache')},
+                       self.tmpdir.name)._replace(
+                           work_manifest={'dirspaces': [], 'base_dirspaces': []})
+        with unittest.mock.patch('workflow_step_infracost_setup._create_base') as create_base, \
+                unittest.mock.patch('workflow_step_infracost_setup._create_head_infracost',
+                                    return_value='') as create_head:
+            infracost_setup._create_infracost(state, {'currency': 'USD'}, self.tmpdir.name,
+                                              'prev.json', 'curr.json')
+        self.assertTrue(create_base.call_args.kwargs['named'])
+        self.assertTrue(create_head.call_args.kwargs['named'])
+
+
+class IncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.breakdowns = {}
+        self.outputs = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _run_retry(self, state, c):
+        args = dict(a[2:].split('=', 1) for a in c[2:] if '=' in a)
+        if c[1] == 'breakdown':
+            with open(args['config-file']) as f:
+                projects = yaml.safe_load(f)['projects']
+            self.breakdowns[os.path.basename(args['config-file'])] = sorted(
+                p['name'] for p in projects)
+            with open(args['out-file'], 'w') as f:
+                json.dump({'projects': [{'name': p['name'], 'metadata': {'path': p['path']}}
+                                        for p in projects]},
+                          f)
+        else:
+            self.outputs.append([os.path.basename(a[len('--path='):])
+                                 for a in c if a.startswith('--path=')])
+        return ''
+
+    def price(self, modules_changed):
+        def ds(path):
+            return {'path': path, 'workspace': 'default'}
+
+        state = _state({'TERRATEAM_INFRACOST_INCREMENTAL': 'true'}, self.tmpdir.name)._replace(
+            working_dir=self.tmpdir.name,
+            work_manifest={'base_ref': 'main',
+                           'changed_dirspaces': [ds('changed')],
+                           'dirspaces': [ds('changed'), ds('unchanged'), ds('uses-module')],
+                           'base_dirspaces': [ds('changed'),
+                                              ds('unchanged'),
+                                              ds('uses-module'),
+                                              ds('base-only')]})
+
+        with unittest.mock.patch('workflow_step_infracost_setup._run_retry', self._run_retry), \
+                unittest.mock.patch('workflow_step_infracost_setup._modules_changed',
+                                    return_value=modules_changed), \
+                unittest.mock.patch('workflow_step_infracost_setup._checkout_base',
+                                    return_value='head'), \
+                unittest.mock.patch('subprocess.check_call'), \
+                unittest.mock.patch('subprocess.call'):
+            infracost_setup._create_infracost(state,
+                                              {'currency': 'USD'},
+                                              self.tmpdir.name,
+                                              os.path.join(self.tmpdir.name, 'prev.json'),
+                                              os.path.join(self.tmpdir.name, 'curr.json'))
+
+    def test_dirspaces_priced_on_each_side(self):
+        self.price(set())
+        self.assertEqual(self.breakdowns,
+                         {'config.yml': ['changed:default'],
+                          'config-unchanged.yml': ['unchanged:default', 'uses-module:default'],
+                          'config-base.yml': ['base-only:default', 'changed:default']})
+        self.assertEqual(self.outputs,
+                         [['infracost-changed.json', 'infracost-unchanged-all.json'],
+                          ['infracost-prev-changed.json', 'infracost-unchanged-all.json']])
+
+    def test_dirspaces_with_changed_modules_are_priced_on_both_sides(self):
+        self.price(set([('uses-module', 'default')]))
+        self.assertEqual(self.breakdowns,
+                         {'config.yml': ['changed:default', 'uses-module:default'],
+                          'config-unchanged.yml': ['unchanged:default'],
+                          'config-base.yml': ['base-only:default',
+                                              'changed:default',
+                                              'uses-module:default']})
+
+
+class ModulesChangedTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.git('init', '-q', '-b', 'main')
+        self.write('app/main.tf', 'module "vpc" {\n  source = "../modules/vpc"\n}\n')
+        self.write('modules/vpc/main.tf', '')
+        self.write('other/main.tf', '')
+        self.commit('base')
+        self.git('update-ref', 'refs/remotes/origin/main', 'HEAD')
+        self.write('modules/vpc/main.tf', '# changed\n')
+        self.commit('head')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def git(self, *args):
+        subprocess.check_call(['git'] + list(args), cwd=self.tmpdir.name)
+
+    def write(self, path, content):
+        path = os.path.join(self.tmpdir.name, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def commit(self, message):
+        self.git('add', '.')
+        self.git('-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                 'commit', '-q', '-m', message)
+
+    def test_dirspaces_using_a_changed_module(self):
+        state = _state({}, self.tmpdir.name)._replace(working_dir=self.tmpdir.name,
+                                                      work_manifest={'base_ref': 'main'})
+        dirspaces = [{'path': p, 'workspace': 'default'} for p in ['app', 'other', '.']]
+        self.assertEqual(infracost_setup._modules_changed(state, dirspaces),
+                         set([('app', 'default'), ('.', 'default')]))
+
+
+class FromPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_hook_moves_to_post_hooks(self):
+        state = _state({'TERRATEAM_INFRACOST_FROM_PLAN': 'true'}, self.tmpdir.name)
+        self.assertEqual([h['type'] for h in work_plan.Exec().post_hooks(state)],
+                         ['infracost_setup'])
+        self.assertTrue(work_plan.Exec().post_hooks(state)[0]['plan_json'])
+
+    def test_projects_are_mapped_to_their_dirspaces(self):
+        state = _state({'TERRATEAM_INFRACOST_FROM_PLAN': 'true'}, self.tmpdir.name)._replace(
+            work_manifest={'changed_dirspaces': [{'path': 'infra/app', 'workspace': 'prod'}]})
+        plan_json = os.path.join(infracost_setup._plan_json_dir(state),
+                                 infracost.json_filename_of_dirspace(
+                                     state.work_manifest['changed_dirspaces'][0]))
+        os.makedirs(os.path.dirname(plan_json))
+        with open(plan_json, 'w') as f:
+            json.dump({}, f)
+
+        def _run_retry(state, c):
+            out = [a for a in c if a.startswith('--out-file=')][0][len('--out-file='):]
+            cost = {'totalMonthlyCost': '10'}
+            with open(out, 'w') as f:
+                # Infracost reports the plan file as the path of the project.
+                json.dump({'currency': 'USD',
+                           'pastTotalMonthlyCost': '0',
+                           'totalMonthlyCost': '10',
+                           'diffTotalMonthlyCost': '10',
+                           'projects': [{'name': 'infra/app:prod',
+                                         'metadata': {'path': plan_json},
+                                         'pastBreakdown': {'totalMonthlyCost': '0'},
+                                         'breakdown': cost,
+                                         'diff': cost}]},
+                          f)
+            return ''
+
+        with unittest.mock.patch('workflow_step_infracost_setup._configure_infracost'), \
+                unittest.mock.patch('workflow_step_infracost_setup._run_retry', _run_retry):
+            result = infracost_setup.run(state, {'plan_json': True})
+
+        self.assertTrue(result.success)
+        self.assertEqual([(d['dir'], d['workspace'], d['total_monthly_cost'])
+                          for d in result.payload['dirspaces']],
+                         [('infra/app', 'prod', 10.0)])
+
+    def test_no_plans(self):
+        state = _state({'TERRATEAM_INFRACOST_FROM_PLAN': 'true'}, self.tmpdir.name)
+        (output, _) = infracost_setup._create_diff_from_plans(
+            state,
+            self.tmpdir.name,
+            os.path.join(self.tmpdir.name, 'diff.json'))
+        self.assertIsNone(output)
+
+
+class BaseRefTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.git('init', '-q', '-b', 'main')
+        self.git('-c', 'user.name=test', '-c', 'user.email=test@example.com',
+                 'commit', '-q', '--allow-empty', '-m', 'base')
+        self.state = _state({}, self.tmpdir.name)._replace(
+            working_dir=self.tmpdir.name,
+            work_manifest={'base_ref': 'main', 'changed_dirspaces': []})
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def git(self, *args):
+        subprocess.check_call(['git'] + list(args), cwd=self.tmpdir.name)
+
+    def test_local_branch_without_remote(self):
+        self.assertEqual(infracost_setup._base_ref(self.state), 'main')
+
+    def test_remote_branch_is_preferred(self):
+        self.git('update-ref', 'refs/remotes/origin/main', 'HEAD')
+        self.assertEqual(infracost_setup._base_ref(self.state), 'refs/remotes/origin/main')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import base64
+import json
+import os
+import tempfile
+import time
+import unittest
+import unittest.mock
+
+import credential_cache
+import run_state
+import workflow_step_oidc
+
+
+def _jwt(claims):
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode('utf-8')).rstrip(b'=')
+    return 'header.{}.signature'.format(payload.decode('utf-8'))
+
+
+class OidcTest(unittest.TestCase):
+    def test_id_token_reused_for_half_its_life(self):
+        token = _jwt({'iat': 1000, 'exp': 1600})
+        self.assertEqual(workflow_step_oidc._id_token_expires_at(token), 1300)
+
+    def test_malformed_id_token_is_not_reused(self):
+        self.assertLessEqual(workflow_step_oidc._id_token_expires_at('not-a-jwt'),
+                             workflow_step_oidc.time.time())
+
+
+    def test_aws_caches_credentials_but_not_the_id_token(self):
+        tokens = iter(['id-token-1', 'id-token-2'])
+        creds = {'access_key_id': 'key',
+                 'secret_access_key': 'secret',
+                 'session_token': 'session',
+                 'expires_at': time.time() + 3600}
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state = run_state.create(api_base_url='https://app.terrateam.io',
+                                     api_token='token-abc',
+                                     repo_config={},
+                                     result_version=2,
+                                     runtime=unittest.mock.Mock(),
+                                     env={'TERRATEAM_TMPDIR': tmpdir,
+                                          credential_cache.ENV_NAME: os.path.join(tmpdir, 'creds')},
+                                     sha='deadbeef',
+                                     work_manifest={},
+                                     work_token='wm-123',
+                                     working_dir='/tmp')
+            config = {'role_arn': 'arn:aws:iam::123:role/test', 'assume_role_enabled': False}
+
+            with unittest.mock.patch('workflow_step_oidc._fetch_id_token',
+                                     lambda state, audience: next(tokens)), \
+                    unittest.mock.patch('workflow_step_oidc._assume_role_with_web_identity',
+                                        return_value=creds) as assume:
+                workflow_step_oidc.run_aws(state, config)
+                result = workflow_step_oidc.run_aws(state, config)
+
+            self.assertEqual(assume.call_count, 1)
+            self.assertEqual(result.state.env['AWS_SESSION_TOKEN'], 'session')
+            with open(os.path.join(tmpdir, 'aws_oidc_token_file')) as f:
+                self.assertEqual(f.read(), 'id-token-2')
+
+
+if __name__ == '__main__':
+    unittest.main()
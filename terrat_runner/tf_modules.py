@@ -0,0 +1,53 @@
+# Local modules used by Terraform, OpenTofu and Terragrunt dirs.
+#
+# Modules are found from `source = "./..."` and `source = "../..."` in the
+# files of a dir, so this only sees local sources written as plain strings,
+# not ones computed from variables.
+import os
+import re
+
+
+SOURCE_RE = re.compile(r'\bsource\s*=\s*"(\.\.?/[^"]*)"')
+FILE_SUFFIXES = ('.tf', '.tofu', '.hcl')
+
+
+def module_dirs(working_dir, path):
+    """Return the local module sources of the files in [path], as paths
+    relative to [working_dir]."""
+    deps = set()
+    try:
+        names = os.listdir(os.path.join(working_dir, path))
+    except OSError:
+        return deps
+
+    for name in names:
+        if not name.endswith(FILE_SUFFIXES):
+            continue
+
+        try:
+            with open(os.path.join(working_dir, path, name)) as f:
+                content = f.read()
+        except (OSError, UnicodeDecodeError):
+            continue
+
+        for source in SOURCE_RE.findall(content):
+            # A '//' separates the directory that is copied from the
+            # subdirectory of it that is used.
+            dep = os.path.normpath(os.path.join(path, source.split('//')[0]))
+            if dep != '.' and not dep.startswith('..'):
+                deps.add(dep)
+
+    return deps
+
+
+def closure(working_dir, paths):
+    """Return [paths] and every directory their modules come from, transitively,
+    as far as the files in [working_dir] show."""
+    seen = set()
+    todo = [os.path.normpath(p) for p in paths]
+    while todo:
+        path = todo.pop()
+        if path not in seen:
+            seen.add(path)
+            todo.extend(module_dirs(working_dir, path) - seen)
+    return sorted(seen)
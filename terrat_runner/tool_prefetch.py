@@ -0,0 +1,253 @@
+# Install the tools a run needs before any dirspace runs.
+#
+# The engine binaries are installed by tenv, and the tools used by steps and
+# integrations by the wrappers in proxy/bin, on first use and behind a lock.
+# With several dirspaces running at once, all but one of them wait on the lock
+# while a tool downloads, and each tool downloads in turn.  Instead, the
+# workflows of the changed dirspaces are walked for the engine versions and
+# tools they use, and those are installed concurrently up front.  A tool that
+# fails to install is only logged, it is installed again on first use.
+#
+# With TERRATEAM_TOOL_CACHE, the engine versions are also kept in the tool
+# cache (see bin/terrateam-tool-cache), which the wrappers use for their tools,
+# so they are installed up front even without TERRATEAM_TOOL_PREFETCH.
+import concurrent.futures
+import logging
+import os
+import re
+import time
+
+import cmd
+import repo_config as rc
+
+
+CONCURRENCY = 4
+
+# Engines that run a tf_cmd.
+TF_ENGINES = ['cdktf', 'stategraph', 'terraform', 'terragrunt', 'tofu']
+
+# The tf_cmds installed by tenv, by the name tenv gives them and the
+# environment variable set_engine_env puts their version in.
+TENV_TOOLS = {
+    'terraform': ('tf', 'TFENV_TERRAFORM_DEFAULT_VERSION'),
+    'tofu': ('tofu', 'TOFUENV_TOFU_DEFAULT_VERSION'),
+}
+
+# Where tenv installs each tool under its root, and the name of the binary.
+TENV_DIRS = {
+    'terraform': ('Terraform', 'terraform'),
+    'terragrunt': ('Terragrunt', 'terragrunt'),
+    'tofu': ('OpenTofu', 'tofu'),
+}
+
+# Only exact versions can be cached, not constraints.
+EXACT_VERSION = re.compile(r'^\d+\.\d+\.\d+([-+][0-9A-Za-z.-]+)?$')
+
+# Commands that make a wrapper in proxy/bin install its tool, by step type and
+# by engine name.
+STEP_TOOLS = {
+    'checkov': ['checkov', '--version'],
+    'conftest': ['conftest', '--version'],
+    'opa': ['opa', 'version'],
+}
+
+# The environment variable a step tool's wrapper reads its version from.
+STEP_TOOL_VERSIONS = {
+    'checkov': 'CHECKOV_VERSION',
+    'conftest': 'CONFTEST_VERSION',
+    'opa': 'OPA_VERSION',
+}
+
+ENGINE_TOOLS = {
+    'fly': ['flyctl', 'version'],
+    'pulumi': ['pulumi', 'version'],
+    'stategraph': ['stategraph', '--version'],
+}
+
+# The environment variable an engine tool's wrapper reads its version from.
+ENGINE_TOOL_VERSIONS = {
+    'stategraph': 'STATEGRAPH_VERSION',
+}
+
+
+def enabled(env):
+    return env.get('TERRATEAM_TOOL_PREFETCH', '').lower() in ('1', 'true')
+
+
+def tool_cache(env):
+    return env.get('TERRATEAM_TOOL_CACHE')
+
+
+def _concurrency(env):
+    return int(env.get('TERRATEAM_TOOL_PREFETCH_CONCURRENCY', CONCURRENCY))
+
+
+def _hooks(state):
+    if state.work_manifest['type'] == 'plan':
+        hooks = rc.get_plan_hooks(state.repo_config)
+    else:
+        hooks = rc.get_apply_hooks(state.repo_config)
+
+    all_hooks = rc.get_all_hooks(state.repo_config)
+    return all_hooks['pre'] + all_hooks['post'] + hooks['pre'] + hooks['post']
+
+
+def _step_tools(env, steps):
+    return {(s['type'], env.get(STEP_TOOL_VERSIONS[s['type']])): (STEP_TOOLS[s['type']], env)
+            for s in steps
+            if s.get('type') in STEP_TOOLS}
+
+
+def _engine_tools(env, engine):
+    tools = {}
+    tf_cmd = env.get('TERRATEAM_TF_CMD')
+    if engine['name'] in TF_ENGINES and tf_cmd in TENV_TOOLS:
+        (name, version_env) = TENV_TOOLS[tf_cmd]
+        if env.get(version_env):
+            tools[(tf_cmd, env[version_env])] = (['tenv', name, 'install', env[version_env]], env)
+
+    if engine['name'] == 'terragrunt':
+        version = env.get('TG_VERSION') or env.get('TG_DEFAULT_VERSION')
+        if version:
+            tools[('terragrunt', version)] = (['tenv', 'tg', 'install', version], env)
+
+    if engine['name'] in ENGINE_TOOLS:
+        version_env = ENGINE_TOOL_VERSIONS.get(engine['name'])
+        version = env.get(version_env) if version_env else None
+        tools[(engine['name'], version)] = (ENGINE_TOOLS[engine['name']], env)
+
+    return tools
+
+
+def tools(state, set_engine_env):
+    """Return a map of (tool, version) to the command that installs it and the
+    environment to run it in, for every tool the changed dirspaces need.
+    [set_engine_env] configures the environment for an engine, which picks the
+    engine versions."""
+    ret = {}
+    # Hooks run with the engine of the repo.
+    ret.update(_engine_tools(state.env, rc.get_engine(state.repo_config)))
+    ret.update(_step_tools(state.env, _hooks(state)))
+
+    for d in state.work_manifest['changed_dirspaces']:
+        workflow = rc.get_dirspace_workflow(state.repo_config, d)
+        env = state.env.copy()
+        set_engine_env(env,
+                       state.repo_config,
+                       workflow['engine'],
+                       state.working_dir,
+                       os.path.join(state.working_dir, d['path']))
+        ret.update(_engine_tools(env, workflow['engine']))
+
+        if state.work_manifest['type'] == 'plan':
+            ret.update(_step_tools(env, workflow['plan']))
+        else:
+            ret.update(_step_tools(env, workflow['apply']))
+
+        if (state.work_manifest['type'] == 'plan'
+                and workflow['integrations']['resourcely']['enabled']
+                and env.get('RESOURCELY_VERSION')):
+            ret[('resourcely-cli', env['RESOURCELY_VERSION'])] = (['resourcely-cli', '--version'],
+                                                                  env)
+
+    return ret
+
+
+def _tenv_binary(env, tool, version):
+    (dirname, binary) = TENV_DIRS[tool]
+    root = env.get('TENV_ROOT', os.path.join(os.path.expanduser('~'), '.tenv'))
+    return os.path.join(root, dirname, version, binary)
+
+
+def _cacheable(env, key):
+    (tool, version) = key
+    return (bool(tool_cache(env))
+            and tool in TENV_DIRS
+            and version is not None
+            and EXACT_VERSION.match(version) is not None)
+
+
+def _tool_cache_cmd(state, op, key):
+    (tool, version) = key
+    (proc, _, _) = cmd.run_with_output(
+        state,
+        {
+            'cmd': ['terrateam-tool-cache', op, tool, version,
+                    _tenv_binary(state.env, tool, version)],
+            'log_output': False,
+        })
+    return proc.returncode == 0
+
+
+def _from_tool_cache(state, needed):
+    # Leave out the engine versions that are installed or in the tool cache.
+    ret = {}
+    for (key, (c, env)) in needed.items():
+        if not _cacheable(env, key):
+            ret[key] = (c, env)
+        elif os.path.exists(_tenv_binary(env, *key)):
+            logging.info('TOOL_CACHE : %s : %s : INSTALLED', *key)
+        elif _tool_cache_cmd(state._replace(env=env), 'get', key):
+            logging.info('TOOL_CACHE : %s : %s : HIT', *key)
+        else:
+            logging.info('TOOL_CACHE : %s : %s : MISS', *key)
+            ret[key] = (c, env)
+
+    return ret
+
+
+def _install(state, key, c, env):
+    # Wrappers and tenv read the version to install from the environment of
+    # the dirspace that needs it.
+    state = state._replace(env=env)
+    start = time.monotonic()
+    (proc, stdout, stderr) = cmd.run_with_output(state, {'cmd': c, 'log_output': False})
+    if (proc.returncode == 0
+            and _cacheable(state.env, key)
+            and os.path.exists(_tenv_binary(state.env, *key))):
+        _tool_cache_cmd(state, 'put', key)
+
+    return (proc.returncode == 0, time.monotonic() - start, '\n'.join([stderr, stdout]))
+
+
+def prepare(state, set_engine_env):
+    if not enabled(state.env) and not tool_cache(state.env):
+        return
+
+    start = time.monotonic()
+    try:
+        needed = tools(state, set_engine_env)
+    except Exception as exn:
+        # Every tool is still installed on first use.
+        logging.warning('PREFETCH : TOOLS : FAILED : %s', exn)
+        return
+
+    if not enabled(state.env):
+        needed = {key: c for (key, c) in needed.items() if key[0] in TENV_DIRS}
+
+    logging.info('PREFETCH : TOOLS : %s',
+                 ', '.join('{}={}'.format(t, v or '') for (t, v) in sorted(needed, key=str)))
+
+    needed = _from_tool_cache(state, needed)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_concurrency(state.env)) as pool:
+        futures = {pool.submit(_install, state, key, c, env): key
+                   for (key, (c, env)) in needed.items()}
+        for future in concurrent.futures.as_completed(futures):
+            (name, version) = futures[future]
+            try:
+                (success, duration, output) = future.result()
+            except Exception as exn:
+                logging.warning('PREFETCH : %s : %s : FAILED : %s', name, version, exn)
+                continue
+
+            if success:
+                logging.info('PREFETCH : %s : %s : %.2fs', name, version, duration)
+            else:
+                logging.warning('PREFETCH : %s : %s : FAILED : %.2fs : %s',
+                                name,
+                                version,
+                                duration,
+                                output)
+
+    logging.info('PREFETCH : TOTAL : installed=%d : %.2fs', len(needed), time.monotonic() - start)
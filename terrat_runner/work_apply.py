@@ -79,6 +79,8 @@ class Exec(work_exec.ExecInterface):
                 state.working_dir,
                 os.path.join(state.working_dir, path))
 
+            work_exec.set_data_dir_env(env, workflow['engine'], tmpdir)
+
             state = state._replace(env=env,
                                    engine=work_exec.convert_engine(workflow['engine']))
 
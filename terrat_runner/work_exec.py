@@ -5,6 +5,7 @@ import os
 import tempfile
 
 import api
+import credential_cache
 import dir_exec
 import engine_cdktf
 import engine_custom
@@ -14,15 +15,25 @@ import engine_stategraph
 import engine_terragrunt
 import engine_tf
 import hooks
+import output_budget
+import plugin_cache
+import provider_mirror
 import repo_config as rc
 import results_compat
 import run_state
+import secret_mask
+import tool_prefetch
 
 
 TOFU_DEFAULT_VERSION = '1.9.0'
 TERRAFORM_DEFAULT_VERSION = '1.5.7'
 TERRAGRUNT_DEFAULT_VERSION = '0.75.3'
 
+# Engines which keep all of their per-run state in TF_DATA_DIR (and, for
+# terragrunt, its download dir), so that giving each dirspace its own data dir
+# lets the workspaces of a dir run at the same time.
+ISOLATED_DATA_DIR_ENGINES = ['terraform', 'tofu', 'terragrunt']
+
 
 class ExecInterface(abc.ABC):
     @abc.abstractmethod
@@ -128,35 +139,27 @@ def set_engine_env(env, repo_config, engine, repo_root, working_dir):
             version)
 
 
-def _mask_output(secrets, unmasked, output):
-    # If the output exactly matches anything in unmasked then return output
-    # unchanged.
-    if output in unmasked:
-        return output
-    else:
-        for secret in secrets:
-            if secret in output:
-                output = output.replace(secret, '***')
-        return output
+def isolate_data_dirs(env):
+    return env.get('TERRATEAM_ISOLATE_DATA_DIRS', '').lower() in ('1', 'true')
 
 
-# Mask all secrets in value, unless masking it would alter an value in
-# "unmasked"
-def _mask_secrets(secrets, unmasked, value):
-    if isinstance(value, str):
-        return _mask_output(secrets, unmasked, value)
-    elif isinstance(value, dict):
-        ret = {}
-        for k, v in value.items():
-            ret[k] = _mask_secrets(secrets, unmasked, v)
-        return ret
-    elif isinstance(value, list):
-        ret = []
-        for v in value:
-            ret.append(_mask_secrets(secrets, unmasked, v))
-        return ret
-    else:
-        return value
+def _uses_isolated_data_dir(env, engine):
+    return isolate_data_dirs(env) and engine['name'] in ISOLATED_DATA_DIR_ENGINES
+
+
+def set_data_dir_env(env, engine, tmpdir):
+    """Point the engine at a data dir inside the dirspace's [tmpdir] rather
+    than <dir>/.terraform, if data dir isolation is enabled.  The selected
+    workspace is stored in the data dir, so workspace selection is isolated as
+    well.
+
+    """
+    if _uses_isolated_data_dir(env, engine):
+        env['TF_DATA_DIR'] = os.path.join(tmpdir, 'tf-data')
+        if engine['name'] == 'terragrunt':
+            download_dir = os.path.join(tmpdir, 'terragrunt-cache')
+            env['TG_DOWNLOAD_DIR'] = download_dir
+            env['TERRAGRUNT_DOWNLOAD'] = download_dir
 
 
 def _extract_secrets(runtime, value):
@@ -176,21 +179,137 @@ def _extract_secrets(runtime, value):
         return []
 
 
-def _store_results(state, results):
+# The server accepts the results of a run in pieces, see [_ResultStream].
+INCREMENTAL_RESULTS_CAPABILITY = 'incremental-results'
+
+# Responses meaning the server does not support incremental results after all.
+INCREMENTAL_RESULTS_UNSUPPORTED = [404, 405, 501]
+
+
+def _mask_results(state, results, secrets):
     unmasked = set([ds['path'] for ds in state.work_manifest['changed_dirspaces']]
                    + [ds['workspace'] for ds in state.work_manifest['changed_dirspaces']]
                    + [step['step'] for step in results['steps']])
 
-    # Collect any secrets that are in the result output.  Sort the secrets by
-    # longest-first.  This ensures that the longest secret is always matched
-    # first when masking.
-    secrets = _extract_secrets(state.runtime, results)
-    secrets = state.secrets | set(secrets)
-    secrets = sorted(secrets, key=len, reverse=True)
-    results = _mask_secrets(secrets, unmasked, results)
-    results = results_compat.transform(state, results)
-
-    return api.work_manifest_put(state, json=results)
+    # Collect any secrets that are in the result output.
+    masker = secret_mask.Masker(set(secrets) | set(_extract_secrets(state.runtime, results)),
+                                unmasked)
+    # Truncate before masking so that only what is sent is masked.  The text
+    # around each cut is masked first so a secret spanning it is not cut in
+    # half and left partially visible.
+    results = output_budget.apply(state.env, results, masker=masker)
+    return masker.mask_value(results)
+
+
+def _prepare_results(state, results, secrets):
+    return results_compat.transform(state, _mask_results(state, results, secrets))
+
+
+def _store_results(state, results, secrets=frozenset()):
+    return api.work_manifest_put(state,
+                                 json=_prepare_results(state, results, state.secrets | secrets))
+
+
+class _ResultStream:
+    """Send the results of a run in pieces as it goes, one for the pre-hooks
+    and one for each dirspace as soon as its worker finishes, rather than in a
+    single request at the end.
+
+    A piece is masked with the secrets known when it is sent.  A secret found
+    later in the run, by another dirspace or a hook, may be in a piece that was
+    already sent, so once the run is done every sent piece is masked again
+    with all of the secrets and sent again, under the same piece number, if
+    that changes it.  Each piece is cut to what is left of the run's output
+    budget.  Gates are only sent with the final results, as are the steps of
+    pieces that could not be sent, and all steps if the server does not
+    support incremental results.
+
+    """
+    def __init__(self, state):
+        self.enabled = (INCREMENTAL_RESULTS_CAPABILITY in state.work_manifest.get('capabilities', [])
+                        and state.result_version == results_compat.RESULTS_VERSION)
+        self.secrets = set(state.secrets)
+        self.count = 0
+        self.used = 0
+        # (piece number, steps, env the piece was masked with, steps sent)
+        self.sent = []
+
+    def _env(self, env):
+        # Each piece gets what is left of the run's output budget, 0 would
+        # disable the budget.
+        budget = output_budget.run_budget(env)
+        if budget:
+            return dict(env, TERRATEAM_OUTPUT_RUN_BUDGET_BYTES=str(max(1, budget - self.used)))
+        else:
+            return env
+
+    def _mask(self, state, env, steps, secrets):
+        masked = _mask_results(state._replace(env=env), {'steps': steps}, secrets)
+        return [{k: v for (k, v) in s.items() if k != 'gates'} for s in masked['steps']]
+
+    def _post(self, state, piece, steps):
+        try:
+            res = api.work_manifest_post(state,
+                                         'results',
+                                         json=dict(results_compat.transform(state, {'steps': steps}),
+                                                   piece=piece))
+        except Exception as exn:
+            logging.warning('RESULTS : INCREMENTAL : FAILED : %s', exn)
+            return False
+
+        if res.status_code in INCREMENTAL_RESULTS_UNSUPPORTED:
+            logging.info('RESULTS : INCREMENTAL : UNSUPPORTED : %d', res.status_code)
+            self.enabled = False
+            return False
+        elif not 200 <= res.status_code < 300:
+            logging.warning('RESULTS : INCREMENTAL : FAILED : status_code=%d', res.status_code)
+            return False
+        else:
+            return True
+
+    def add(self, state, steps, secrets=frozenset()):
+        """Send [steps], masked with the secrets seen so far and [secrets]."""
+        self.secrets.update(secrets)
+        self.secrets.update(_extract_secrets(state.runtime, steps))
+        if not self.enabled or not steps:
+            return
+
+        env = self._env(state.env)
+        masked = self._mask(state, env, steps, self.secrets)
+        piece = self.count
+        self.count += 1
+        if self._post(state, piece, masked):
+            self.used += output_budget.size({'steps': masked})
+            self.sent.append((piece, steps, env, masked))
+
+    def finish(self, state, results):
+        """Send again any sent piece that the secrets of the whole run mask
+        differently, and return [results], which has every step of the run,
+        masked with only the steps that were not sent."""
+        secrets = (self.secrets
+                   | state.secrets
+                   | set(_extract_secrets(state.runtime, results['steps'])))
+
+        resent = 0
+        for (piece, steps, env, masked) in self.sent:
+            remasked = self._mask(state, env, steps, secrets)
+            if remasked != masked:
+                if self._post(state, piece, remasked):
+                    resent += 1
+                else:
+                    logging.warning('RESULTS : INCREMENTAL : RESEND_FAILED : piece=%d', piece)
+
+        sent = set(id(s) for (_, steps, _, _) in self.sent for s in steps)
+        if self.sent:
+            logging.info('RESULTS : INCREMENTAL : pieces=%d : resent=%d : steps=%d : unsent=%d',
+                         len(self.sent),
+                         resent,
+                         len(sent),
+                         len(results['steps']) - len(sent))
+
+        return _mask_results(state._replace(env=self._env(state.env)),
+                             dict(results, steps=[s for s in results['steps'] if id(s) not in sent]),
+                             secrets)
 
 
 def convert_engine(engine):
@@ -241,6 +360,10 @@ def _run(state, exec_cb):
     state = state._replace(engine=convert_engine(rc.get_engine(state.repo_config)))
 
     env['TERRATEAM_TMPDIR'] = state.tmpdir
+    env[credential_cache.ENV_NAME] = os.path.join(state.tmpdir, 'credentials')
+    if plugin_cache.cache_dir(env):
+        env['TF_PLUGIN_CACHE_DIR'] = plugin_cache.cache_dir(env)
+
     state = state._replace(env=env)
 
     pre_hooks = exec_cb.pre_hooks(state)
@@ -270,10 +393,28 @@ def _run(state, exec_cb):
 
     state = state._replace(outputs=[])
 
+    stream = _ResultStream(state)
+    stream.add(state, steps)
+
+    tool_prefetch.prepare(state, set_engine_env)
+    state = provider_mirror.prepare(state)
+    plugin_cache.prepare(state, set_engine_env)
+
+    if isolate_data_dirs(state.env):
+        # Workspaces of the same dir only share the data dir, so they can run
+        # at the same time if each one has its own.
+        def concurrent_workspaces(d):
+            return _uses_isolated_data_dir(state.env,
+                                           rc.get_dirspace_workflow(state.repo_config, d)['engine'])
+    else:
+        concurrent_workspaces = None
+
     res = dir_exec.run(rc.get_parallelism(state.repo_config),
                        state.work_manifest['changed_dirspaces'],
                        exec_cb.exec,
-                       (state,))
+                       (state,),
+                       concurrent_workspaces=concurrent_workspaces,
+                       on_result=lambda _d, r: stream.add(state, r[1]['outputs'], r[0].secrets))
 
     for (s, r) in res:
         state = state._replace(success=state.success and s.success)
@@ -301,6 +442,8 @@ def _run(state, exec_cb):
 
     steps.extend(state.outputs)
 
+    credential_cache.log_stats(state.env)
+
     gates = []
     for s in steps:
         # 'gates' may be set but to None, so extract 'gates' then test if it is
@@ -321,7 +464,8 @@ def _run(state, exec_cb):
     if gates:
         results['gates'] = gates
 
-    ret = _store_results(state, results)
+    ret = api.work_manifest_put(state,
+                                json=results_compat.transform(state, stream.finish(state, results)))
 
     if ret.status_code != 200:
         logging.info('RESPONSE : STATUS_CODE : %d', ret.status_code)
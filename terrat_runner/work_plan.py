@@ -5,6 +5,7 @@ import tempfile
 import repo_config as rc
 import work_exec
 import workflow_step
+import workflow_step_infracost_setup
 import workflow_step_terrateam_ssh_key_setup
 
 
@@ -18,6 +19,21 @@ def _merge_integrations(state, steps, integrations):
     return steps
 
 
+def _infracost_hooks(state, plan_json):
+    cost_estimation_config = rc.get_cost_estimation(state.repo_config)
+    if cost_estimation_config['enabled'] and cost_estimation_config['provider'] == 'infracost':
+        return [
+            {
+                'type': 'infracost_setup',
+                'currency': cost_estimation_config['currency'],
+                'plan_json': plan_json,
+                'ignore_errors': True
+            }
+        ]
+    else:
+        return []
+
+
 class Exec(work_exec.ExecInterface):
     def pre_hooks(self, state):
         pre_hooks = state.runtime.update_pre_hook_steps(
@@ -32,21 +48,20 @@ class Exec(work_exec.ExecInterface):
 
         pre_hooks.extend(rc.get_plan_hooks(state.repo_config)['pre'])
 
-        cost_estimation_config = rc.get_cost_estimation(state.repo_config)
-        if cost_estimation_config['enabled']:
-            if cost_estimation_config['provider'] == 'infracost':
-                pre_hooks.append(
-                    {
-                        'type': 'infracost_setup',
-                        'currency': cost_estimation_config['currency'],
-                        'ignore_errors': True
-                    }
-                )
+        if not workflow_step_infracost_setup.plan_json_enabled(env):
+            pre_hooks.extend(_infracost_hooks(state, plan_json=False))
 
         return pre_hooks
 
     def post_hooks(self, state):
-        return (rc.get_all_hooks(state.repo_config)['post']
+        # Estimating the cost from the plans has to wait for all of them.
+        if workflow_step_infracost_setup.plan_json_enabled(state.env):
+            infracost_hooks = _infracost_hooks(state, plan_json=True)
+        else:
+            infracost_hooks = []
+
+        return (infracost_hooks
+                + rc.get_all_hooks(state.repo_config)['post']
                 + rc.get_plan_hooks(state.repo_config)['post'])
 
     def exec(self, state, d):
@@ -103,6 +118,8 @@ class Exec(work_exec.ExecInterface):
                 state.working_dir,
                 os.path.join(state.working_dir, path))
 
+            work_exec.set_data_dir_env(env, workflow['engine'], tmpdir)
+
             state = state._replace(env=env,
                                    engine=work_exec.convert_engine(workflow['engine']))
 
@@ -116,6 +133,9 @@ class Exec(work_exec.ExecInterface):
                 {'type': 'dirspace', 'dir': path, 'workspace': workspace},
                 state.runtime.update_workflow_steps('plan', plan_steps))
 
+            if workflow_step_infracost_setup.plan_json_enabled(state.env):
+                workflow_step_infracost_setup.store_plan_json(state, d)
+
             result = {
                 'path': path,
                 'workspace': workspace,
@@ -3,10 +3,68 @@ import hashlib
 import json
 import logging
 import string
+import time
 
 import api
+import aws_client
 import cmd
+import plan_cache
+import plan_codec
+import repo_config as rc
 import workflow
+import workflow_step_plan
+
+
+def _s3_client(state, s3):
+    plan_storage = dict(rc.get_plan_storage(state.repo_config), region=s3['region'])
+    return workflow_step_plan.s3_client(state, plan_storage)
+
+
+def _fetch_plan_s3(state, s3, plan_path):
+    # Returns [False] if the plan has to be fetched with the commands instead.
+    client = _s3_client(state, s3)
+    if client is None:
+        return False
+
+    start = time.monotonic()
+    try:
+        client.get_file(s3['bucket'], s3['key'], plan_path)
+    except aws_client.Error as exn:
+        logging.warning('APPLY : LOAD_PLAN : S3 : %s : USING_CLI', exn)
+        return False
+
+    logging.info('APPLY : LOAD_PLAN : S3 : bucket=%s : key=%s : time=%.2f',
+                 s3['bucket'],
+                 s3['key'],
+                 time.monotonic() - start)
+    return True
+
+
+def _fetch_plan_cmd(state, plan_data, plan_path):
+    if 's3' in plan_data and _fetch_plan_s3(state, plan_data['s3'], plan_path):
+        return True
+
+    tmpl_vars = {
+        'plan_dst_path': plan_path
+    }
+    fetch_cmd = [string.Template(s).safe_substitute(tmpl_vars) for s in plan_data['fetch']]
+    proc = cmd.run(state, {'cmd': fetch_cmd})
+    return proc.returncode == 0
+
+
+def _delete_plan_cmd(state, plan_data):
+    s3 = plan_data.get('s3')
+    if s3 and s3['delete']:
+        client = _s3_client(state, s3)
+        if client is not None:
+            try:
+                client.delete(s3['bucket'], s3['key'])
+                return
+            except aws_client.Error as exn:
+                logging.warning('APPLY : DELETE_PLAN : S3 : %s : USING_CLI', exn)
+
+    if plan_data.get('delete'):
+        cmd.run(state, {'cmd': plan_data['delete']})
 
 
 def _load_plan(state, dir_path, workspace, plan_path):
@@ -19,6 +77,18 @@ def _load_plan(state, dir_path, workspace, plan_path):
 
     plan_data = base64.b64decode(res.json()['data'])
 
+    if plan_codec.is_encoded(plan_data):
+        try:
+            md5 = plan_codec.decode_to_file(plan_data, plan_path)
+        except plan_codec.Error as exn:
+            return (False, 'Could not decode plan: {}'.format(exn))
+
+        logging.debug('APPLY : LOAD_PLAN : dir_path=%s : workspace=%s : md5=%s',
+                      dir_path,
+                      workspace,
+                      md5)
+        return (True, None)
+
     try:
         plan_data = json.loads(plan_data)
 
@@ -35,16 +105,27 @@ def _load_plan(state, dir_path, workspace, plan_path):
 
             return (True, None)
         elif plan_data['method'] == 'cmd':
-            tmpl_vars = {
-                'plan_dst_path': plan_path
-            }
-            fetch_cmd = [string.Template(s).safe_substitute(tmpl_vars) for s in plan_data['fetch']]
-            proc = cmd.run(state, {'cmd': fetch_cmd})
-            if proc.returncode != 0:
+            sha256 = plan_data.get('sha256')
+            if sha256 and plan_cache.get(state.env, sha256, plan_path):
+                logging.info('APPLY : LOAD_PLAN : dir_path=%s : workspace=%s : CACHED : %s',
+                             dir_path,
+                             workspace,
+                             sha256)
+            elif not _fetch_plan_cmd(state, plan_data, plan_path):
                 return (False, 'Failed to fetch plan, see action logs for more details')
-            if plan_data.get('delete'):
-                cmd.run(state, {'cmd': plan_data['delete']})
-                return (True, None)
+            elif sha256:
+                if plan_cache.digest(plan_path) != sha256:
+                    logging.error('APPLY : LOAD_PLAN : dir_path=%s : workspace=%s : '
+                                  'DIGEST_MISMATCH : %s',
+                                  dir_path,
+                                  workspace,
+                                  sha256)
+                    return (False, 'Fetched plan does not match the plan that was stored')
+
+                plan_cache.put(state.env, sha256, plan_path)
+
+            _delete_plan_cmd(state, plan_data)
+            return (True, None)
         else:
             raise Exception('Unknown method')
     except json.JSONDecodeError:
@@ -1,6 +1,4 @@
-import os
-
-import cmd
+import plan_render
 import workflow
 
 import workflow_step_run
@@ -16,34 +14,20 @@ def run(state, config):
         config['ignore_errors'] = True
 
     if state.env['TERRATEAM_ENGINE_NAME'] == 'terragrunt':
-        (proc, stdout, stderr) = cmd.run_with_output(
-            state,
-            {
-                'cmd': ['terragrunt', 'show', '-json', '${TERRATEAM_PLAN_FILE}'],
-                'log_output': False,
-            })
+        (success, plan_show, error) = plan_render.show_json(state, 'terragrunt')
     else:
-        (proc, stdout, stderr) = cmd.run_with_output(
-            state,
-            {
-                'cmd': ['${TERRATEAM_TF_CMD}', 'show', '-json', '${TERRATEAM_PLAN_FILE}'],
-                'log_output': False,
-            })
+        (success, plan_show, error) = plan_render.show_json(state)
 
-    if proc.returncode != 0:
+    if not success:
         return workflow.make(
             payload={
-                'text': '\n'.join([stderr, stdout]),
+                'text': error,
                 'visible_on': 'error',
             },
             state=state,
             step='tf/checkov',
             success=False)
 
-    plan_show = os.path.join(state.tmpdir, 'checkov.plan.json')
-    with open(plan_show, 'w') as f:
-        f.write(stdout)
-
     extra_args = config.get('extra_args')
     if extra_args:
         return workflow_step_run.run(
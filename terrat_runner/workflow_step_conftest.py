@@ -1,6 +1,6 @@
 import os
 
-import cmd
+import plan_render
 import workflow
 
 import workflow_step_run
@@ -20,27 +20,18 @@ def run(state, config):
     else:
         working_dir = state.working_dir
 
-    (proc, stdout, stderr) = cmd.run_with_output(
-        state._replace(working_dir=working_dir),
-        {
-            'cmd': ['${TERRATEAM_TF_CMD}', 'show', '-json', '${TERRATEAM_PLAN_FILE}'],
-            'log_output': False,
-        })
+    (success, plan_show, error) = plan_render.show_json(state._replace(working_dir=working_dir))
 
-    if proc.returncode != 0:
+    if not success:
         return workflow.make(
             payload={
-                'text': '\n'.join([stderr, stdout]),
+                'text': error,
                 'visible_on': 'error',
             },
             state=state,
             step='tf/conftest',
             success=False)
 
-    plan_show = os.path.join(state.tmpdir, 'conftest.plan.json')
-    with open(plan_show, 'w') as f:
-        f.write(stdout)
-
     extra_args = config.get('extra_args', [])
     return workflow_step_run.run(
         state._replace(working_dir=working_dir),
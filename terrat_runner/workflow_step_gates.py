@@ -42,7 +42,7 @@ def run(state, config):
                     for r in g.get('all_of', []) + g.get('any_of', []):
                         add_reviewers.add(r)
 
-            state.runtime.add_reviewers(state.env, add_reviewers)
+            state.runtime.add_reviewers(state, add_reviewers)
 
             # Setting gates requires that the workflow step has failed.
             return workflow.make(
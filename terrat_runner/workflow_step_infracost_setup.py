@@ -1,12 +1,22 @@
 from datetime import datetime
+import concurrent.futures
+import hashlib
 import json
 import logging
 import os
+import shutil
 import subprocess
+import time
+
+import yaml
 
 import cmd
+import engine_tf
 import infracost
+import infracost_cache
+import plan_render
 import retry
+import tf_modules
 import workflow
 
 
@@ -37,6 +47,21 @@ def _run_retry(state, c):
     return stdout
 
 
+def _base_ref(state):
+    # The base branch as fetched from the remote if there is one, otherwise the
+    # local branch.  Both base checkouts and the base cache key use it, so a
+    # cached breakdown is always for the commit that would be checked out.
+    base_ref = state.work_manifest['base_ref']
+    remote_ref = 'refs/remotes/origin/' + base_ref
+    ret = subprocess.run(['git', 'rev-parse', '--verify', '--quiet', remote_ref + '^{commit}'],
+                         cwd=state.working_dir,
+                         capture_output=True)
+    if ret.returncode == 0:
+        return remote_ref
+    else:
+        return base_ref
+
+
 def _checkout_base(state):
     current_branch = subprocess.check_output(['git', 'branch', '--show-current'],
                                              cwd=state.working_dir)
@@ -51,7 +76,7 @@ def _checkout_base(state):
     subprocess.check_call(['git', 'branch'], cwd=state.working_dir)
     # If they made any changes to the repo, stash it for now
     subprocess.call(['git', 'stash', 'push'])
-    subprocess.check_call(['git', 'checkout', state.work_manifest['base_ref'], '--'],
+    subprocess.check_call(['git', 'checkout', _base_ref(state), '--'],
                           cwd=state.working_dir)
     return current_branch.strip()
 
@@ -90,7 +115,11 @@ def _configure_infracost(state, config):
                 env.get(INFRACOST_CURRENCY, config['currency'])])
 
 
-def _resolve_config_file(state, infracost_dir, dirspaces):
+def _use_worktree(state):
+    return state.env.get('TERRATEAM_INFRACOST_BASE_WORKTREE', '').lower() in ('1', 'true')
+
+
+def _resolve_config_file(state, infracost_dir, dirspaces, name='config.yml', named=False):
     # A user-provided Infracost config file takes precedence over the one
     # Terrateam generates.  It is set via the INFRACOST_CONFIG_FILE environment
     # variable (e.g. from an `env` hook).  The path may be absolute or relative
@@ -110,16 +139,16 @@ def _resolve_config_file(state, infracost_dir, dirspaces):
             'INFRACOST : CUSTOM_CONFIG_FILE_NOT_FOUND : %s : '
             'falling back to generated config', path)
 
-    infracost_config_yml = os.path.join(infracost_dir, 'config.yml')
-    infracost.create_infracost_yml(infracost_config_yml, dirspaces)
+    infracost_config_yml = os.path.join(infracost_dir, name)
+    infracost.create_infracost_yml(infracost_config_yml, dirspaces, named=named)
     return infracost_config_yml
 
 
-def _create_base_infracost(state, infracost_dir, infracost_json):
+def _create_base_infracost(state, infracost_dir, infracost_json, dirspaces, named=False):
     current_branch = _checkout_base(state)
     try:
         infracost_config_yml = _resolve_config_file(
-            state, infracost_dir, state.work_manifest['base_dirspaces'])
+            state, infracost_dir, dirspaces, name='config-base.yml', named=named)
 
         _run_retry(state,
                    ['infracost',
@@ -133,6 +162,514 @@ def _create_base_infracost(state, infracost_dir, infracost_json):
         subprocess.call(['git', 'stash', 'pop'])
 
 
+def _create_base_infracost_worktree(state, infracost_dir, infracost_json, dirspaces):
+    # Check the base branch out into its own worktree, so the working tree is
+    # never touched and the head breakdown can run at the same time.
+    worktree = os.path.join(infracost_dir, 'base')
+    subprocess.check_call(['git', 'worktree', 'add', '--detach', worktree, _base_ref(state)],
+                          cwd=state.working_dir)
+    try:
+        infracost_config_yml = _resolve_config_file(
+            state._replace(working_dir=worktree),
+            infracost_dir,
+            dirspaces,
+            name='config-base.yml',
+            named=True)
+
+        _run_retry(state._replace(working_dir=worktree),
+                   ['infracost',
+                    'breakdown',
+                    '--config-file={}'.format(infracost_config_yml),
+                    '--format=json',
+                    '--out-file={}'.format(infracost_json)])
+    finally:
+        subprocess.call(['git', 'worktree', 'remove', '--force', worktree], cwd=state.working_dir)
+
+
+def _create_head_infracost(state, infracost_dir, infracost_json, dirspaces, named=False,
+                           name='config.yml'):
+    infracost_config_yml = _resolve_config_file(
+        state, infracost_dir, dirspaces, name=name, named=named)
+
+    logging.info('INFRACOST : CONFIG')
+
+    with open(infracost_config_yml, 'r') as f:
+        logging.info('%s', f.read())
+
+    return _run_retry(state,
+                      ['infracost',
+                       'breakdown',
+                       '--config-file={}'.format(infracost_config_yml),
+                       '--format=json',
+                       '--out-file={}'.format(infracost_json)])
+
+
+def _timed(f, *args, **kwargs):
+    start = time.monotonic()
+    ret = f(*args, **kwargs)
+    return (ret, time.monotonic() - start)
+
+
+def _git_output(state, args):
+    return subprocess.check_output(['git'] + args, cwd=state.working_dir).decode('utf-8').strip()
+
+
+def _infracost_version(state):
+    return subprocess.check_output(['infracost', '--version'],
+                                   cwd=state.working_dir).decode('utf-8').strip()
+
+
+def _base_cache_key(state, config, dirspaces, named):
+    # Everything the base breakdown depends on: the base commit, the dirspaces
+    # priced and how they are configured, and how Infracost prices them.
+    base_sha = _git_output(state, ['rev-parse', _base_ref(state) + '^{commit}'])
+
+    config_file = state.env.get(INFRACOST_CONFIG_FILE)
+    if config_file and os.path.isabs(config_file):
+        with open(config_file, 'rb') as f:
+            config_file_id = hashlib.sha256(f.read()).hexdigest()
+    elif config_file:
+        ret = subprocess.run(['git', 'rev-parse', '{}:{}'.format(base_sha, config_file)],
+                             cwd=state.working_dir,
+                             capture_output=True)
+        config_file_id = ret.stdout.decode('utf-8').strip() if ret.returncode == 0 else None
+    else:
+        config_file_id = None
+
+    key = {
+        'base_sha': base_sha,
+        'dirspaces': sorted([ds['path'], ds['workspace']] for ds in dirspaces),
+        'config_file': [config_file, config_file_id],
+        'currency': state.env.get(INFRACOST_CURRENCY, config['currency']),
+        'infracost': _infracost_version(state),
+        'named': named,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _rebase_project_paths(src, dst, f):
+    # Rewrite the path of every project of the breakdown [src] with [f].
+    with open(src) as fd:
+        breakdown = json.load(fd)
+
+    for project in breakdown.get('projects', []):
+        if 'path' in project.get('metadata', {}):
+            project['metadata']['path'] = f(project['metadata']['path'])
+
+    with open(dst, 'w') as fd:
+        json.dump(breakdown, fd)
+
+
+def _create_base(state, config, infracost_dir, infracost_json, dirspaces, named, worktree):
+    # Project paths are where the breakdown was made, which differs between
+    # runs and between worktree and in place checkouts, so cached breakdowns
+    # keep them relative to the checkout and are put back under this run's
+    # working dir when they are used.  Projects must be named for the same
+    # reason, see [infracost.create_infracost_yml].
+    key = None
+    if infracost_cache.enabled(state):
+        try:
+            key = _base_cache_key(state, config, dirspaces, named)
+        except (OSError, subprocess.CalledProcessError) as exn:
+            logging.warning('INFRACOST : BASE_CACHE_KEY_FAILED : %s', exn)
+
+    if key is not None and infracost_cache.get(state, key, infracost_json):
+        _rebase_project_paths(infracost_json,
+                              infracost_json,
+                              lambda p: os.path.join(state.working_dir, p))
+        return
+
+    if worktree:
+        _create_base_infracost_worktree(state, infracost_dir, infracost_json, dirspaces)
+        root = os.path.join(infracost_dir, 'base')
+    else:
+        _create_base_infracost(state, infracost_dir, infracost_json, dirspaces, named=named)
+        root = state.working_dir
+
+    if key is not None:
+        relative_json = os.path.join(infracost_dir, 'infracost-prev-relative.json')
+        _rebase_project_paths(infracost_json,
+                              relative_json,
+                              lambda p: _make_path_relative(root, p))
+        infracost_cache.put(state, key, relative_json)
+
+
+def _use_incremental(state):
+    if state.env.get('TERRATEAM_INFRACOST_INCREMENTAL', '').lower() not in ('1', 'true'):
+        return False
+    elif state.env.get(INFRACOST_CONFIG_FILE):
+        logging.info('INFRACOST : INCREMENTAL : SKIPPED : custom config file')
+        return False
+    else:
+        return True
+
+
+def _dirspace_key(ds):
+    return (ds['path'], ds['workspace'])
+
+
+def _module_closures(state, dirspaces):
+    return {ds['path']: tf_modules.closure(state.working_dir, [ds['path']]) for ds in dirspaces}
+
+
+def _trees(state, rev, closures):
+    """Return the tree id at [rev] of every dir in [closures], the module
+    closure of each dir, leaving out the dirs that do not exist there."""
+    all_paths = sorted(set(p for ps in closures.values() for p in ps if p != '.'))
+    trees = {}
+    if all_paths:
+        out = _git_output(state, ['ls-tree', rev, '--'] + all_paths)
+        for line in out.splitlines():
+            (info, path) = line.split('\t', 1)
+            trees[path] = info.split()[2]
+    if any('.' in ps for ps in closures.values()):
+        trees['.'] = _git_output(state, ['rev-parse', rev + '^{tree}'])
+    return trees
+
+
+def _modules_changed(state, dirspaces):
+    """Return the keys of [dirspaces] whose dir or one of the local modules it
+    uses differs between the base and HEAD."""
+    closures = _module_closures(state, dirspaces)
+    head = _trees(state, 'HEAD', closures)
+    base = _trees(state, _base_ref(state), closures)
+    return set(_dirspace_key(ds) for ds in dirspaces
+               if any(head.get(p) != base.get(p) for p in closures[ds['path']]))
+
+
+def _project_cache_keys(state, config, dirspaces):
+    # A project is priced the same as long as its dir and the local modules it
+    # uses are, so it is keyed by their trees.
+    paths = _module_closures(state, dirspaces)
+    trees = _trees(state, 'HEAD', paths)
+
+    common = {
+        'currency': state.env.get(INFRACOST_CURRENCY, config['currency']),
+        'infracost': _infracost_version(state),
+    }
+    keys = {}
+    for ds in dirspaces:
+        if ds['path'] == '.':
+            key = dict(common, trees=[['.', trees['.']]], workspace=ds['workspace'])
+        else:
+            key = dict(common,
+                       trees=[[p, trees.get(p)] for p in paths[ds['path']]],
+                       workspace=ds['workspace'])
+        keys[_dirspace_key(ds)] = 'project-' + hashlib.sha256(
+            json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    return keys
+
+
+def _split_breakdown(breakdown_json, out_dir):
+    """Write each project of a breakdown to its own breakdown file in
+    [out_dir], named after the project.  Returns the project names and
+    files."""
+    with open(breakdown_json) as f:
+        breakdown = json.load(f)
+
+    os.makedirs(out_dir, exist_ok=True)
+    ret = {}
+    for idx, project in enumerate(breakdown.get('projects', [])):
+        path = os.path.join(out_dir, '{}.json'.format(idx))
+        with open(path, 'w') as f:
+            json.dump(dict(breakdown, projects=[project]), f)
+        ret[project['name']] = path
+
+    return ret
+
+
+def _join_breakdowns(paths, out):
+    # Only the projects are joined, the totals are made by [infracost output].
+    breakdown = None
+    for path in paths:
+        with open(path) as f:
+            b = json.load(f)
+        if breakdown is None:
+            breakdown = b
+        else:
+            breakdown['projects'].extend(b.get('projects', []))
+
+    with open(out, 'w') as f:
+        json.dump(breakdown, f)
+
+
+def _set_project_path(path, project_path):
+    # A cached project may have been priced in another working directory.
+    with open(path) as f:
+        breakdown = json.load(f)
+
+    for project in breakdown.get('projects', []):
+        project['metadata']['path'] = project_path
+
+    with open(path, 'w') as f:
+        json.dump(breakdown, f)
+
+
+def _unchanged_projects(state, config, infracost_dir, dirspaces):
+    """Return the output of pricing [dirspaces] and a breakdown file for each
+    of them, from the cache where possible, and otherwise from one breakdown of
+    all the others."""
+    projects_dir = os.path.join(infracost_dir, 'projects')
+    os.makedirs(projects_dir, exist_ok=True)
+    use_cache = infracost_cache.enabled(state)
+    keys = {}
+    if use_cache:
+        try:
+            keys = _project_cache_keys(state, config, dirspaces)
+        except (OSError, subprocess.CalledProcessError) as exn:
+            logging.warning('INFRACOST : PROJECT_CACHE_KEY_FAILED : %s', exn)
+            use_cache = False
+
+    paths = []
+    missing = []
+    for ds in dirspaces:
+        path = os.path.join(projects_dir, hashlib.sha256(
+            infracost.project_name(ds).encode('utf-8')).hexdigest() + '.json')
+        if use_cache and infracost_cache.get(state, keys[_dirspace_key(ds)], path):
+            _set_project_path(path, os.path.join(state.working_dir, ds['path']))
+            paths.append(path)
+        else:
+            missing.append(ds)
+
+    logging.info('INFRACOST : INCREMENTAL : unchanged=%d : cached=%d : priced=%d',
+                 len(dirspaces),
+                 len(paths),
+                 len(missing))
+
+    output = ''
+    if missing:
+        priced_json = os.path.join(infracost_dir, 'infracost-unchanged.json')
+        output = _create_head_infracost(state,
+                               infracost_dir,
+                               priced_json,
+                               missing,
+                               named=True,
+                               name='config-unchanged.yml')
+        split = _split_breakdown(priced_json, os.path.join(infracost_dir, 'priced'))
+        for ds in missing:
+            path = split.get(infracost.project_name(ds))
+            if path is not None:
+                paths.append(path)
+                if use_cache:
+                    infracost_cache.put(state, keys[_dirspace_key(ds)], path)
+
+    return (output, paths)
+
+
+def _output(state, paths, out):
+    _run_retry(state,
+               ['infracost',
+                'output',
+                '--format=json',
+                '--out-file={}'.format(out)] +
+               ['--path={}'.format(p) for p in paths])
+
+
+def _create_infracost_incremental(state, config, infracost_dir, prev_infracost, curr_infracost):
+    # Unchanged dirspaces cost the same before and after, so they are priced
+    # once, or taken from the cache, and only the changed dirspaces are priced
+    # on both the base and the head.  A dirspace using a local module that
+    # changed counts as changed even if it is not in the changed dirspaces.
+    wm = state.work_manifest
+    changed = set(_dirspace_key(ds) for ds in wm['changed_dirspaces'])
+    others = [ds for ds in wm['dirspaces'] if _dirspace_key(ds) not in changed]
+    try:
+        modules_changed = _modules_changed(state, others)
+    except (OSError, subprocess.CalledProcessError) as exn:
+        logging.warning('INFRACOST : INCREMENTAL : MODULES_CHANGED_FAILED : %s', exn)
+        modules_changed = set(_dirspace_key(ds) for ds in others)
+    if modules_changed:
+        logging.info('INFRACOST : INCREMENTAL : modules_changed=%d', len(modules_changed))
+    changed |= modules_changed
+    head_keys = set(_dirspace_key(ds) for ds in wm['dirspaces'])
+    head_changed = [ds for ds in wm['dirspaces'] if _dirspace_key(ds) in changed]
+    unchanged = [ds for ds in wm['dirspaces'] if _dirspace_key(ds) not in changed]
+    # A dirspace only on the base is priced there even if it did not change.
+    base_priced = [ds for ds in wm['base_dirspaces']
+                   if _dirspace_key(ds) in changed or _dirspace_key(ds) not in head_keys]
+
+    head_changed_json = os.path.join(infracost_dir, 'infracost-changed.json')
+    base_changed_json = os.path.join(infracost_dir, 'infracost-prev-changed.json')
+    worktree = _use_worktree(state)
+
+    def _head():
+        output = ''
+        if head_changed:
+            output = _create_head_infracost(state,
+                                            infracost_dir,
+                                            head_changed_json,
+                                            head_changed,
+                                            named=True)
+        (unchanged_output, unchanged_paths) = _unchanged_projects(state,
+                                                                  config,
+                                                                  infracost_dir,
+                                                                  unchanged)
+        return (output + unchanged_output, unchanged_paths)
+
+    def _base():
+        if base_priced:
+            _create_base(state, config, infracost_dir, base_changed_json, base_priced,
+                         named=True, worktree=worktree)
+
+    if worktree:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            base = pool.submit(_timed, _base)
+            ((output, unchanged_paths), head_time) = _timed(_head)
+            (_, base_time) = base.result()
+    else:
+        (_, base_time) = _timed(_base)
+        ((output, unchanged_paths), head_time) = _timed(_head)
+
+    if unchanged_paths:
+        unchanged_json = os.path.join(infracost_dir, 'infracost-unchanged-all.json')
+        _join_breakdowns(unchanged_paths, unchanged_json)
+        unchanged_paths = [unchanged_json]
+
+    _output(state, ([head_changed_json] if head_changed else []) + unchanged_paths, curr_infracost)
+    _output(state, ([base_changed_json] if base_priced else []) + unchanged_paths, prev_infracost)
+
+    logging.info('INFRACOST : BREAKDOWN : incremental=True : worktree=%r : changed=%d : '
+                 'base=%.2fs : head=%.2fs',
+                 worktree,
+                 len(head_changed),
+                 base_time,
+                 head_time)
+    return output
+
+
+def _create_infracost(state, config, infracost_dir, prev_infracost, curr_infracost):
+    """Create the base and head breakdowns, and return the output of the head
+    breakdown."""
+    # Incremental pricing needs a breakdown on each side to build on.
+    if _use_incremental(state) and (state.work_manifest['dirspaces']
+                                    and state.work_manifest['base_dirspaces']):
+        return _create_infracost_incremental(state,
+                                             config,
+                                             infracost_dir,
+                                             prev_infracost,
+                                             curr_infracost)
+
+    start = time.monotonic()
+    worktree = _use_worktree(state)
+    if worktree:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            base = pool.submit(_timed,
+                               _create_base,
+                               state,
+                               config,
+                               infracost_dir,
+                               prev_infracost,
+                               state.work_manifest['base_dirspaces'],
+                               named=True,
+                               worktree=True)
+            (output, head_time) = _timed(_create_head_infracost,
+                                         state,
+                                         infracost_dir,
+                                         curr_infracost,
+                                         state.work_manifest['dirspaces'],
+                                         named=True)
+            (_, base_time) = base.result()
+    else:
+        # Cached base breakdowns are used in other checkouts, so their projects
+        # must be named.
+        named = infracost_cache.enabled(state)
+        (_, base_time) = _timed(_create_base,
+                                state,
+                                config,
+                                infracost_dir,
+                                prev_infracost,
+                                state.work_manifest['base_dirspaces'],
+                                named=named,
+                                worktree=False)
+        (output, head_time) = _timed(_create_head_infracost,
+                                     state,
+                                     infracost_dir,
+                                     curr_infracost,
+                                     state.work_manifest['dirspaces'],
+                                     named=named)
+
+    logging.info('INFRACOST : BREAKDOWN : worktree=%r : base=%.2fs : head=%.2fs : total=%.2fs',
+                 worktree,
+                 base_time,
+                 head_time,
+                 time.monotonic() - start)
+    return output
+
+
+def plan_json_enabled(env):
+    return env.get('TERRATEAM_INFRACOST_FROM_PLAN', '').lower() in ('1', 'true')
+
+
+def _plan_json_dir(state):
+    return os.path.join(state.tmpdir, 'infracost-plans')
+
+
+def store_plan_json(state, dirspace):
+    """Keep the `show -json` of the plan of [dirspace] for cost estimation after
+    all dirspaces are planned.  [state] is the state after its plan steps."""
+    if not state.success or not isinstance(state.engine, engine_tf.Engine):
+        return
+
+    plan_file = state.env.get('TERRATEAM_PLAN_FILE')
+    if not plan_file or not os.path.exists(plan_file):
+        return
+
+    # The plan steps have usually rendered the plan already, for the diff.
+    (success, path, error) = plan_render.show_json(state, state.engine.tf_cmd)
+    if not success:
+        logging.warning('INFRACOST : PLAN_JSON : %s : %s : FAILED : %s',
+                        dirspace['path'],
+                        dirspace['workspace'],
+                        error)
+        return
+
+    try:
+        os.makedirs(_plan_json_dir(state), exist_ok=True)
+        shutil.copyfile(path,
+                        os.path.join(_plan_json_dir(state),
+                                     infracost.json_filename_of_dirspace(dirspace)))
+    except OSError as exn:
+        logging.warning('INFRACOST : PLAN_JSON : %s : %s : FAILED : %s',
+                        dirspace['path'],
+                        dirspace['workspace'],
+                        exn)
+
+
+def _create_diff_from_plans(state, infracost_dir, diff_infracost):
+    # A plan JSON has the prior state and the planned changes, so Infracost can
+    # diff it on its own, with no base branch checkout and no HCL evaluation.
+    # Returns the output of the diff, or None if there are no plans, and the
+    # dirspace of each project.
+    projects = []
+    project_dirspaces = {}
+    for ds in state.work_manifest['changed_dirspaces']:
+        path = os.path.join(_plan_json_dir(state), infracost.json_filename_of_dirspace(ds))
+        if os.path.exists(path):
+            projects.append({'path': path, 'name': infracost.project_name(ds)})
+            project_dirspaces[infracost.project_name(ds)] = ds
+        else:
+            logging.info('INFRACOST : PLAN_JSON : %s : %s : MISSING', ds['path'], ds['workspace'])
+
+    if not projects:
+        return (None, project_dirspaces)
+
+    infracost_config_yml = os.path.join(infracost_dir, 'config-plans.yml')
+    with open(infracost_config_yml, 'w') as f:
+        yaml.dump({'version': '0.1', 'projects': projects}, f)
+
+    (output, diff_time) = _timed(_run_retry,
+                                 state,
+                                 ['infracost',
+                                  'diff',
+                                  '--config-file={}'.format(infracost_config_yml),
+                                  '--format=json',
+                                  '--out-file={}'.format(diff_infracost)])
+    logging.info('INFRACOST : BREAKDOWN : from_plan=True : projects=%d : diff=%.2fs',
+                 len(projects),
+                 diff_time)
+    return (output, project_dirspaces)
+
+
 def _make_path_relative(base, path):
     if path == base:
         return '.'
@@ -152,30 +689,26 @@ def run(state, config):
         logging.info('INFRACOST : SETUP')
         _configure_infracost(state, config)
 
-        _create_base_infracost(state, infracost_dir, prev_infracost)
-
-        infracost_config_yml = _resolve_config_file(
-            state, infracost_dir, state.work_manifest['dirspaces'])
-
-        logging.info('INFRACOST : CONFIG')
-
-        with open(infracost_config_yml, 'r') as f:
-            logging.info('%s', f.read())
-
-        output = _run_retry(state,
-                            ['infracost',
-                             'breakdown',
-                             '--config-file={}'.format(infracost_config_yml),
-                             '--format=json',
-                             '--out-file={}'.format(curr_infracost)])
+        if config.get('plan_json'):
+            (output, project_dirspaces) = _create_diff_from_plans(state,
+                                                                  infracost_dir,
+                                                                  diff_infracost)
+            if output is None:
+                return workflow.make(payload={'text': 'No plans to estimate the cost of'},
+                                     state=state,
+                                     step='tf/cost-estimation',
+                                     success=False)
+        else:
+            project_dirspaces = {}
+            output = _create_infracost(state, config, infracost_dir, prev_infracost, curr_infracost)
 
-        _run_retry(state,
-                   ['infracost',
-                    'diff',
-                    '--format=json',
-                    '--path={}'.format(curr_infracost),
-                    '--compare-to={}'.format(prev_infracost),
-                    '--out-file={}'.format(diff_infracost)])
+            _run_retry(state,
+                       ['infracost',
+                        'diff',
+                        '--format=json',
+                        '--path={}'.format(curr_infracost),
+                        '--compare-to={}'.format(prev_infracost),
+                        '--out-file={}'.format(diff_infracost)])
 
         if 'level=error' not in output:
             with open(diff_infracost) as f:
@@ -194,11 +727,18 @@ def run(state, config):
             try:
                 dirspaces = [
                     {
-                        'dir': _make_path_relative(state.working_dir, p['metadata']['path']),
+                        # Projects only on the base branch are in its worktree.
+                        'dir': project_dirspaces.get(p['name'], {}).get(
+                            'path',
+                            _make_path_relative(
+                                os.path.join(infracost_dir, 'base'),
+                                _make_path_relative(state.working_dir, p['metadata']['path']))),
                         # A user-provided config file may not set a Terraform
                         # workspace on each project, in which case Infracost
                         # omits terraformWorkspace from the metadata.
-                        'workspace': p['metadata'].get('terraformWorkspace', 'default'),
+                        'workspace': project_dirspaces.get(p['name'], {}).get(
+                            'workspace',
+                            p['metadata'].get('terraformWorkspace', 'default')),
                         'prev_monthly_cost': infracost.convert_cost(p['pastBreakdown']['totalMonthlyCost']),
                         'total_monthly_cost': infracost.convert_cost(p['breakdown']['totalMonthlyCost']),
                         'diff_monthly_cost': infracost.convert_cost(p['diff']['totalMonthlyCost'])
@@ -1,3 +1,4 @@
+import base64
 import datetime
 import json
 import logging
@@ -8,6 +9,8 @@ import time
 
 import requests
 
+import aws_client
+import credential_cache
 import requests_retry
 import retry
 import run_state
@@ -16,7 +19,8 @@ import workflow
 
 TRIES = 3
 INITIAL_SLEEP = 2
-BACKOFF = 1.5
+
+STS_RETRY = retry.Policy('OIDC', TRIES, INITIAL_SLEEP)
 
 DEFAULT_AWS_AUDIENCE = 'sts.amazonaws.com'
 DEFAULT_AZURE_AUDIENCE = 'api://AzureADTokenExchange'
@@ -46,56 +50,109 @@ def _safe_coerce(coerce, default, v):
         return default
 
 
-def assume_role_with_web_identity(state, config, web_identity_token):
-    role_arn = _subst(state, config['role_arn'])
-    duration = _safe_coerce(int, DEFAULT_DURATION, _subst(state, config.get('duration', DEFAULT_DURATION)))
-    session_name = _subst(state, config.get('session_name', DEFAULT_SESSION_NAME))
+def _parse_time(s):
+    return datetime.datetime.fromisoformat(s.replace('Z', '+00:00')).timestamp()
+
+
+def _id_token_expires_at(token):
+    # An ID token is only reused during the first half of its life, so whoever
+    # uses it still has time to exchange it.
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return claims['iat'] + (claims['exp'] - claims['iat']) / 2
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time()
+
+
+def _fetch_id_token(state, audience):
+    res = requests_retry.get(state.env[REQUEST_URL_VAR],
+                             headers={
+                                 'authorization': 'bearer {}'.format(state.env[REQUEST_TOKEN_VAR])
+                             },
+                             params={
+                                 'audience': audience
+                             })
+
+    if res.status_code != 200:
+        raise Auth_error(res.content.decode('utf-8'))
+
+    return res.json()['value']
 
-    proc = retry.run(
+
+def _cli_credentials(proc):
+    creds = json.loads(proc.stdout.decode('utf-8'))['Credentials']
+    return {
+        'access_key_id': creds['AccessKeyId'],
+        'secret_access_key': creds['SecretAccessKey'],
+        'session_token': creds['SessionToken'],
+        'expires_at': _parse_time(creds['Expiration']),
+    }
+
+
+def _run_sts_cli(state, args):
+    proc = STS_RETRY.run(
         lambda: subprocess.run(
-            [
-                'aws',
-                'sts',
-                'assume-role-with-web-identity',
-                '--role-arn', role_arn,
-                '--role-session-name', session_name,
-                '--web-identity-token', web_identity_token,
-                '--duration-seconds', str(duration),
-                '--output', 'json'
-            ],
+            ['aws', 'sts'] + args + ['--output', 'json'],
             cwd=state.working_dir,
             env=state.env,
             capture_output=True
         ),
-        retry.finite_tries(TRIES, lambda ret: ret.returncode == 0),
-        retry.betwixt_sleep_with_backoff(INITIAL_SLEEP, BACKOFF))
-
-    if proc.returncode == 0:
-        output = json.loads(proc.stdout.decode('utf-8'))
-        env = state.env.copy()
-        env['AWS_ACCESS_KEY_ID'] = output['Credentials']['AccessKeyId']
-        env['AWS_SECRET_ACCESS_KEY'] = output['Credentials']['SecretAccessKey']
-        env['AWS_SESSION_TOKEN'] = output['Credentials']['SessionToken']
-        state = run_state.set_secret(state, env['AWS_ACCESS_KEY_ID'])
-        state = run_state.set_secret(state, env['AWS_SECRET_ACCESS_KEY'])
-        state = run_state.set_secret(state, env['AWS_SESSION_TOKEN'])
-        state = state._replace(env=env)
+        lambda ret: ret.returncode == 0)
 
-        return workflow.make(payload={},
-                             state=state,
-                             step='auth/oidc',
-                             success=True)
-    else:
-        output = proc.stdout.decode('utf-8') + '\n' + proc.stderr.decode('utf-8')
-        logging.error('OIDC : %s : ERROR : %s', role_arn, output)
-        return workflow.make(
-            payload={
-                'text': output,
-                'visible_on': 'error'
-            },
-            state=state,
-            step='auth/oidc',
-            success=False)
+    if proc.returncode != 0:
+        raise Auth_error(proc.stdout.decode('utf-8') + '\n' + proc.stderr.decode('utf-8'))
+
+    return _cli_credentials(proc)
+
+
+def _assume_role_with_web_identity(state, role_arn, session_name, duration, web_identity_token):
+    # AssumeRoleWithWebIdentity is not signed, so it is a plain HTTPS request
+    # rather than starting the AWS CLI.  The CLI is only used if STS cannot be
+    # reached directly, for example because of a proxy setup it knows about.
+    try:
+        return aws_client.assume_role_with_web_identity(state.env,
+                                                        state.env['AWS_REGION'],
+                                                        role_arn,
+                                                        session_name,
+                                                        duration,
+                                                        web_identity_token)
+    except aws_client.Error as exn:
+        if not exn.unreachable:
+            raise Auth_error(exn.args[0])
+
+        logging.warning('OIDC : %s : STS_UNREACHABLE : %s : USING_CLI', role_arn, exn)
+        return _run_sts_cli(state,
+                            [
+                                'assume-role-with-web-identity',
+                                '--role-arn', role_arn,
+                                '--role-session-name', session_name,
+                                '--web-identity-token', web_identity_token,
+                                '--duration-seconds', str(duration),
+                            ])
+
+
+def _set_aws_credentials(state, creds):
+    env = state.env.copy()
+    env['AWS_ACCESS_KEY_ID'] = creds['access_key_id']
+    env['AWS_SECRET_ACCESS_KEY'] = creds['secret_access_key']
+    env['AWS_SESSION_TOKEN'] = creds['session_token']
+    state = run_state.set_secret(state, env['AWS_ACCESS_KEY_ID'])
+    state = run_state.set_secret(state, env['AWS_SECRET_ACCESS_KEY'])
+    state = run_state.set_secret(state, env['AWS_SESSION_TOKEN'])
+    return state._replace(env=env)
+
+
+def _auth_failed(state, name, exn):
+    logging.error('OIDC : %s : ERROR : %s', name, exn.args[0])
+    return workflow.make(
+        payload={
+            'text': exn.args[0],
+            'visible_on': 'error'
+        },
+        state=state,
+        step='auth/oidc',
+        success=False)
 
 
 def assume_role(state, config):
@@ -103,106 +160,99 @@ def assume_role(state, config):
     duration = _safe_coerce(int, DEFAULT_DURATION, _subst(state, config.get('duration', DEFAULT_DURATION)))
     session_name = _subst(state, config.get('session_name', DEFAULT_SESSION_NAME))
 
-    proc = retry.run(
-        lambda: subprocess.run(
-            [
-                'aws',
-                'sts',
-                'assume-role',
-                '--role-arn', assume_role_arn,
-                '--role-session-name', session_name,
-                '--duration-seconds', str(duration),
-                '--output', 'json'
-            ],
-            cwd=state.working_dir,
-            env=state.env,
-            capture_output=True
-        ),
-        retry.finite_tries(TRIES, lambda ret: ret.returncode == 0),
-        retry.betwixt_sleep_with_backoff(INITIAL_SLEEP, BACKOFF))
-
-    if proc.returncode == 0:
-        output = json.loads(proc.stdout.decode('utf-8'))
-        env = state.env.copy()
-        env['AWS_ACCESS_KEY_ID'] = output['Credentials']['AccessKeyId']
-        env['AWS_SECRET_ACCESS_KEY'] = output['Credentials']['SecretAccessKey']
-        env['AWS_SESSION_TOKEN'] = output['Credentials']['SessionToken']
-        state = run_state.set_secret(state, env['AWS_ACCESS_KEY_ID'])
-        state = run_state.set_secret(state, env['AWS_SECRET_ACCESS_KEY'])
-        state = run_state.set_secret(state, env['AWS_SESSION_TOKEN'])
-        state = state._replace(env=env)
+    def _fetch():
+        try:
+            creds = aws_client.assume_role(state.env,
+                                           state.env['AWS_REGION'],
+                                           assume_role_arn,
+                                           session_name,
+                                           duration)
+        except aws_client.Error as exn:
+            if not exn.unreachable:
+                raise Auth_error(exn.args[0])
+            logging.warning('OIDC : %s : STS_UNREACHABLE : %s : USING_CLI', assume_role_arn, exn)
+            creds = None
+
+        if creds is None:
+            creds = _run_sts_cli(state,
+                                 [
+                                     'assume-role',
+                                     '--role-arn', assume_role_arn,
+                                     '--role-session-name', session_name,
+                                     '--duration-seconds', str(duration),
+                                 ])
+        return (creds, creds['expires_at'])
 
-        return workflow.make(payload={},
-                             state=state,
-                             step='auth/oidc',
-                             success=True)
-    else:
-        output = proc.stdout.decode('utf-8') + '\n' + proc.stderr.decode('utf-8')
-        logging.error('OIDC : %s : ERROR : %s', assume_role_arn, output)
-        return workflow.make(
-            payload={
-                'text': output,
-                'visible_on': 'error'
-            },
-            state=state,
-            step='auth/oidc',
-            success=False)
+    try:
+        # The credentials being used to assume the role are part of the key,
+        # so a different source identity never gets the cached role.
+        creds = credential_cache.get(
+            state.env,
+            'oidc/aws/assume-role',
+            [assume_role_arn, session_name, duration, state.env['AWS_ACCESS_KEY_ID']],
+            _fetch)
+    except Auth_error as exn:
+        return _auth_failed(state, assume_role_arn, exn)
+
+    return workflow.make(payload={},
+                         state=_set_aws_credentials(state, creds),
+                         step='auth/oidc',
+                         success=True)
 
 
 def run_aws(state, config):
     role_arn = _subst(state, config['role_arn'])
     audience = _subst(state, config.get('audience', DEFAULT_AWS_AUDIENCE))
+    duration = _safe_coerce(int, DEFAULT_DURATION, _subst(state, config.get('duration', DEFAULT_DURATION)))
+    session_name = _subst(state, config.get('session_name', DEFAULT_SESSION_NAME))
+    region = _subst(state, config.get('region', DEFAULT_REGION))
 
-    request_url = state.env[REQUEST_URL_VAR]
-    request_token = state.env[REQUEST_TOKEN_VAR]
-
-    res = requests_retry.get(request_url,
-                             headers={
-                                 'authorization': 'bearer {}'.format(request_token)
-                             },
-                             params={
-                                 'audience': audience
-                             })
-
-    if res.status_code == 200:
-        logging.info('OIDC : %s : SUCCESS', role_arn)
-        web_identity_token = res.json()['value']
+    env = state.env.copy()
+    env['AWS_REGION'] = region
+    state = state._replace(env=env)
 
-        state = run_state.set_secret(state, web_identity_token)
+    # Only the credentials are cached.  The ID token expires long before them,
+    # and the token file must hold a valid one, so a new one is fetched every
+    # time.
+    try:
+        web_identity_token = _fetch_id_token(state, audience)
+    except Auth_error as exn:
+        return _auth_failed(state, role_arn, exn)
 
-        web_identity_token_file = os.path.join(state.env['TERRATEAM_TMPDIR'], 'aws_oidc_token_file')
-        with open(web_identity_token_file, 'w') as f:
-            f.write(web_identity_token)
+    logging.info('OIDC : %s : SUCCESS', role_arn)
+    state = run_state.set_secret(state, web_identity_token)
 
-        region = _subst(state, config.get('region', DEFAULT_REGION))
+    web_identity_token_file = os.path.join(state.env['TERRATEAM_TMPDIR'], 'aws_oidc_token_file')
+    with open(web_identity_token_file, 'w') as f:
+        f.write(web_identity_token)
 
-        env = state.env.copy()
-        env['AWS_REGION'] = region
-        state = state._replace(env=env)
+    def _fetch():
         logging.info('OIDC : %s : ASSUMING_ROLE_WITH_WEB_IDENTITY', role_arn)
-        result = assume_role_with_web_identity(state, config, web_identity_token)
-        if not result.success:
-            return result._replace(step='auth/oidc')
-        elif config.get('assume_role_enabled', True) and 'assume_role_arn' in config:
-            logging.info('OIDC : %s : ASSUMING_ROLE', config['assume_role_arn'])
-            return assume_role(result.state, config)
-        else:
-            return result._replace(payload={},
-                                   step='auth/oidc',
-                                   success=True)
+        creds = _assume_role_with_web_identity(state,
+                                               role_arn,
+                                               session_name,
+                                               duration,
+                                               web_identity_token)
+        return (creds, creds['expires_at'])
 
+    try:
+        creds = credential_cache.get(state.env,
+                                     'oidc/aws',
+                                     [role_arn, audience, session_name, duration, region],
+                                     _fetch)
+    except Auth_error as exn:
+        return _auth_failed(state, role_arn, exn)
+
+    state = _set_aws_credentials(state, creds)
+
+    if config.get('assume_role_enabled', True) and 'assume_role_arn' in config:
+        logging.info('OIDC : %s : ASSUMING_ROLE', config['assume_role_arn'])
+        return assume_role(state, config)
     else:
-        logging.error('OIDC : %s : ERROR : %s',
-                      role_arn,
-                      res.content.decode('utf-8'))
-        return workflow.make(
-            payload={
-                'text': res.content.decode('utf-8'),
-                'visible_on': 'error'
-            },
-            state=state,
-            step='auth/oidc',
-            success=False)
+        return workflow.make(payload={},
+                             state=state,
+                             step='auth/oidc',
+                             success=True)
 
 
 def build_domain_wide_deligation_jwt(service_account, access_token_subject, lifetime):
@@ -352,68 +402,58 @@ def run_gcp(state, config):
     if access_token_subject:
         access_token_subject = _subst(state, access_token_subject)
 
-    request_url = state.env[REQUEST_URL_VAR]
-    request_token = state.env[REQUEST_TOKEN_VAR]
-
-    res = requests_retry.get(request_url,
-                             headers={
-                                 'authorization': 'bearer {}'.format(request_token)
-                             },
-                             params={
-                                 'audience': audience
-                             })
+    # Only the access token is cached, the ID token is not used once it has
+    # been exchanged.  It is still masked in case the exchange fails and echoes
+    # it.
+    web_identity_tokens = []
 
-    if res.status_code == 200:
+    def _fetch():
+        web_identity_token = _fetch_id_token(state, audience)
+        web_identity_tokens.append(web_identity_token)
         logging.info('OIDC : gcp : SUCCESS')
-        web_identity_token = res.json()['value']
+        oauth_token_data = create_token(web_identity_token=web_identity_token,
+                                        provider_id=workload_identity_provider,
+                                        service_account=service_account,
+                                        access_token_subject=access_token_subject,
+                                        lifetime=access_token_lifetime,
+                                        access_token_scopes=access_token_scopes)
+        return (oauth_token_data, _parse_time(oauth_token_data['expiration']))
 
+    try:
+        oauth_token_data = credential_cache.get(state.env,
+                                                'oidc/gcp',
+                                                [service_account,
+                                                 workload_identity_provider,
+                                                 audience,
+                                                 access_token_subject,
+                                                 access_token_lifetime,
+                                                 access_token_scopes],
+                                                _fetch)
+    except Auth_error as exn:
+        for web_identity_token in web_identity_tokens:
+            state = run_state.set_secret(state, web_identity_token)
+        return _auth_failed(state, 'gcp', exn)
+
+    for web_identity_token in web_identity_tokens:
         state = run_state.set_secret(state, web_identity_token)
 
-        try:
-            oauth_token_data = create_token(web_identity_token=web_identity_token,
-                                            provider_id=workload_identity_provider,
-                                            service_account=service_account,
-                                            access_token_subject=access_token_subject,
-                                            lifetime=access_token_lifetime,
-                                            access_token_scopes=access_token_scopes)
-
-            google_oauth_access_token = oauth_token_data['access_token']
-            state = run_state.set_secret(state, google_oauth_access_token)
-
-            google_oauth_access_token_file = os.path.join(state.env['TERRATEAM_TMPDIR'],
-                                                          'gcp_oidc_token_file')
-            with open(google_oauth_access_token_file, 'w') as f:
-                f.write(google_oauth_access_token)
-
-            env = state.env.copy()
-            env['GOOGLE_OAUTH_ACCESS_TOKEN_FILE'] = google_oauth_access_token_file
-            env['GOOGLE_OAUTH_ACCESS_TOKEN'] = google_oauth_access_token
-            state = state._replace(env=env)
-
-            return workflow.make(payload={},
-                                 state=state,
-                                 step='auth/oidc',
-                                 success=True)
-        except Auth_error as exn:
-            return workflow.make(
-                payload={
-                    'text': exn.args[0],
-                    'visible_on': 'error'
-                },
-                state=state,
-                step='auth/oidc',
-                success=False)
-    else:
-        logging.error('OIDC : gcp : ERROR : %s',
-                      res.content.decode('utf-8'))
-        return workflow.make(
-            payload={
-                'text': res.content.decode('utf-8'),
-                'visible_on': 'error'
-            },
-            state=state,
-            step='auth/oidc',
-            success=False)
+    google_oauth_access_token = oauth_token_data['access_token']
+    state = run_state.set_secret(state, google_oauth_access_token)
+
+    google_oauth_access_token_file = os.path.join(state.env['TERRATEAM_TMPDIR'],
+                                                  'gcp_oidc_token_file')
+    with open(google_oauth_access_token_file, 'w') as f:
+        f.write(google_oauth_access_token)
+
+    env = state.env.copy()
+    env['GOOGLE_OAUTH_ACCESS_TOKEN_FILE'] = google_oauth_access_token_file
+    env['GOOGLE_OAUTH_ACCESS_TOKEN'] = google_oauth_access_token
+    state = state._replace(env=env)
+
+    return workflow.make(payload={},
+                         state=state,
+                         step='auth/oidc',
+                         success=True)
 
 
 def run_azure(state, config):
@@ -421,50 +461,40 @@ def run_azure(state, config):
     tenant_id = _subst(state, config['tenant_id'])
     audience = _subst(state, config.get('audience', DEFAULT_AZURE_AUDIENCE))
 
-    request_url = state.env[REQUEST_URL_VAR]
-    request_token = state.env[REQUEST_TOKEN_VAR]
-
-    res = requests_retry.get(request_url,
-                             headers={
-                                 'authorization': 'bearer {}'.format(request_token)
-                             },
-                             params={
-                                 'audience': audience
-                             })
-
-    if res.status_code == 200:
+    def _fetch():
+        oidc_token = _fetch_id_token(state, audience)
         logging.info('OIDC : azure : SUCCESS')
-        oidc_token = res.json()['value']
-
-        state = run_state.set_secret(state, oidc_token)
-
-        env = state.env.copy()
-        env['ARM_USE_OIDC'] = 'true'
-        env['ARM_CLIENT_ID'] = client_id
-        env['ARM_TENANT_ID'] = tenant_id
-        env['ARM_OIDC_TOKEN'] = oidc_token
+        return (oidc_token, _id_token_expires_at(oidc_token))
 
-        subscription_id = config.get('subscription_id')
-        if subscription_id:
-            env['ARM_SUBSCRIPTION_ID'] = _subst(state, subscription_id)
-
-        state = state._replace(env=env)
-
-        return workflow.make(payload={},
-                             state=state,
-                             step='auth/oidc',
-                             success=True)
-    else:
-        logging.error('OIDC : azure : ERROR : %s',
-                      res.content.decode('utf-8'))
-        return workflow.make(
-            payload={
-                'text': res.content.decode('utf-8'),
-                'visible_on': 'error'
-            },
-            state=state,
-            step='auth/oidc',
-            success=False)
+    # The ID token is what the provider exchanges for Azure credentials, so
+    # it is what is reused, see [_id_token_expires_at].
+    try:
+        oidc_token = credential_cache.get(state.env,
+                                          'oidc/azure',
+                                          [audience],
+                                          _fetch,
+                                          margin=0)
+    except Auth_error as exn:
+        return _auth_failed(state, 'azure', exn)
+
+    state = run_state.set_secret(state, oidc_token)
+
+    env = state.env.copy()
+    env['ARM_USE_OIDC'] = 'true'
+    env['ARM_CLIENT_ID'] = client_id
+    env['ARM_TENANT_ID'] = tenant_id
+    env['ARM_OIDC_TOKEN'] = oidc_token
+
+    subscription_id = config.get('subscription_id')
+    if subscription_id:
+        env['ARM_SUBSCRIPTION_ID'] = _subst(state, subscription_id)
+
+    state = state._replace(env=env)
+
+    return workflow.make(payload={},
+                         state=state,
+                         step='auth/oidc',
+                         success=True)
 
 
 def run(state, config):
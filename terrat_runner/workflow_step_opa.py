@@ -2,7 +2,7 @@ import json
 import logging
 import os
 
-import cmd
+import plan_render
 import workflow
 
 import workflow_step_run
@@ -22,27 +22,18 @@ def run(state, config):
     else:
         working_dir = state.working_dir
 
-    (proc, stdout, stderr) = cmd.run_with_output(
-        state._replace(working_dir=working_dir),
-        {
-            'cmd': ['${TERRATEAM_TF_CMD}', 'show', '-json', '${TERRATEAM_PLAN_FILE}'],
-            'log_output': False,
-        })
+    (success, plan_show, error) = plan_render.show_json(state._replace(working_dir=working_dir))
 
-    if proc.returncode != 0:
+    if not success:
         return workflow.make(
             payload={
-                'text': '\n'.join([stderr, stdout]),
+                'text': error,
                 'visible_on': 'error',
             },
             state=state,
             step='tf/opa',
             success=False)
 
-    plan_show = os.path.join(state.tmpdir, 'opa.plan.json')
-    with open(plan_show, 'w') as f:
-        f.write(stdout)
-
     extra_args = config.get('extra_args', [])
 
     fail_on = config.get('fail_on', 'undefined')
@@ -1,5 +1,4 @@
 import base64
-import hashlib
 import json
 import logging
 import os
@@ -7,7 +6,10 @@ import string
 import time
 
 import api
+import aws_client
 import cmd
+import plan_cache
+import plan_codec
 import repo_config as rc
 
 import workflow
@@ -17,8 +19,8 @@ ACCESS_KEY_ID = 'access_key_id'
 SECRET_ACCESS_KEY = 'secret_access_key'
 
 
-def _store_plan_data(state, plan_data, dir_path, workspace, has_changes):
-    plan_data = base64.b64encode(json.dumps(plan_data).encode('utf-8')).decode('utf-8')
+def _store_plan_bytes(state, plan_data, dir_path, workspace, has_changes):
+    plan_data = base64.b64encode(plan_data).decode('utf-8')
 
     res = api.work_manifest_post(state,
                                  'plans',
@@ -32,43 +34,62 @@ def _store_plan_data(state, plan_data, dir_path, workspace, has_changes):
     return (res.status_code == 200, res.text)
 
 
+def _store_plan_data(state, plan_data, dir_path, workspace, has_changes):
+    return _store_plan_bytes(state,
+                             json.dumps(plan_data).encode('utf-8'),
+                             dir_path,
+                             workspace,
+                             has_changes)
+
+
 def _store_plan_terrateam(state, dir_path, workspace, plan_path, has_changes):
     try:
-        with open(plan_path, 'rb') as f:
-            plan_data_raw = f.read()
-            plan_data_encoded = base64.b64encode(plan_data_raw).decode('utf-8')
-            plan_data = {
-                'data': plan_data_encoded,
-                'method': 'terrateam',
-                'version': 1
-            }
+        compression = plan_codec.compression(state.env)
+        (plan_data, md5) = plan_codec.encode(plan_path, compression)
 
         logging.debug('PLAN : STORE_PLAN : dir_path=%s : workspace=%s : md5=%s',
                       dir_path,
                       workspace,
-                      hashlib.md5(plan_data_raw, usedforsecurity=False).hexdigest())
-
-        return _store_plan_data(state, plan_data, dir_path, workspace, has_changes)
+                      md5)
+        logging.info('PLAN : STORE_PLAN : dir_path=%s : workspace=%s : compression=%s : '
+                     'size=%d : encoded_size=%d',
+                     dir_path,
+                     workspace,
+                     compression,
+                     os.path.getsize(plan_path),
+                     len(plan_data))
+
+        return _store_plan_bytes(state, plan_data, dir_path, workspace, has_changes)
     except Exception as exn:
         logging.exception('Failed')
         return (False, str(exn))
 
 
-def _store_plan_cmd(state, plan_storage, dir_path, workspace, plan_path, has_changes):
-    tmpl_vars = {
+def _tmpl_vars(state, dir_path, workspace, plan_path, digest):
+    return {
         'date': time.strftime('%Y-%m-%d'),
+        'digest': digest,
         'dir': dir_path,
         'plan_path': plan_path,
         'time': time.strftime('%H%M%S'),
         'token': state.work_token,
         'workspace': workspace,
     }
-    plan_data = {
+
+
+def _cmd_plan_data(plan_storage, tmpl_vars):
+    return {
         'delete': [string.Template(s).safe_substitute(tmpl_vars) for s in plan_storage.get('delete', [])],
         'fetch': [string.Template(s).safe_substitute(tmpl_vars) for s in plan_storage['fetch']],
         'method': 'cmd',
+        'sha256': tmpl_vars['digest'],
         'version': 1,
     }
+
+
+def _store_plan_cmd(state, plan_storage, dir_path, workspace, plan_path, has_changes, digest):
+    tmpl_vars = _tmpl_vars(state, dir_path, workspace, plan_path, digest)
+    plan_data = _cmd_plan_data(plan_storage, tmpl_vars)
     store_cmd = [string.Template(s).safe_substitute(tmpl_vars) for s in plan_storage['store']]
     (proc, stdout, stderr) = cmd.run_with_output(state, {'cmd': store_cmd})
     if proc.returncode == 0:
@@ -77,7 +98,62 @@ def _store_plan_cmd(state, plan_storage, dir_path, workspace, plan_path, has_cha
         return (False, '\n'.join([stderr, stdout]))
 
 
-def _store_plan_s3(state, plan_storage, dir_path, workspace, plan_path, has_changes):
+def s3_client(state, plan_storage):
+    """Return a client for the S3 plan storage, or [None] if the AWS CLI has to
+    be used.  The CLI is always used if any extra arguments are configured,
+    because they are CLI options."""
+    if any(plan_storage.get(k) for k in ['store_extra_args', 'fetch_extra_args', 'delete_extra_args']):
+        return None
+
+    creds = aws_client.credentials(state.env,
+                                   plan_storage.get(ACCESS_KEY_ID),
+                                   plan_storage.get(SECRET_ACCESS_KEY))
+    return aws_client.s3_client(state.env, plan_storage['region'], creds)
+
+
+def _is_content_addressed(s3_path):
+    return '$digest' in s3_path or '${digest}' in s3_path
+
+
+def _store_plan_s3_native(state, client, plan_storage, s3_path, cmd_plan_storage, dir_path,
+                          workspace, plan_path, has_changes, digest):
+    tmpl_vars = _tmpl_vars(state, dir_path, workspace, plan_path, digest)
+    key = string.Template(s3_path).safe_substitute(tmpl_vars)
+
+    start = time.monotonic()
+    try:
+        # A path with the digest in it only ever holds this plan, so if it
+        # exists the plan does not need to be uploaded again.
+        if (_is_content_addressed(s3_path)
+                and client.size(plan_storage['bucket'], key) == os.path.getsize(plan_path)):
+            logging.info('PLAN : STORE_PLAN : S3 : dir_path=%s : workspace=%s : EXISTS : %s',
+                         dir_path,
+                         workspace,
+                         digest)
+        else:
+            client.put_file(plan_storage['bucket'], key, plan_path)
+    except aws_client.Error as exn:
+        logging.warning('PLAN : STORE_PLAN : S3 : %s : USING_CLI', exn)
+        return None
+
+    logging.info('PLAN : STORE_PLAN : S3 : dir_path=%s : workspace=%s : time=%.2f',
+                 dir_path,
+                 workspace,
+                 time.monotonic() - start)
+
+    # The fetch and delete commands are kept so a runner without the client,
+    # or one that fails to use it, can still fetch the plan.
+    plan_data = _cmd_plan_data(cmd_plan_storage, tmpl_vars)
+    plan_data['s3'] = {
+        'bucket': plan_storage['bucket'],
+        'delete': bool(cmd_plan_storage['delete']),
+        'key': key,
+        'region': plan_storage['region'],
+    }
+    return _store_plan_data(state, plan_data, dir_path, workspace, has_changes)
+
+
+def _store_plan_s3(state, plan_storage, dir_path, workspace, plan_path, has_changes, digest):
     s3_path = plan_storage.get('path', 'terrateam/plans/$dir/$workspace/$date-$time-$token')
     url = 's3://' + plan_storage['bucket'] + '/' + s3_path
 
@@ -93,7 +169,9 @@ def _store_plan_s3(state, plan_storage, dir_path, workspace, plan_path, has_chan
     fetch_extra_args = plan_storage.get('fetch_extra_args', [])
     delete_extra_args = plan_storage.get('delete_extra_args', [])
 
-    if plan_storage.get('delete_used_plans', True):
+    # Plans stored by digest can be shared by several dirspaces and runs, so
+    # they are never deleted.
+    if plan_storage.get('delete_used_plans', True) and not _is_content_addressed(s3_path):
         delete_cmd = cmd_prefix + ['aws', 's3', 'rm'] + delete_extra_args + [url, '--region', plan_storage['region']]
     else:
         delete_cmd = []
@@ -107,40 +185,67 @@ def _store_plan_s3(state, plan_storage, dir_path, workspace, plan_path, has_chan
                  store_extra_args +
                  ['$plan_path', url, '--region', plan_storage['region']])
 
+    cmd_plan_storage = {
+        'delete': delete_cmd,
+        'fetch': fetch_cmd,
+        'store': store_cmd,
+    }
+
+    client = s3_client(state, plan_storage)
+    if client is not None:
+        res = _store_plan_s3_native(state,
+                                    client,
+                                    plan_storage,
+                                    s3_path,
+                                    cmd_plan_storage,
+                                    dir_path,
+                                    workspace,
+                                    plan_path,
+                                    has_changes,
+                                    digest)
+        if res is not None:
+            return res
+
     return _store_plan_cmd(
         state,
-        {
-            'delete': delete_cmd,
-            'fetch': fetch_cmd,
-            'store': store_cmd,
-        },
+        cmd_plan_storage,
         dir_path,
         workspace,
         plan_path,
-        has_changes)
+        has_changes,
+        digest)
 
 
 def _store_plan(state, plan_storage, dir_path, workspace, plan_path, has_changes):
     method = plan_storage['method']
+    digest = plan_cache.digest(plan_path)
     if method == 'terrateam':
-        return _store_plan_terrateam(state, dir_path, workspace, plan_path, has_changes)
+        ret = _store_plan_terrateam(state, dir_path, workspace, plan_path, has_changes)
     elif method == 'cmd':
-        return _store_plan_cmd(state,
-                               plan_storage,
-                               dir_path,
-                               workspace,
-                               plan_path,
-                               has_changes)
-    elif method == 's3':
-        return _store_plan_s3(state,
+        ret = _store_plan_cmd(state,
                               plan_storage,
                               dir_path,
                               workspace,
                               plan_path,
-                              has_changes)
+                              has_changes,
+                              digest)
+    elif method == 's3':
+        ret = _store_plan_s3(state,
+                             plan_storage,
+                             dir_path,
+                             workspace,
+                             plan_path,
+                             has_changes,
+                             digest)
     else:
         raise Exception('Unknown method')
 
+    (success, _) = ret
+    if success:
+        plan_cache.put(state.env, digest, plan_path)
+
+    return ret
+
 
 def run(state, config):
     (success, has_changes, stdout, stderr) = state.engine.plan(state, config)
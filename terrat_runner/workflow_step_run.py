@@ -1,6 +1,7 @@
 import logging
 
 import cmd
+import output_budget
 import workflow
 
 
@@ -19,7 +20,7 @@ def run(state, config):
         # Only capture output if we want to save it somewhere or we have
         # explicitly enabled it.
         if capture_output:
-            proc, stdout, stderr = cmd.run_with_output(state, config)
+            proc, stdout, stderr = output_budget.run_with_output(state, config)
             if proc.returncode == 0:
                 payload = {
                     'text': stdout,